@@ -12,6 +12,9 @@ class NullLogger(Logger):
     def log(self, event_type, data=None):
         pass
 
+    def tell(self):
+        return None
+
 class FileLogger(Logger):
 
     def __init__(self, file, flush=False, reopen=False):
@@ -37,6 +40,12 @@ class FileLogger(Logger):
         elif self.flush:
             self.file.flush()
 
+    def tell(self):
+        """Get the current position in the log file, which can be used to
+        resume logging from this point."""
+        self.file.flush()
+        return self.file.tell()
+
 def read_log_file(file):
     return map(parse_log_line, file)
 
@@ -73,7 +73,7 @@ class ModelInterface:
     def fail_argument_check(self, msg):
         self.parser.error(msg)
 
-    def construct_saver(self, args, *_args, **_kwargs):
+    def construct_saver(self, args, *_args, allow_existing_output=False, **_kwargs):
         device = self.get_device(args)
         if self.use_init and (not self.use_load or args.load_model is None):
             try:
@@ -85,7 +85,7 @@ class ModelInterface:
             else:
                 output = None
             saver = construct_saver(self.construct_model, output, **kwargs)
-            saver.check_output()
+            saver.check_output(allow_existing_output)
             saver.model.to(device)
             self.parameter_seed = args.parameter_seed
             if self.parameter_seed is None:
@@ -103,7 +103,7 @@ class ModelInterface:
                 self.construct_model, args.load_model, args.load_parameters, device)
             if self.use_output:
                 saver = saver.to_directory(args.output)
-                saver.check_output()
+                saver.check_output(allow_existing_output)
         self.on_saver_constructed(args, saver)
         return saver
 
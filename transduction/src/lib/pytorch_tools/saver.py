@@ -3,6 +3,8 @@ import contextlib
 import json
 import os
 import pickle
+import threading
+import time
 
 import torch
 
@@ -15,6 +17,8 @@ LOGS_DIR = 'logs'
 DEFAULT_PARAMETER_FILE = 'main'
 DEFAULT_LOG_FILE = 'main.log'
 DEFAULT_METADATA_NAME = 'main'
+TRAINING_STATE_FILE = 'training_state.pt'
+TRAINING_STATE_PENDING_FILE = 'training_state.pending'
 
 def construct_saver(model_constructor, directory_name, **kwargs):
     model = model_constructor(**kwargs)
@@ -75,6 +79,23 @@ def read_saver(model_constructor, directory_name,
         read_directory_name=directory_name
     )
 
+def read_training_state(directory_name, map_location=None):
+    """Read the training state saved by :py:meth:`ModelSaver.save_training_state`
+    from a model directory, or return ``None`` if there is none."""
+    path = os.path.join(directory_name, TRAINING_STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, map_location=map_location)
+
+def can_start_training_over(directory_name):
+    """Tell whether an existing model directory without a training state can
+    be reused to start training over, because it is empty or was left by a
+    run that was interrupted before it saved its first training state."""
+    return (
+        os.path.exists(os.path.join(directory_name, TRAINING_STATE_PENDING_FILE)) or
+        not os.listdir(directory_name)
+    )
+
 class ModelSaver:
 
     def __init__(self, model, kwargs, directory_name, created_output_dir,
@@ -91,13 +112,40 @@ class ModelSaver:
         self.metadata_cache = metadata_cache
         self.read_directory_name = read_directory_name
 
-    def save(self, file_name=DEFAULT_PARAMETER_FILE):
+    def save(self, file_name=DEFAULT_PARAMETER_FILE, state_dict=None):
+        # If state_dict is given, it is saved instead of the model's current
+        # parameters.
+        if state_dict is None:
+            state_dict = self.model.state_dict()
+        save_atomically(state_dict, self.parameter_path(file_name))
+
+    def save_training_state(self, state):
+        # The training state includes everything needed to resume training,
+        # such as the current parameters and the optimizer state.
+        self.ensure_output_dir_created()
+        self.ensure_kwargs_file_written()
+        save_atomically(state, os.path.join(self.directory_name, TRAINING_STATE_FILE))
+        if os.path.exists(self.training_state_pending_path()):
+            os.remove(self.training_state_pending_path())
+
+    def mark_training_state_pending(self):
+        """Mark the model directory as belonging to a run that will save a
+        training state, so that it can be started over in if the run is
+        interrupted before it does. This must be called before anything else
+        is written to the directory."""
+        self.ensure_output_dir_created()
+        with open(self.training_state_pending_path(), 'w'):
+            pass
+
+    def training_state_pending_path(self):
+        return os.path.join(self.directory_name, TRAINING_STATE_PENDING_FILE)
+
+    def parameter_path(self, file_name=DEFAULT_PARAMETER_FILE):
         self.ensure_output_dir_created()
         self.ensure_kwargs_file_written()
         self.ensure_param_dir_created()
-        param_path = os.path.join(
+        return os.path.join(
             self.directory_name, PARAMETERS_DIR, file_name + '.pt')
-        torch.save(self.model.state_dict(), param_path)
 
     def save_metadata(self, data, name=DEFAULT_METADATA_NAME):
         self.ensure_output_dir_created()
@@ -118,19 +166,28 @@ class ModelSaver:
             self.metadata_cache[name] = data
         return path_lookup(data, path)
 
-    def check_output(self):
-        self.ensure_output_dir_created()
+    def check_output(self, allow_existing=False):
+        self.ensure_output_dir_created(allow_existing)
 
     @contextlib.contextmanager
-    def logger(self, name=DEFAULT_LOG_FILE):
+    def logger(self, name=DEFAULT_LOG_FILE, resume_position=None, overwrite=False):
         self.ensure_output_dir_created()
         self.ensure_logs_dir_created()
         file_name = os.path.join(self.directory_name, LOGS_DIR, name)
         # If a directory is specified, open the log file and return a
         # logger object.
-        # Attempt to open the log file in *exclusive* mode so the
-        # operation will fail early if the log file already exists.
-        with open(file_name, 'x') as fout:
+        if resume_position is None:
+            # Unless the log file is meant to be overwritten, attempt to open
+            # it in *exclusive* mode so the operation will fail early if the
+            # log file already exists.
+            fout = open(file_name, 'w' if overwrite else 'x')
+        else:
+            # Continue an existing log file from a position returned by
+            # FileLogger.tell(), discarding anything logged after it.
+            fout = open(file_name, 'r+')
+            fout.truncate(resume_position)
+            fout.seek(resume_position)
+        with fout:
             logger = FileLogger(fout)
             try:
                 yield logger
@@ -150,10 +207,10 @@ class ModelSaver:
     def logs(self, name=DEFAULT_LOG_FILE):
         return read_logs(self.directory_name, name)
 
-    def ensure_output_dir_created(self):
+    def ensure_output_dir_created(self, allow_existing=False):
         if not self.created_output_dir:
             try:
-                os.makedirs(self.directory_name)
+                os.makedirs(self.directory_name, exist_ok=allow_existing)
             except FileExistsError:
                 raise DirectoryExists('the directory %s already exists' % self.directory_name)
             self.created_output_dir = True
@@ -203,6 +260,103 @@ class ModelSaver:
                 read_directory_name=self.read_directory_name
             )
 
+def save_atomically(obj, path):
+    # Write to a temporary file in the same directory and then rename it, so
+    # that the file at path is never left partially written.
+    temp_path = path + '.tmp'
+    torch.save(obj, temp_path)
+    os.replace(temp_path, path)
+
+class AsyncParameterWriter:
+    """Saves parameters on a background thread, so that saving does not
+    block training.
+
+    The parameters are copied to CPU memory before :py:meth:`save` returns.
+    If a newer save to the same file is requested before the previous one
+    has started writing, only the newer one is written.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.last_write_seconds = None
+        self.num_coalesced_writes = 0
+        self._condition = threading.Condition()
+        # Maps file paths to the state dict to write and the time the write
+        # was requested.
+        self._pending = {}
+        self._is_writing = False
+        self._is_closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, saver, file_name=DEFAULT_PARAMETER_FILE, state_dict=None):
+        """Schedule saving a model's parameters.
+
+        :param saver: The saver of the model.
+        :param file_name: The name of the parameter file.
+        :param state_dict: If given, this is written instead of a copy of
+            the model's current parameters. It must not be modified
+            afterwards.
+        """
+        path = saver.parameter_path(file_name)
+        if path is None:
+            return
+        if state_dict is None:
+            state_dict = {
+                name: tensor.detach().to('cpu', copy=True)
+                for name, tensor in saver.model.state_dict().items()
+            }
+        with self._condition:
+            self._raise_error()
+            if path in self._pending:
+                self.num_coalesced_writes += 1
+            self._pending[path] = (state_dict, time.perf_counter())
+            self._condition.notify_all()
+
+    def flush(self):
+        """Wait until all scheduled saves have been written."""
+        with self._condition:
+            while self._pending or self._is_writing:
+                self._raise_error()
+                self._condition.wait()
+            self._raise_error()
+
+    def close(self):
+        self.flush()
+        with self._condition:
+            self._is_closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError('saving parameters failed') from self._error
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._is_closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                path = next(iter(self._pending))
+                state_dict, request_time = self._pending.pop(path)
+                self._is_writing = True
+            try:
+                save_atomically(state_dict, path)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            with self._condition:
+                self._is_writing = False
+                if error is not None:
+                    self._error = error
+                else:
+                    self.last_write_seconds = time.perf_counter() - request_time
+                self._condition.notify_all()
+
 def write_json(fout, data):
     json.dump(data, fout, indent=2, sort_keys=True)
 
@@ -258,7 +412,16 @@ class NullModelSaver:
         self.kwargs = kwargs
         self.metadata_cache = metadata_cache
 
-    def save(self, file_name=None):
+    def save(self, file_name=None, state_dict=None):
+        pass
+
+    def parameter_path(self, file_name=None):
+        return None
+
+    def save_training_state(self, state):
+        pass
+
+    def mark_training_state_pending(self):
         pass
 
     def save_metadata(self, data, name=DEFAULT_METADATA_NAME):
@@ -267,11 +430,11 @@ class NullModelSaver:
     def metadata(self, path, name=DEFAULT_METADATA_NAME):
         return path_lookup(self.metadata_cache[name], path)
 
-    def check_output(self):
+    def check_output(self, allow_existing=False):
         pass
 
     @contextlib.contextmanager
-    def logger(self, name=None):
+    def logger(self, name=None, resume_position=None, overwrite=False):
         yield NullLogger()
 
     def to_directory(self, directory_name):
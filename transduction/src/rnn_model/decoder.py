@@ -0,0 +1,251 @@
+import math
+from collections.abc import Callable
+from typing import Optional, Union
+
+import torch
+
+from torch_unidirectional import (
+    Unidirectional,
+    ForwardResult,
+    UnidirectionalLSTM,
+    UnidirectionalGRU
+)
+
+UNIDIRECTIONAL_RNN_CLASSES = {
+    'lstm': UnidirectionalLSTM,
+    'gru': UnidirectionalGRU
+}
+
+class RNNDecoderLayers(Unidirectional):
+    """A stack of LSTM or GRU layers followed by attention over the encoder
+    output, which can be used in place of transformer decoder layers.
+
+    The output of the last RNN layer is used as the query of a scaled
+    dot-product attention over the encoder output, and the attention context
+    is combined with it as in Luong et al. (2015). Since the output does not
+    feed back into the RNN, training can run the RNN and the attention over
+    the whole target sequence at once. When decoding one symbol at a time,
+    each step only updates the hidden state of the RNN and attends once, so
+    its cost does not grow with the length of the prefix.
+    """
+
+    def __init__(self,
+        rnn_type: str,
+        num_layers: int,
+        d_model: int,
+        dropout: float
+    ):
+        """
+        :param rnn_type: Either ``'lstm'`` or ``'gru'``.
+        :param num_layers: Number of RNN layers.
+        :param d_model: The size of the input and output vectors, and of the
+            hidden state of the RNN.
+        :param dropout: The amount of dropout applied in between RNN layers
+            and to the output.
+        """
+        super().__init__()
+        self.rnn = UNIDIRECTIONAL_RNN_CLASSES[rnn_type](
+            input_size=d_model,
+            hidden_units=d_model,
+            layers=num_layers,
+            dropout=dropout
+        )
+        self.key_projection = torch.nn.Linear(d_model, d_model, bias=False)
+        self.output_projection = torch.nn.Linear(2 * d_model, d_model)
+        self.dropout = torch.nn.Dropout(dropout)
+
+    def forward(self,
+        input_sequence: torch.Tensor,
+        encoder_sequence: torch.Tensor,
+        input_is_padding_mask: Optional[torch.Tensor]=None,
+        encoder_is_padding_mask: Optional[torch.Tensor]=None,
+        input_segment_ids: Optional[torch.Tensor]=None,
+        encoder_segment_ids: Optional[torch.Tensor]=None,
+        initial_state: Optional[Unidirectional.State]=None,
+        return_state: bool=False,
+        include_first: bool=True
+    ) -> Union[torch.Tensor, ForwardResult]:
+        """
+        :param input_sequence: The target sequence that is given as input to
+            the decoder.
+        :param encoder_sequence: The output sequence of the encoder.
+        :param input_is_padding_mask: Ignored, since padding only occurs at
+            the end of a sequence, and the RNN only reads forward.
+        :param input_segment_ids: Not supported, since the hidden state
+            would be carried from one packed sequence to the next.
+        """
+        if input_segment_ids is not None or encoder_segment_ids is not None:
+            raise ValueError('RNN decoder layers cannot be used with packed sequences')
+        return super().forward(
+            input_sequence,
+            encoder_sequence,
+            encoder_is_padding_mask,
+            initial_state=initial_state,
+            return_state=return_state,
+            include_first=include_first
+        )
+
+    def _attend(self,
+        hidden_states: torch.Tensor,
+        encoder_keys: torch.Tensor,
+        encoder_sequence: torch.Tensor,
+        encoder_is_padding_mask: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        r"""Compute the outputs for any number of RNN outputs at once.
+
+        :param hidden_states: A :math:`B \times n \times d` tensor of outputs
+            of the last RNN layer.
+        :param encoder_keys: The :math:`B \times m \times d` encoder output
+            passed through the key projection.
+        :param encoder_sequence: The :math:`B \times m \times d` encoder
+            output.
+        :param encoder_is_padding_mask: An optional :math:`B \times m`
+            boolean tensor that is true at padding positions.
+        :return: A :math:`B \times n \times d` tensor.
+        """
+        # scores : B x n x m
+        scores = torch.bmm(hidden_states, encoder_keys.transpose(1, 2))
+        scores = scores / math.sqrt(hidden_states.size(2))
+        if encoder_is_padding_mask is not None:
+            scores = scores.masked_fill(encoder_is_padding_mask[:, None, :], -math.inf)
+        weights = torch.softmax(scores, dim=2)
+        # context : B x n x d
+        context = torch.bmm(weights, encoder_sequence)
+        # return : B x n x d
+        return self.dropout(torch.tanh(self.output_projection(
+            torch.concat([hidden_states, context], dim=2)
+        )))
+
+    class State(Unidirectional.State):
+
+        decoder: 'RNNDecoderLayers'
+        rnn_state: Unidirectional.State
+        encoder_keys: torch.Tensor
+        encoder_sequence: torch.Tensor
+        encoder_is_padding_mask: Optional[torch.Tensor]
+        _output: Optional[torch.Tensor]
+
+        def __init__(self,
+            decoder: 'RNNDecoderLayers',
+            rnn_state: Unidirectional.State,
+            encoder_keys: torch.Tensor,
+            encoder_sequence: torch.Tensor,
+            encoder_is_padding_mask: Optional[torch.Tensor],
+            output: Optional[torch.Tensor]
+        ):
+            super().__init__()
+            self.decoder = decoder
+            self.rnn_state = rnn_state
+            # The keys are computed once, when the initial state is created.
+            self.encoder_keys = encoder_keys
+            self.encoder_sequence = encoder_sequence
+            self.encoder_is_padding_mask = encoder_is_padding_mask
+            self._output = output
+
+        def _attend(self, hidden_states: torch.Tensor) -> torch.Tensor:
+            return self.decoder._attend(
+                hidden_states,
+                self.encoder_keys,
+                self.encoder_sequence,
+                self.encoder_is_padding_mask
+            )
+
+        def _with(self,
+            rnn_state: Unidirectional.State,
+            output: Optional[torch.Tensor]
+        ) -> Unidirectional.State:
+            return RNNDecoderLayers.State(
+                self.decoder,
+                rnn_state,
+                self.encoder_keys,
+                self.encoder_sequence,
+                self.encoder_is_padding_mask,
+                output
+            )
+
+        def next(self, input_tensor: torch.Tensor) -> Unidirectional.State:
+            rnn_state = self.rnn_state.next(input_tensor)
+            # output : B x d
+            output = self._attend(rnn_state.output()[:, None, :]).squeeze(1)
+            return self._with(rnn_state, output)
+
+        def output(self) -> Union[torch.Tensor, tuple[torch.Tensor, ...]]:
+            if self._output is None:
+                raise ValueError(
+                    'initial state of RNNDecoderLayers does not have an '
+                    'output'
+                )
+            return self._output
+
+        def batch_size(self) -> int:
+            return self.rnn_state.batch_size()
+
+        def transform_tensors(self,
+            func: Callable[[torch.Tensor], torch.Tensor]
+        ) -> Unidirectional.State:
+            return RNNDecoderLayers.State(
+                self.decoder,
+                self.rnn_state.transform_tensors(func),
+                func(self.encoder_keys),
+                func(self.encoder_sequence),
+                func(self.encoder_is_padding_mask) if self.encoder_is_padding_mask is not None else None,
+                func(self._output) if self._output is not None else None
+            )
+
+        def fastforward(self, input_sequence: torch.Tensor) -> Unidirectional.State:
+            if input_sequence.size(1) == 0:
+                return self
+            # Only the output of the last timestep needs to attend.
+            rnn_state = self.rnn_state.fastforward(input_sequence)
+            output = self._attend(rnn_state.output()[:, None, :]).squeeze(1)
+            return self._with(rnn_state, output)
+
+        def outputs(self,
+            input_sequence: torch.Tensor,
+            include_first: bool
+        ) -> torch.Tensor:
+            return self.forward(input_sequence, return_state=False, include_first=include_first)
+
+        def forward(self,
+            input_sequence: torch.Tensor,
+            return_state: bool,
+            include_first: bool
+        ) -> Union[torch.Tensor, ForwardResult]:
+            if include_first:
+                first_output = self.output()
+            # input_sequence : B x n x d
+            rnn_result = self.rnn_state.forward(
+                input_sequence,
+                return_state=return_state,
+                include_first=False
+            )
+            if return_state:
+                rnn_output = rnn_result.output
+            else:
+                rnn_output = rnn_result
+            # output : B x n x d
+            output = self._attend(rnn_output)
+            if include_first:
+                output = torch.concat([first_output[:, None], output], dim=1)
+            if return_state:
+                if input_sequence.size(1) == 0:
+                    state = self
+                else:
+                    state = self._with(rnn_result.state, output[:, -1])
+                return ForwardResult(output, [], state)
+            else:
+                return output
+
+    def initial_state(self,
+        batch_size: int,
+        encoder_sequence: torch.Tensor,
+        encoder_is_padding_mask: Optional[torch.Tensor]=None
+    ) -> Unidirectional.State:
+        return self.State(
+            self,
+            self.rnn.initial_state(batch_size),
+            self.key_projection(encoder_sequence),
+            encoder_sequence,
+            encoder_is_padding_mask,
+            None
+        )
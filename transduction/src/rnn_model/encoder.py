@@ -0,0 +1,76 @@
+import torch
+
+from torch_unidirectional.rnn import remove_extra_bias_parameters
+
+RNN_CLASSES = {
+    'lstm': torch.nn.LSTM,
+    'gru': torch.nn.GRU
+}
+
+class RNNEncoderLayers(torch.nn.Module):
+    """A stack of bidirectional LSTM or GRU layers that can be used in place
+    of transformer encoder layers.
+
+    The forward and backward directions each have half of the ``d_model``
+    hidden units, so that the output has size ``d_model``.
+    """
+
+    def __init__(self,
+        rnn_type,
+        num_layers,
+        d_model,
+        dropout
+    ):
+        """
+        :param rnn_type: Either ``'lstm'`` or ``'gru'``.
+        :param num_layers: Number of layers.
+        :param d_model: The size of the input and output vectors. It must be
+            even.
+        :param dropout: The amount of dropout applied in between layers.
+        """
+        if d_model % 2 != 0:
+            raise ValueError(f'd_model must be even for a bidirectional RNN encoder, but got {d_model}')
+        super().__init__()
+        self.rnn = RNN_CLASSES[rnn_type](
+            d_model,
+            d_model // 2,
+            num_layers=num_layers,
+            batch_first=True,
+            bidirectional=True,
+            dropout=dropout if num_layers > 1 else 0.0
+        )
+        if rnn_type == 'lstm':
+            # Like UnidirectionalLSTM, remove the redundant bias terms.
+            remove_extra_bias_parameters(self.rnn)
+
+    def forward(self, source_sequence, is_padding_mask=None, segment_ids=None):
+        """
+        :param is_padding_mask: A boolean tensor indicating which positions
+            are padding. Padding must only occur at the end of a sequence.
+            The backward direction starts reading each sequence at its last
+            non-padding position.
+        :param segment_ids: Not supported, since the hidden state would be
+            carried from one packed sequence to the next.
+        """
+        if segment_ids is not None:
+            raise ValueError('RNN encoder layers cannot be used with packed sequences')
+        # source_sequence : B x n x d_model
+        if is_padding_mask is None:
+            output, _ = self.rnn(source_sequence)
+            return output
+        # lengths : B, on the CPU, as required by pack_padded_sequence()
+        lengths = torch.sum(~is_padding_mask, dim=1).cpu()
+        packed_output, _ = self.rnn(torch.nn.utils.rnn.pack_padded_sequence(
+            source_sequence,
+            lengths,
+            batch_first=True,
+            enforce_sorted=False
+        ))
+        # Padding positions are output as zeros.
+        # output : B x n x d_model
+        output, _ = torch.nn.utils.rnn.pad_packed_sequence(
+            packed_output,
+            batch_first=True,
+            total_length=source_sequence.size(1)
+        )
+        return output
@@ -0,0 +1,189 @@
+import collections
+import dataclasses
+import queue
+import time
+from typing import Any
+
+import torch
+
+from .data_util import VocabularyContainer
+from .model_util import SequenceToSequenceModelInterface
+
+def add_async_evaluation_arguments(group):
+    group.add_argument('--async-checkpoint-evaluation', action='store_true', default=False,
+        help='At each checkpoint, copy the parameters to a separate process '
+             'that computes the validation cross entropy while training '
+             'continues. The learning rate schedule and early stopping are '
+             'updated when the result arrives, and if the checkpoint is the '
+             'best so far, the copied parameters are saved. The lag of each '
+             'result is logged in the checkpoint event.')
+    group.add_argument('--async-evaluation-max-lag', type=int, default=1,
+        help='When --async-checkpoint-evaluation is used, the maximum number '
+             'of checkpoints whose evaluation can be pending at once. When a '
+             'new checkpoint would exceed this, training waits for the '
+             'oldest result.')
+    group.add_argument('--async-evaluation-threads', type=int,
+        help='When --async-checkpoint-evaluation is used, the number of CPU '
+             'threads used by the evaluation process. The default is '
+             'PyTorch\'s default.')
+
+@dataclasses.dataclass
+class PendingCheckpoint:
+    key: Any
+    """Identifies the checkpoint to the caller."""
+    state_dicts: list[dict[str, torch.Tensor]]
+    """The parameters that are being evaluated."""
+    submit_time: float
+
+@dataclasses.dataclass
+class CheckpointResult:
+    key: Any
+    state_dicts: list[dict[str, torch.Tensor]]
+    scores: list[dict[str, float]]
+    """The validation scores of each of the state dicts."""
+    lag_seconds: float
+    """The time between submitting the checkpoint and receiving its
+    result."""
+
+class AsyncCheckpointEvaluator:
+    """Evaluates snapshots of a model's parameters on the validation set in a
+    separate process.
+
+    Results are returned in the order that checkpoints were submitted.
+    """
+
+    def __init__(self, evaluate, model_kwargs, validation_batches, vocabs, device, num_threads):
+        """
+        :param evaluate: The function that evaluates a model, with the same
+            signature as :py:func:`sequence_to_sequence.train_util.evaluate`.
+            It must be picklable.
+        :param model_kwargs: The keyword arguments used to construct the
+            model.
+        :param validation_batches: Prepared validation batches.
+        :param vocabs: The vocabularies of the data.
+        :param device: The device on which to evaluate.
+        :param num_threads: The number of CPU threads used by the evaluation
+            process, or ``None`` for the default.
+        """
+        super().__init__()
+        context = torch.multiprocessing.get_context('spawn')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.pending = collections.deque()
+        self.process = context.Process(
+            target=_run_evaluation_process,
+            args=(
+                evaluate,
+                model_kwargs,
+                # Only the padded tensors are needed for evaluation.
+                [dataclasses.replace(batch, pairs=[]) for batch in validation_batches],
+                VocabularyContainer(
+                    source_vocab=vocabs.source_vocab,
+                    target_input_vocab=vocabs.target_input_vocab,
+                    target_output_vocab=vocabs.target_output_vocab,
+                    vocab_is_shared=vocabs.vocab_is_shared
+                ),
+                device,
+                num_threads,
+                self.requests,
+                self.results
+            ),
+            daemon=True
+        )
+        self.process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def num_pending(self) -> int:
+        return len(self.pending)
+
+    def submit(self, key, models) -> None:
+        """Copy the parameters of some models and start evaluating them.
+
+        :param key: An object that is returned with the result.
+        :param models: A list of models with the same architecture.
+        """
+        state_dicts = [
+            {
+                name: tensor.detach().to('cpu', copy=True)
+                for name, tensor in model.state_dict().items()
+            }
+            for model in models
+        ]
+        self.requests.put(state_dicts)
+        self.pending.append(PendingCheckpoint(key, state_dicts, time.perf_counter()))
+
+    def poll(self) -> list[CheckpointResult]:
+        """Get the results that have arrived, without waiting."""
+        results = []
+        while self.pending:
+            try:
+                scores = self.results.get_nowait()
+            except queue.Empty:
+                break
+            results.append(self._finish(scores))
+        return results
+
+    def wait(self) -> CheckpointResult:
+        """Wait for the result of the oldest pending checkpoint."""
+        while True:
+            try:
+                scores = self.results.get(timeout=1)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError('the checkpoint evaluation process exited unexpectedly')
+            else:
+                return self._finish(scores)
+
+    def _finish(self, scores):
+        if isinstance(scores, BaseException):
+            raise RuntimeError('checkpoint evaluation failed') from scores
+        pending = self.pending.popleft()
+        return CheckpointResult(
+            pending.key,
+            pending.state_dicts,
+            scores,
+            time.perf_counter() - pending.submit_time
+        )
+
+    def close(self) -> None:
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join()
+
+def _run_evaluation_process(
+    evaluate,
+    model_kwargs,
+    validation_batches,
+    vocabs,
+    device,
+    num_threads,
+    requests,
+    results
+):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    try:
+        model_interface = SequenceToSequenceModelInterface(
+            use_load=False,
+            use_init=False,
+            use_output=False,
+            require_output=False
+        )
+        model = model_interface.construct_model(**model_kwargs)
+        model.to(device)
+        while True:
+            state_dicts = requests.get()
+            if state_dicts is None:
+                break
+            scores = []
+            for state_dict in state_dicts:
+                model.load_state_dict(state_dict)
+                scores.append(evaluate(model, validation_batches, vocabs, model_interface, device))
+            results.put(scores)
+    except Exception as e:
+        results.put(e)
@@ -0,0 +1,178 @@
+import dataclasses
+import itertools
+import random
+from collections.abc import Iterable
+from typing import Any
+
+import torch
+
+from .batching import get_pair_sort_key, group_into_batches
+from .packing import PackedBatch, prepare_packed_batch
+
+@dataclasses.dataclass
+class PreparedBatch:
+    """A batch of training pairs whose padded tensors have already been
+    built by :py:meth:`SequenceToSequenceModelInterface.prepare_batch`."""
+
+    pairs: list[tuple[torch.Tensor, torch.Tensor]]
+    model_input: Any
+    correct_target: torch.Tensor
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+    def to(self, device: torch.device) -> tuple[Any, torch.Tensor]:
+        """Get the model input and correct target on a device."""
+        model_input = type(self.model_input)(**{
+            field.name : getattr(self.model_input, field.name).to(device, non_blocking=True)
+            for field in dataclasses.fields(self.model_input)
+        })
+        return model_input, self.correct_target.to(device, non_blocking=True)
+
+def prepare_batch(batch, model_interface, device, data):
+    """Pad a batch, or move an already padded :py:class:`PreparedBatch` to
+    the device."""
+    if isinstance(batch, PreparedBatch):
+        return batch.to(device)
+    elif isinstance(batch, PackedBatch):
+        return prepare_packed_batch(batch, device, data)
+    else:
+        return model_interface.prepare_batch(batch, device, data)
+
+def get_prepared_batch(batch, model_interface, device, data):
+    """Pad a batch in CPU memory so that it can be kept for later epochs."""
+    model_input, correct_target = model_interface.prepare_batch(
+        batch,
+        torch.device('cpu'),
+        data
+    )
+    if device.type == 'cuda':
+        # Pinned memory allows the copy to the GPU to be asynchronous.
+        model_input = type(model_input)(**{
+            field.name : getattr(model_input, field.name).pin_memory()
+            for field in dataclasses.fields(model_input)
+        })
+        correct_target = correct_target.pin_memory()
+    return PreparedBatch(batch, model_input, correct_target)
+
+def prepare_batches(batches, model_interface, device, data):
+    """Pad a list of batches once, on the device where they will be used."""
+    return [
+        PreparedBatch(batch, *model_interface.prepare_batch(batch, device, data))
+        for batch in batches
+    ]
+
+class CachedBatchPlan:
+    """Groups training pairs into batches once and keeps the padded tensors
+    of each batch, so that later epochs only need to shuffle the order of the
+    batches.
+
+    The pairs are sorted by length once. Pairs with the same sort key form a
+    bucket. Since the order of pairs within a bucket is arbitrary, it can
+    optionally be reshuffled between epochs, in which case only the batches
+    that overlap reshuffled buckets are re-packed and padded again.
+    """
+
+    def __init__(self,
+        pairs: list[tuple[torch.Tensor, torch.Tensor]],
+        batcher,
+        model_interface,
+        device: torch.device,
+        data
+    ):
+        """
+        :param pairs: Training pairs, in the order used to break ties between
+            pairs of the same length. This list will be sorted in place.
+        :param batcher: The batcher used to group pairs into batches.
+        :param model_interface: The model interface used to pad batches.
+        :param device: The device where the batches will be used. The padded
+            tensors are kept in CPU memory.
+        :param data: The data object with the vocabularies.
+        """
+        super().__init__()
+        self.batcher = batcher
+        self.model_interface = model_interface
+        self.device = device
+        self.data = data
+        self.pairs = pairs
+        # This sorts self.pairs in place.
+        self.batches = self._prepare_batches(batcher.generate_batches(self.pairs))
+        # Each bucket is a (start, stop) range of pair indexes with the same
+        # sort key.
+        self.buckets = []
+        start = 0
+        for _, group in itertools.groupby(self.pairs, key=get_pair_sort_key):
+            stop = start + sum(1 for _ in group)
+            self.buckets.append((start, stop))
+            start = stop
+
+    def _prepare_batches(self, batches: Iterable[list]) -> list[PreparedBatch]:
+        return [
+            get_prepared_batch(batch, self.model_interface, self.device, self.data)
+            for batch in batches
+        ]
+
+    def get_batches(self, generator: random.Random) -> list[PreparedBatch]:
+        """Get the batches in a new random order."""
+        batches = list(self.batches)
+        generator.shuffle(batches)
+        return batches
+
+    def reshuffle_buckets(self, generator: random.Random, probability: float) -> int:
+        """Shuffle the pairs within randomly chosen buckets and re-pack the
+        batches that contain them.
+
+        :param generator: Random number generator.
+        :param probability: The probability of reshuffling each bucket.
+        :return: The number of batches that were re-packed.
+        """
+        # Find the ranges of pair indexes to reshuffle.
+        selected_buckets = [
+            (start, stop)
+            for start, stop in self.buckets
+            if stop - start > 1 and generator.random() < probability
+        ]
+        if not selected_buckets:
+            return 0
+        for start, stop in selected_buckets:
+            bucket = self.pairs[start:stop]
+            generator.shuffle(bucket)
+            self.pairs[start:stop] = bucket
+        # Find the runs of consecutive batches that overlap the reshuffled
+        # buckets. Each run starts and ends on a batch boundary, so it can be
+        # re-packed independently of the other batches.
+        batch_starts = list(itertools.accumulate(
+            (len(batch) for batch in self.batches),
+            initial=0
+        ))
+        is_affected = [False] * len(self.batches)
+        batch_no = 0
+        for start, stop in selected_buckets:
+            while batch_starts[batch_no + 1] <= start:
+                batch_no += 1
+            affected_batch_no = batch_no
+            while affected_batch_no < len(self.batches) and batch_starts[affected_batch_no] < stop:
+                is_affected[affected_batch_no] = True
+                affected_batch_no += 1
+        new_batches = []
+        num_repacked = 0
+        for affected, group in itertools.groupby(
+            zip(is_affected, self.batches, batch_starts),
+            key=lambda x: x[0]
+        ):
+            group = list(group)
+            if affected:
+                run_start = group[0][2]
+                run_stop = run_start + sum(len(batch) for _, batch, _ in group)
+                repacked = self._prepare_batches(self.batcher.generate_batches(
+                    self.pairs[run_start:run_stop]
+                ))
+                num_repacked += len(repacked)
+                new_batches.extend(repacked)
+            else:
+                new_batches.extend(batch for _, batch, _ in group)
+        self.batches = new_batches
+        return num_repacked
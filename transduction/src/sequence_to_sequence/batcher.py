@@ -1,27 +1,65 @@
 import dataclasses
 
-from .model_util import SequenceToSequenceModelInterface
+from .model_util import (
+    SequenceToSequenceModelInterface,
+    has_only_transformer_layers,
+    parse_layers
+)
 from .batching import (
     group_into_batches,
     group_sources_into_batches
 )
 
 def add_batching_arguments(group):
-    group.add_argument('--batching-max-tokens', type=int, required=True)
+    group.add_argument('--batching-max-tokens', type=int,
+        help='The maximum cost of a batch. This is required unless '
+             '--batching-calibrate is used.')
+    group.add_argument('--batching-cost-model',
+        choices=['max-tokens', 'attention'],
+        default='max-tokens',
+        help='How to estimate the cost of a batch. max-tokens uses the '
+             'number of tokens in the padded batch. attention also accounts '
+             'for the quadratic cost of attention, using the dimensions of '
+             'the model, and only batches together examples from the same '
+             'length bucket. In both cases, --batching-max-tokens is the '
+             'maximum cost of a batch, measured in tokens.')
+    group.add_argument('--batching-bucket-width', type=int, default=8,
+        help='When --batching-cost-model is attention, the width of each '
+             'length bucket, in terms of the combined length of the source '
+             'and target sequences.')
 
-def get_batching_dict(args):
+def get_batching_dict(args, batcher):
     return dict(
-        max_tokens=args.batching_max_tokens
+        max_tokens=batcher.max_cost,
+        calibrated=args.batching_calibrate,
+        cost_model=args.batching_cost_model,
+        bucket_width=args.batching_bucket_width
     )
 
-def get_batcher(parser, args, model_interface):
-    if args.batching_max_tokens is not None:
-        return MaxTokensBatcher(
-            args.batching_max_tokens,
-            model_interface
-        )
+def get_batcher(parser, args, model_interface, model_kwargs, max_cost=None):
+    if max_cost is None:
+        max_cost = args.batching_max_tokens
+    if max_cost is not None:
+        if args.batching_cost_model == 'max-tokens':
+            return MaxTokensBatcher(
+                max_cost,
+                model_interface
+            )
+        elif args.batching_cost_model == 'attention':
+            if args.batching_bucket_width < 1:
+                parser.error('--batching-bucket-width must be at least 1')
+            if not has_only_transformer_layers(model_kwargs):
+                parser.error('--batching-cost-model attention can only be used with transformer layers')
+            return AttentionCostBatcher.from_model_kwargs(
+                max_cost,
+                model_interface,
+                model_kwargs,
+                args.batching_bucket_width
+            )
+        else:
+            raise ValueError
     else:
-        raise ValueError
+        parser.error('--batching-max-tokens is required')
 
 @dataclasses.dataclass
 class Batcher:
@@ -60,3 +98,85 @@ class MaxTokensBatcher(Batcher):
 
     def estimate_cost_single(self, source_length, target_length):
         return max(source_length, target_length)
+
+@dataclasses.dataclass
+class AttentionCostBatcher(Batcher):
+    r"""Estimates the cost of a batch from the number of floating point
+    operations in the transformer layers, including the attention terms that
+    are quadratic in sequence length, and never puts examples from different
+    length buckets in the same batch.
+
+    The cost is measured in tokens: it is normalized so that, ignoring the
+    quadratic terms, a pair whose source and target both have length
+    :math:`n` costs :math:`n`, as in :py:class:`MaxTokensBatcher`.
+    """
+
+    d_model: int
+    feedforward_size: int
+    num_encoder_layers: int
+    num_decoder_layers: int
+    bucket_width: int
+
+    @staticmethod
+    def from_model_kwargs(max_cost, model_interface, model_kwargs, bucket_width):
+        return AttentionCostBatcher(
+            max_cost=max_cost,
+            model_interface=model_interface,
+            d_model=model_kwargs['d_model'],
+            feedforward_size=model_kwargs['feedforward_size'],
+            num_encoder_layers=count_layers(model_kwargs['encoder_layers']),
+            num_decoder_layers=count_layers(model_kwargs['decoder_layers']),
+            bucket_width=bucket_width
+        )
+
+    def __post_init__(self):
+        d = self.d_model
+        # The cost per token of the query/key/value/output projections and
+        # the feedforward sublayer.
+        linear_cost = 4 * d * d + 2 * d * self.feedforward_size
+        self._encoder_linear_cost = self.num_encoder_layers * linear_cost
+        # Decoder layers also have a cross-attention query and output
+        # projection per target token.
+        self._decoder_linear_cost = self.num_decoder_layers * (linear_cost + 2 * d * d)
+        # The key and value projections of the encoder output in the
+        # cross-attention of each decoder layer, per source token.
+        self._cross_linear_cost = self.num_decoder_layers * 2 * d * d
+        # The attention scores and weighted sum of values for each pair of
+        # positions.
+        self._encoder_attention_cost = self.num_encoder_layers * 2 * d
+        self._decoder_attention_cost = self.num_decoder_layers * 2 * d
+        self._normalizer = (
+            self._encoder_linear_cost +
+            self._decoder_linear_cost +
+            self._cross_linear_cost
+        )
+
+    def filter_pairs(self, data):
+        return data
+
+    def generate_batches(self, data):
+        return group_into_batches(data, self.is_small_enough, self.get_bucket)
+
+    def generate_source_batches(self, data):
+        return group_sources_into_batches(data, self.is_small_enough, self.get_source_bucket)
+
+    def get_bucket(self, source_length, target_length):
+        return (source_length + target_length) // self.bucket_width
+
+    def get_source_bucket(self, source_length):
+        return source_length // self.bucket_width
+
+    def estimate_cost_single(self, source_length, target_length):
+        n = source_length
+        m = target_length
+        return (
+            self._encoder_linear_cost * n +
+            self._decoder_linear_cost * m +
+            self._cross_linear_cost * n +
+            self._encoder_attention_cost * n * n +
+            # Self-attention and cross-attention.
+            self._decoder_attention_cost * (m * m + m * n)
+        ) / self._normalizer
+
+def count_layers(layers):
+    return sum(num_layers for _, (num_layers,) in parse_layers(layers))
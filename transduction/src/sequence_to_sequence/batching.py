@@ -1,17 +1,39 @@
 from collections.abc import Callable, Iterable
-from typing import Any
+from typing import Any, Optional
 
 import torch
 
+def get_pair_sort_key(pair: tuple[torch.Tensor, torch.Tensor]) -> int:
+    return len(pair[0]) + len(pair[1])
+
 def group_into_batches(
     pairs: list[tuple[torch.Tensor, torch.Tensor]],
-    is_small_enough: Callable[[int, int, int], bool]
+    is_small_enough: Callable[[int, int, int], bool],
+    get_bucket: Optional[Callable[[int, int], int]]=None
 ) -> Iterable[list[tuple[torch.Tensor, torch.Tensor]]]:
-    pairs.sort(key=lambda x: len(x[0]) + len(x[1]))
+    """Sort pairs by length and greedily group them into batches.
+
+    :param pairs: The pairs to group. This list is sorted in place.
+    :param is_small_enough: Whether a batch of a given size and maximum source
+        and target lengths is small enough.
+    :param get_bucket: An optional function that maps source and target
+        lengths to a length bucket. If given, pairs in different buckets are
+        never put in the same batch. It must be monotonic in the sort order.
+    """
+    pairs.sort(key=get_pair_sort_key)
     batch = []
     max_source_length = 0
     max_target_length = 0
+    bucket = None
     for example in pairs:
+        if get_bucket is not None:
+            prev_bucket = bucket
+            bucket = get_bucket(len(example[0]), len(example[1]))
+            if batch and bucket != prev_bucket:
+                yield batch
+                batch = []
+                max_source_length = 0
+                max_target_length = 0
         batch.append(example)
         batch_size = len(batch)
         max_source_length = max(max_source_length, len(example[0]))
@@ -33,12 +55,21 @@ def group_into_batches(
 
 def group_sources_into_batches(
     sources: Iterable[torch.Tensor],
-    is_small_enough: Callable[[int, int, int], bool]
+    is_small_enough: Callable[[int, int, int], bool],
+    get_bucket: Optional[Callable[[int], int]]=None
 ) -> Iterable[list[torch.Tensor]]:
     examples = sorted(enumerate(sources), key=lambda x: len(x[1]))
     batch = []
     max_source_length = 0
+    bucket = None
     for example in examples:
+        if get_bucket is not None:
+            prev_bucket = bucket
+            bucket = get_bucket(len(example[1]))
+            if batch and bucket != prev_bucket:
+                yield batch
+                batch = []
+                max_source_length = 0
         batch.append(example)
         batch_size = len(batch)
         max_source_length = max(max_source_length, len(example[1]))
@@ -1,17 +1,216 @@
-import more_itertools
+import math
+
 import torch
 
+def get_output_log_probs(state):
+    logits = state.output()
+    # The log probabilities are accumulated in at least float32, even if the
+    # model runs in lower precision.
+    return torch.nn.functional.log_softmax(
+        logits,
+        dim=1,
+        dtype=torch.promote_types(logits.dtype, torch.float32)
+    )
+
 def beam_search(initial_state, beam_size, eos_symbol, max_length, device):
+    # This runs beam search on all batch elements ("sentences") at once. It
+    # gives the same results as running beam_search_single() on each sentence
+    # separately.
+    # The beam of every sentence is stored in a batch_size x beam_width
+    # layout. For every beam item, the state keeps one batch element only if
+    # the item is unfinished and its sentence is still being decoded. The
+    # rows of the state are ordered by (sentence, position in beam).
     batch_size = initial_state.batch_size()
-    return [
-        beam_search_single(
-            initial_state.transform_tensors(lambda x: x[i:i+1, ...]),
-            beam_size,
-            eos_symbol,
-            max_length,
-            device
+    if max_length == 0:
+        return [[] for _ in range(batch_size)]
+    beam_unfinished_states = initial_state
+    # row_sentences : num_rows of ints in [0, batch_size)
+    # row_positions : num_rows of ints in [0, beam_width)
+    row_sentences = torch.arange(batch_size, device=device)
+    row_positions = torch.zeros((batch_size,), dtype=torch.long, device=device)
+    # All of these are batch_size x beam_width. Initially, each beam only
+    # contains the empty sequence.
+    beam_log_probs = torch.zeros((batch_size, 1), device=device)
+    beam_is_finished = torch.zeros((batch_size, 1), dtype=torch.bool, device=device)
+    # For finished items, this is the number of symbols before EOS.
+    finished_lengths = torch.zeros((batch_size, 1), dtype=torch.long, device=device)
+    # For finished items, this is the position in the beam at timestep
+    # length - 1 of the item that generated EOS.
+    finished_positions = torch.zeros((batch_size, 1), dtype=torch.long, device=device)
+    # These are batch_size tensors describing where each sentence's output
+    # ends, once it is known.
+    result_lengths = torch.zeros((batch_size,), dtype=torch.long, device=device)
+    result_positions = torch.zeros((batch_size,), dtype=torch.long, device=device)
+    # is_active : batch_size of bool
+    is_active = torch.ones((batch_size,), dtype=torch.bool, device=device)
+    # For each timestep t, these contain batch_size x k tensors containing
+    # the symbol generated by each beam item and the position of its parent
+    # at timestep t - 1.
+    symbols = []
+    backpointers = []
+    for t in range(max_length):
+        beam_width = beam_log_probs.size(1)
+        # output_log_probs : num_rows x output_vocab_size
+        output_log_probs = get_output_log_probs(beam_unfinished_states)
+        output_vocab_size = output_log_probs.size(1)
+        k = min(beam_size, output_vocab_size)
+        # top_output_log_probs : num_rows x k
+        # top_output_symbols : num_rows x k of ints in [0, output_vocab_size)
+        top_output_log_probs, top_output_symbols = torch.topk(
+            output_log_probs,
+            k=k,
+            dim=1,
+            sorted=False
+        )
+        # Arrange the candidates of the unfinished items in the beam layout.
+        # Positions that do not correspond to rows get a log probability of
+        # -inf, so they are never selected.
+        # unfinished_candidate_log_probs : batch_size x beam_width x k
+        unfinished_candidate_log_probs = top_output_log_probs.new_full(
+            (batch_size, beam_width, k),
+            -math.inf
+        )
+        unfinished_candidate_log_probs[row_sentences, row_positions] = (
+            beam_log_probs[row_sentences, row_positions][:, None] +
+            top_output_log_probs
+        )
+        # unfinished_candidate_symbols : batch_size x beam_width x k
+        unfinished_candidate_symbols = torch.zeros(
+            (batch_size, beam_width, k),
+            dtype=torch.long,
+            device=device
+        )
+        unfinished_candidate_symbols[row_sentences, row_positions] = top_output_symbols
+        # flat_unfinished_candidate_log_probs : batch_size x (beam_width * k)
+        flat_unfinished_candidate_log_probs = unfinished_candidate_log_probs.view(batch_size, -1)
+        num_unfinished_candidates = flat_unfinished_candidate_log_probs.size(1)
+        # finished_log_probs : batch_size x beam_width
+        finished_log_probs = beam_log_probs.masked_fill(~beam_is_finished, -math.inf)
+        # candidate_log_probs : batch_size x num_candidates
+        candidate_log_probs = torch.concat([
+            flat_unfinished_candidate_log_probs,
+            finished_log_probs
+        ], dim=1)
+        # NOTE This implements length normalization.
+        candidate_scores = torch.concat([
+            flat_unfinished_candidate_log_probs / (t + 1),
+            finished_log_probs / (finished_lengths + 1)
+        ], dim=1)
+        # top_k_indexes : batch_size x k of ints in [0, num_candidates)
+        _, top_k_indexes = torch.topk(
+            candidate_scores,
+            k=k,
+            dim=1,
+            sorted=True
+        )
+        # All of the following are batch_size x k.
+        new_log_probs = torch.gather(candidate_log_probs, 1, top_k_indexes)
+        is_from_unfinished = top_k_indexes < num_unfinished_candidates
+        is_from_finished = ~is_from_unfinished
+        # Make sure any indexes that would be invalid for one kind of
+        # candidate are set to 0.
+        # masked_top_k_indexes : ints in [0, num_unfinished_candidates)
+        masked_top_k_indexes = top_k_indexes * is_from_unfinished
+        # finished_indexes : ints in [0, beam_width)
+        finished_indexes = (top_k_indexes - num_unfinished_candidates) * is_from_finished
+        # top_backpointers : ints in [0, beam_width)
+        top_backpointers = torch.div(masked_top_k_indexes, k, rounding_mode='floor')
+        # new_symbols : ints in [0, output_vocab_size)
+        new_symbols = torch.gather(
+            unfinished_candidate_symbols.view(batch_size, -1),
+            1,
+            masked_top_k_indexes
         )
-        for i in range(batch_size)
+        just_generated_eos = is_from_unfinished & (new_symbols == eos_symbol)
+        new_beam_is_finished = just_generated_eos | is_from_finished
+        # For beam items that were already finished, copy their lengths and
+        # positions from the previous timestep. For beam items that just
+        # finished, their length is t, and they end at their parent.
+        finished_lengths = torch.where(
+            is_from_finished,
+            torch.gather(finished_lengths, 1, finished_indexes),
+            torch.full_like(finished_indexes, t)
+        )
+        finished_positions = torch.where(
+            is_from_finished,
+            torch.gather(finished_positions, 1, finished_indexes),
+            top_backpointers
+        )
+        symbols.append(new_symbols)
+        backpointers.append(top_backpointers)
+        # A sentence is done if the top of its beam is finished.
+        # just_finished : batch_size of bool
+        just_finished = is_active & new_beam_is_finished[:, 0]
+        result_lengths = torch.where(just_finished, finished_lengths[:, 0], result_lengths)
+        result_positions = torch.where(just_finished, finished_positions[:, 0], result_positions)
+        is_active = is_active & ~just_finished
+        if t == max_length - 1:
+            # If we've reached the last timestep, just end with the best item
+            # of each remaining beam, which is at position 0.
+            result_lengths = result_lengths.masked_fill(is_active, max_length)
+            result_positions = result_positions.masked_fill(is_active, 0)
+            break
+        if not is_active.any().item():
+            break
+        # Keep a row in the state for every unfinished item of an active
+        # sentence.
+        # old_row_indexes : batch_size x beam_width of ints in [0, num_rows)
+        old_row_indexes = torch.zeros(
+            (batch_size, beam_width),
+            dtype=torch.long,
+            device=device
+        )
+        old_row_indexes[row_sentences, row_positions] = torch.arange(
+            row_sentences.size(0),
+            device=device
+        )
+        row_sentences, row_positions = torch.nonzero(
+            is_active[:, None] & ~new_beam_is_finished,
+            as_tuple=True
+        )
+        # rearranged_backpointers : new_num_rows of ints in [0, num_rows)
+        rearranged_backpointers = old_row_indexes[
+            row_sentences,
+            top_backpointers[row_sentences, row_positions]
+        ]
+        def rearrange(x):
+            # x : num_rows x ...
+            # return : new_num_rows x ...
+            return x[rearranged_backpointers, ...]
+        rearranged_states = beam_unfinished_states.transform_tensors(rearrange)
+        # rearranged_input_symbols : new_num_rows of ints in [0, output_vocab_size)
+        rearranged_input_symbols = new_symbols[row_sentences, row_positions]
+        beam_log_probs = new_log_probs
+        beam_is_finished = new_beam_is_finished
+        # beam_unfinished_states : State with batch size new_num_rows
+        beam_unfinished_states = rearranged_states.next(rearranged_input_symbols)
+    return follow_batched_backpointers(
+        backpointers,
+        symbols,
+        result_lengths,
+        result_positions
+    )
+
+def follow_batched_backpointers(backpointers, symbols, lengths, positions):
+    # backpointers, symbols : list of batch_size x k
+    # lengths, positions : batch_size
+    batch_size, = lengths.size()
+    max_length = len(symbols)
+    result = []
+    curr_positions = positions
+    for t in reversed(range(max_length)):
+        # Sentences whose outputs end at or before t start following their
+        # backpointers at timestep lengths - 1. Symbols past the end are
+        # discarded below.
+        curr_positions = torch.where(t < lengths - 1, curr_positions, positions)
+        result.append(torch.gather(symbols[t], 1, curr_positions[:, None]).squeeze(1))
+        curr_positions = torch.gather(backpointers[t], 1, curr_positions[:, None]).squeeze(1)
+    result.reverse()
+    # result_tensor : batch_size x max_length
+    result_tensor = torch.stack(result, dim=1)
+    return [
+        sequence[:length]
+        for sequence, length in zip(result_tensor.tolist(), lengths.tolist())
     ]
 
 def beam_search_single(initial_state, beam_size, eos_symbol, max_length, device):
@@ -42,10 +241,7 @@ def beam_search_single(initial_state, beam_size, eos_symbol, max_length, device)
         # TODO It should be possible to take the top k of the logits and only
         # compute log probs for the top k. But it's necessary to pass all the
         # logits to log_softmax() to get the denominators right.
-        output_log_probs = torch.nn.functional.log_softmax(
-            beam_unfinished_states.output(),
-            dim=1
-        )
+        output_log_probs = get_output_log_probs(beam_unfinished_states)
         output_vocab_size = output_log_probs.size(1)
         k = min(beam_size, output_vocab_size)
         # top_output_log_probs : old_unfinished_beam_size x k
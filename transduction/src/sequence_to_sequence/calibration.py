@@ -0,0 +1,361 @@
+import dataclasses
+import math
+import resource
+import statistics
+import sys
+import time
+from collections.abc import Callable
+from typing import Optional
+
+import humanfriendly
+import numpy
+import torch
+
+from utils.profile_torch import reset_memory_profiler, get_peak_memory
+from .batcher import get_batcher
+from .out_of_memory import is_out_of_memory_error
+from .precision import get_autocast_context
+
+CALIBRATION_METADATA_NAME = 'batching_calibration'
+MIN_PROBE_LENGTH = 4
+MAX_PROBE_BATCH_SIZE = 4096
+
+def add_calibration_arguments(group):
+    group.add_argument('--batching-calibrate', action='store_true', default=False,
+        help='Instead of using --batching-max-tokens, choose the maximum '
+             'batch cost by timing the model on synthetic batches of '
+             'different shapes and fitting a linear model of step time and '
+             'peak memory against the estimated cost of each batch. The '
+             'result is saved in the model directory and reused by later '
+             'runs with the same settings.')
+    group.add_argument('--batching-target-step-time', type=float,
+        help='When --batching-calibrate is used, the target time in seconds '
+             'of a single training step or decoding batch.')
+    group.add_argument('--batching-target-peak-memory', type=humanfriendly.parse_size,
+        help='When --batching-calibrate is used, the target peak memory of '
+             'a single training step or decoding batch, e.g. 8GB. This is '
+             'allocated CUDA memory on GPUs and peak resident set size on '
+             'CPUs.')
+    group.add_argument('--batching-calibration-repeats', type=int, default=3,
+        help='When --batching-calibrate is used, the number of times each '
+             'batch shape is timed. The median is used.')
+
+def check_calibration_arguments(parser, args):
+    if args.batching_calibrate:
+        if args.batching_target_step_time is None and args.batching_target_peak_memory is None:
+            parser.error(
+                '--batching-calibrate requires --batching-target-step-time '
+                'or --batching-target-peak-memory'
+            )
+    elif args.batching_max_tokens is None:
+        parser.error('either --batching-max-tokens or --batching-calibrate is required')
+
+@dataclasses.dataclass
+class CalibrationProbe:
+    batch_size: int
+    length: int
+    cost: float
+    step_time: float
+    peak_memory: Optional[int]
+    out_of_memory: bool
+
+def calibrate_training(parser, args, saver, model_interface, data, device, max_length, logger, run_update):
+    """Choose the maximum batch cost for training.
+
+    :param max_length: The maximum source or target length of the synthetic
+        batches.
+    :param run_update: A function that runs one training step on a batch of
+        pairs, including the optimizer update, so that the probes measure the
+        same work as training.
+    :return: The maximum batch cost, and a dict describing the calibration
+        that can be logged.
+    """
+    vocab_sizes = get_synthetic_vocab_sizes(data)
+
+    def run_step(batch_size, length):
+        run_update(get_synthetic_pairs(vocab_sizes, batch_size, length))
+
+    # The probes update the parameters, so restore them afterward. They are
+    # kept on the CPU so that they do not add to the measured memory.
+    parameters = {
+        name : value.detach().to('cpu', copy=True)
+        for name, value in saver.model.state_dict().items()
+    }
+    try:
+        return calibrate(
+            parser,
+            args,
+            saver,
+            model_interface,
+            device,
+            'train',
+            dict(),
+            run_step,
+            max_length,
+            logger
+        )
+    finally:
+        saver.model.load_state_dict(parameters)
+        saver.model.zero_grad(set_to_none=True)
+
+def calibrate_decoding(parser, args, saver, model_interface, vocabs, device, max_length, logger):
+    """Choose the maximum batch cost for beam search decoding.
+
+    :param max_length: The maximum source length of the synthetic batches.
+    :return: See :py:func:`calibrate_training`.
+    """
+    vocab_sizes = get_synthetic_vocab_sizes(vocabs)
+
+    def run_step(batch_size, length):
+        sources = [s for s, t in get_synthetic_pairs(vocab_sizes, batch_size, length)]
+        model_source = model_interface.prepare_source(sources, device, vocabs)
+        with get_autocast_context(args.precision, device):
+            model_interface.decode(
+                model=saver.model,
+                model_source=model_source,
+                bos_symbol=vocabs.target_input_vocab.bos_index,
+                beam_size=args.beam_size,
+                eos_symbol=vocabs.target_output_vocab.eos_index,
+                max_length=args.max_target_length
+            )
+
+    return calibrate(
+        parser,
+        args,
+        saver,
+        model_interface,
+        device,
+        'decode',
+        dict(
+            beam_size=args.beam_size,
+            max_target_length=args.max_target_length
+        ),
+        run_step,
+        max_length,
+        logger
+    )
+
+def calibrate(
+    parser,
+    args,
+    saver,
+    model_interface,
+    device,
+    mode,
+    settings,
+    run_step: Callable[[int, int], None],
+    max_length,
+    logger
+):
+    settings = dict(
+        settings,
+        mode=mode,
+        device=device.type,
+        cost_model=args.batching_cost_model,
+        bucket_width=args.batching_bucket_width,
+        target_step_time=args.batching_target_step_time,
+        target_peak_memory=args.batching_target_peak_memory,
+        precision=args.precision,
+        compile=args.compile
+    )
+    key = f'{mode}-{device.type}'
+    saved_calibrations = read_saved_calibrations(saver)
+    saved = saved_calibrations.get(key)
+    if saved is not None and saved['settings'] == settings:
+        logger.info(f'using saved batching calibration: max cost {saved["max_cost"]}')
+        return saved['max_cost'], saved
+    logger.info('calibrating batch size')
+    # The placeholder maximum cost is not used; the batcher is only used to
+    # estimate the cost of each probe.
+    batcher = get_batcher(parser, args, model_interface, saver.kwargs, max_cost=1)
+    probes = []
+    # Do not let the probes affect the random state used for training.
+    with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+        for length in get_probe_lengths(max_length):
+            batch_size = 1
+            while batch_size <= MAX_PROBE_BATCH_SIZE:
+                probe = run_probe(
+                    run_step,
+                    batch_size,
+                    length,
+                    # Each probe uses the same length for the source and the
+                    # target, which is also how source-only batches are
+                    # costed.
+                    batcher.estimate_cost(
+                        batch_size,
+                        model_interface.adjust_source_length(length),
+                        model_interface.adjust_target_length(length)
+                    ),
+                    device,
+                    args.batching_calibration_repeats
+                )
+                probes.append(probe)
+                logger.info(
+                    f'  batch size {batch_size}, length {length}: '
+                    + (
+                        'out of memory' if probe.out_of_memory else
+                        f'{probe.step_time:.4f}s, '
+                        f'{humanfriendly.format_size(probe.peak_memory) if probe.peak_memory is not None else "unknown memory"}'
+                    )
+                )
+                if probe.out_of_memory or exceeds_targets(probe, args):
+                    break
+                batch_size *= 2
+    successful_probes = [p for p in probes if not p.out_of_memory]
+    if not successful_probes:
+        raise ValueError('no batch fit in memory during batch size calibration')
+    costs = [p.cost for p in successful_probes]
+    step_time_coefficients = fit_line(costs, [p.step_time for p in successful_probes])
+    if all(p.peak_memory is not None for p in successful_probes):
+        peak_memory_coefficients = fit_line(costs, [p.peak_memory for p in successful_probes])
+    else:
+        peak_memory_coefficients = None
+    max_costs = []
+    if args.batching_target_step_time is not None:
+        max_costs.append(solve_line(step_time_coefficients, args.batching_target_step_time))
+    if args.batching_target_peak_memory is not None:
+        if peak_memory_coefficients is None:
+            raise ValueError('peak memory cannot be measured on this device')
+        max_costs.append(solve_line(peak_memory_coefficients, args.batching_target_peak_memory))
+    # Never pick a cost that was measured to run out of memory.
+    for p in probes:
+        if p.out_of_memory:
+            max_costs.append(p.cost - 1)
+    max_cost = min(max_costs)
+    if max_cost == math.inf:
+        # The measurements did not grow with the cost, so they do not bound
+        # it. Fall back to the largest cost that was measured.
+        max_cost = max(costs)
+    max_cost = max(1, math.floor(max_cost))
+    logger.info(f'calibrated max cost: {max_cost}')
+    result = dict(
+        settings=settings,
+        max_cost=max_cost,
+        step_time_coefficients=step_time_coefficients,
+        peak_memory_coefficients=peak_memory_coefficients,
+        probes=[dataclasses.asdict(p) for p in probes]
+    )
+    saved_calibrations[key] = result
+    saver.save_metadata(saved_calibrations, name=CALIBRATION_METADATA_NAME)
+    return max_cost, result
+
+def read_saved_calibrations(saver):
+    try:
+        return dict(saver.metadata([], name=CALIBRATION_METADATA_NAME))
+    except (FileNotFoundError, KeyError, AttributeError):
+        # There is no saved calibration, or, without an output directory,
+        # nowhere to save one.
+        return {}
+
+def get_probe_lengths(max_length):
+    max_length = max(1, max_length)
+    length = min(MIN_PROBE_LENGTH, max_length)
+    while length < max_length:
+        yield length
+        length *= 2
+    yield max_length
+
+def run_probe(run_step, batch_size, length, cost, device, repeats):
+    try:
+        # Warm up, so that one-time allocations are not timed.
+        run_step(batch_size, length)
+        step_times = []
+        peak_memories = []
+        for _ in range(repeats):
+            reset_peak_memory(device)
+            synchronize(device)
+            start_time = time.perf_counter()
+            run_step(batch_size, length)
+            synchronize(device)
+            step_times.append(time.perf_counter() - start_time)
+            peak_memories.append(read_peak_memory(device))
+    except Exception as e:
+        # Running out of CUDA or CPU memory is recorded as a failed probe.
+        if not is_out_of_memory_error(e):
+            raise
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        return CalibrationProbe(batch_size, length, cost, math.inf, None, True)
+    return CalibrationProbe(
+        batch_size,
+        length,
+        cost,
+        statistics.median(step_times),
+        max(peak_memories) if None not in peak_memories else None,
+        False
+    )
+
+def exceeds_targets(probe, args):
+    return (
+        (
+            args.batching_target_step_time is not None and
+            probe.step_time > args.batching_target_step_time
+        ) or
+        (
+            args.batching_target_peak_memory is not None and
+            probe.peak_memory is not None and
+            probe.peak_memory > args.batching_target_peak_memory
+        )
+    )
+
+def fit_line(x, y):
+    """Fit ``y = a + b * x`` by least squares and return ``[a, b]``."""
+    x = numpy.array(x, dtype=numpy.float64)
+    y = numpy.array(y, dtype=numpy.float64)
+    if len(set(x.tolist())) < 2:
+        # A line through the origin is the only thing that can be fitted.
+        return [0.0, float(numpy.mean(y / x))]
+    A = numpy.stack([numpy.ones_like(x), x], axis=1)
+    (a, b), *_ = numpy.linalg.lstsq(A, y, rcond=None)
+    return [float(a), float(b)]
+
+def solve_line(coefficients, target):
+    a, b = coefficients
+    if b <= 0:
+        return math.inf
+    return (target - a) / b
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        reset_memory_profiler(device)
+    elif sys.platform.startswith('linux'):
+        # Writing 5 to clear_refs resets the peak resident set size.
+        try:
+            with open('/proc/self/clear_refs', 'w') as fout:
+                fout.write('5')
+        except OSError:
+            pass
+
+def read_peak_memory(device):
+    if device.type == 'cuda':
+        return get_peak_memory(device)
+    elif sys.platform.startswith('linux'):
+        try:
+            with open('/proc/self/status') as fin:
+                for line in fin:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        # ru_maxrss is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    else:
+        return None
+
+def get_synthetic_vocab_sizes(vocabs):
+    # Target tokens are used as both decoder inputs and outputs, so they must
+    # be valid in both vocabularies.
+    return (
+        len(vocabs.source_vocab),
+        min(len(vocabs.target_input_vocab), len(vocabs.target_output_vocab))
+    )
+
+def get_synthetic_pairs(vocab_sizes, batch_size, length):
+    source_vocab_size, target_vocab_size = vocab_sizes
+    sources = torch.randint(source_vocab_size, (batch_size, length))
+    targets = torch.randint(target_vocab_size, (batch_size, length))
+    return list(zip(sources, targets))
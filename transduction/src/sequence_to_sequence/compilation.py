@@ -0,0 +1,107 @@
+import time
+from collections.abc import Callable
+from typing import Any
+
+import torch
+
+from transformer_model.decoder import TransformerDecoderLayers
+from .out_of_memory import is_out_of_memory_error
+
+def add_compile_arguments(group):
+    group.add_argument('--compile', action='store_true', default=False,
+        help='Compile the encoder, the decoder, and the per-step update of '
+             'the decoder used in beam search with torch.compile. The first '
+             'batches are slower while they are compiled. If torch.compile '
+             'is not available, or compilation fails, the model runs '
+             'eagerly instead.')
+    group.add_argument('--compile-length-multiple', type=int, default=8,
+        help='When --compile is used, pad the source and target lengths of '
+             'every batch up to a multiple of this, so that batches of '
+             'similar lengths share the same compiled code instead of '
+             'causing recompilation.')
+
+def check_compile_arguments(parser, args):
+    if args.compile and args.compile_length_multiple < 1:
+        parser.error('--compile-length-multiple must be at least 1')
+
+def is_compile_available() -> bool:
+    return hasattr(torch, 'compile')
+
+class CompiledFunction:
+    """Calls a function compiled with :py:func:`torch.compile`, and falls
+    back to calling the original function eagerly, for good, if compilation
+    fails."""
+
+    def __init__(self, name: str, function: Callable[..., Any], logger):
+        self.name = name
+        self.function = function
+        self.compiled_function = torch.compile(function)
+        self.logger = logger
+        self.is_compiled = False
+        self.failed = False
+
+    def __call__(self, *args, **kwargs):
+        if self.failed:
+            return self.function(*args, **kwargs)
+        start_time = time.perf_counter()
+        try:
+            result = self.compiled_function(*args, **kwargs)
+        except Exception as e:
+            # Running out of memory is not a problem with compilation, and
+            # it is handled elsewhere.
+            if is_out_of_memory_error(e):
+                raise
+            self.failed = True
+            self.logger.info(
+                f'compiling {self.name} failed, so it will run eagerly: '
+                f'{type(e).__name__}: {e}'
+            )
+            return self.function(*args, **kwargs)
+        if not self.is_compiled:
+            # The first call includes the time spent compiling. Calls with new
+            # shapes may be recompiled later.
+            self.is_compiled = True
+            duration = time.perf_counter() - start_time
+            self.logger.info(f'compiled {self.name} in {duration:.2f}s')
+        return result
+
+def compile_method(obj: Any, name: str, description: str, logger) -> None:
+    """Replace a method of an object with a compiled version, in place.
+
+    For a module's ``forward`` method, this means that calling the module
+    runs the compiled code, while its parameters and state dict are
+    unaffected.
+    """
+    setattr(obj, name, CompiledFunction(description, getattr(obj, name), logger))
+
+def compile_model(model_interface, saver, length_multiple, logger) -> bool:
+    """Compile the encoder, the decoder up to its output layer, and the
+    per-step update of the decoder's transformer layers in place.
+
+    Since a new shape usually means recompiling, the padded lengths of all
+    batches prepared by ``model_interface`` afterwards are rounded up to a
+    multiple of ``length_multiple``. Extra source positions are masked like
+    any other padding, and extra target positions are ignored by the loss.
+    The batch size and the length of the decoder's cache still vary, so they
+    are left to torch.compile's support for dynamic shapes.
+
+    :return: Whether the model was compiled. If torch.compile is not
+        available, the model is left as is.
+    """
+    if not is_compile_available():
+        logger.info(
+            f'torch.compile is not available in PyTorch {torch.__version__}, '
+            'so the model will run eagerly'
+        )
+        return False
+    model_interface.length_multiple = length_multiple
+    model = saver.model
+    compile_method(model, 'frozen_encoder', 'encoder', logger)
+    # The output layer is left out, because during training it is only
+    # applied to the hidden states of non-padding positions, whose number
+    # changes with every batch.
+    compile_method(model, 'frozen_decoder_without_output', 'decoder', logger)
+    for module in model.decoder.modules():
+        if isinstance(module, TransformerDecoderLayers):
+            compile_method(module, '_forward_step', 'decoder step', logger)
+    return True
@@ -0,0 +1,35 @@
+import argparse
+import pathlib
+import sys
+
+import torch
+
+from sequence_to_sequence.prepared_data import (
+    is_prepared_data_file,
+    write_prepared_data_file
+)
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=
+        'Convert .prepared files written with torch.save() by older versions '
+        'of prepare_data_shared.py to the memory-mapped format, in place.'
+    )
+    parser.add_argument('files', type=pathlib.Path, nargs='+')
+    args = parser.parse_args()
+
+    for path in args.files:
+        if is_prepared_data_file(path):
+            print(f'skipping {path}, which is already converted', file=sys.stderr)
+            continue
+        print(f'converting {path}', file=sys.stderr)
+        data = torch.load(path)
+        # Write to a temporary file first so the original is never left
+        # half-overwritten.
+        temp_path = path.with_name(path.name + '.tmp')
+        write_prepared_data_file(temp_path, data)
+        temp_path.replace(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+import math
+import os
+
+import torch
+
+def add_data_parallel_arguments(group):
+    group.add_argument('--data-parallel-workers', type=int, default=1,
+        help='Train with this many processes on the CPU, each with its own '
+             'copy of the model. The batches of each epoch are divided among '
+             'the processes, and gradients are averaged over the sequences of '
+             'all processes with the gloo backend of torch.distributed '
+             'before every parameter update. '
+             'Evaluation, saving, and logging are done by the first process.')
+
+class SingleProcess:
+    """The default when data parallelism is not used. All of its operations
+    do nothing."""
+
+    rank = 0
+    world_size = 1
+    is_main = True
+
+    def shard(self, batches):
+        return batches
+
+    def get_loss_denominator(self, batch_size):
+        return batch_size
+
+    def reduce_gradients(self, model, loss_numer, num_symbols, batch_size):
+        return loss_numer, num_symbols, batch_size
+
+    def broadcast_object(self, obj):
+        return obj
+
+    def reduce_min(self, value):
+        return value
+
+    def broadcast_parameters(self, model):
+        pass
+
+class DataParallel:
+    """Coordinates data-parallel training across processes that have joined
+    a :py:mod:`torch.distributed` process group."""
+
+    def __init__(self, rank, world_size):
+        super().__init__()
+        self.rank = rank
+        self.world_size = world_size
+        self.is_main = rank == 0
+
+    def shard(self, batches):
+        """Get the batches that this process should train on.
+
+        Every process must pass the same list of batches. Each process gets
+        the same number of steps; if the number of batches is not divisible
+        by the number of processes, some processes get ``None`` for their
+        last step, which they must still pass to
+        :py:meth:`reduce_gradients`.
+        """
+        num_steps = math.ceil(len(batches) / self.world_size)
+        shard = batches[self.rank::self.world_size]
+        return shard + [None] * (num_steps - len(shard))
+
+    def get_loss_denominator(self, batch_size):
+        """Get the number that the loss of a batch of a certain size should
+        be divided by before backpropagation.
+
+        Each process backpropagates the sum of its sequence losses, and
+        :py:meth:`reduce_gradients` divides the summed gradients by the
+        number of sequences in all processes, so that every sequence has the
+        same weight no matter how the sequences are divided into batches.
+        """
+        return 1
+
+    def reduce_gradients(self, model, loss_numer, num_symbols, batch_size):
+        """Sum the gradients and the statistics of the batches of all
+        processes, and divide the gradients by the total number of sequences.
+
+        :return: The loss numerator, number of symbols, and batch size summed
+            over all processes.
+        """
+        parameters = [p for p in model.parameters() if p.requires_grad]
+        # Reduce all of the gradients with a single all-reduce over one flat
+        # buffer.
+        gradients = torch.cat([
+            (p.grad if p.grad is not None else torch.zeros_like(p)).flatten()
+            for p in parameters
+        ])
+        statistics = torch.tensor(
+            [loss_numer, num_symbols, batch_size],
+            dtype=torch.float64
+        )
+        torch.distributed.all_reduce(gradients)
+        torch.distributed.all_reduce(statistics)
+        loss_numer, num_symbols, batch_size = statistics.tolist()
+        # Each process's gradient is of the sum of its sequence losses, so
+        # this is the gradient of the mean loss over all sequences.
+        if batch_size > 0:
+            gradients /= batch_size
+        offset = 0
+        for p in parameters:
+            size = p.numel()
+            p.grad = gradients[offset:offset+size].view_as(p)
+            offset += size
+        return loss_numer, round(num_symbols), round(batch_size)
+
+    def broadcast_object(self, obj):
+        """Send a picklable object from the first process to all the
+        others."""
+        objects = [obj]
+        torch.distributed.broadcast_object_list(objects, src=0)
+        return objects[0]
+
+    def reduce_min(self, value):
+        """Get the minimum of a number over all processes."""
+        tensor = torch.tensor([value], dtype=torch.float64)
+        torch.distributed.all_reduce(tensor, op=torch.distributed.ReduceOp.MIN)
+        return type(value)(tensor.item())
+
+    def broadcast_parameters(self, model):
+        """Make every process start from the first process's parameters."""
+        with torch.no_grad():
+            for p in model.parameters():
+                torch.distributed.broadcast(p, src=0)
+
+def init_data_parallel(rank, world_size, init_method):
+    torch.distributed.init_process_group(
+        'gloo',
+        init_method=init_method,
+        rank=rank,
+        world_size=world_size
+    )
+    # Divide the cores among the processes.
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    return DataParallel(rank, world_size)
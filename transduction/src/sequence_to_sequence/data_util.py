@@ -6,6 +6,10 @@ import torch
 
 from vocab2 import ToStringVocabulary, ToStringVocabularyBuilder
 from sequence_to_sequence.vocabulary import load_shared_vocabularies
+from sequence_to_sequence.prepared_data import (
+    is_prepared_data_file,
+    read_prepared_data_file
+)
 
 @dataclasses.dataclass
 class VocabularyContainer:
@@ -78,4 +82,10 @@ def load_prepared_data_files(source_path, target_path):
     ))
 
 def load_prepared_data_file(path):
-    return [torch.tensor(x) for x in torch.load(path)]
+    if is_prepared_data_file(path):
+        return read_prepared_data_file(path).sequences()
+    else:
+        # This is the format written by older versions of
+        # prepare_data_utils.prepare_file(). Such files can be converted with
+        # convert_prepared_data.py.
+        return [torch.tensor(x) for x in torch.load(path)]
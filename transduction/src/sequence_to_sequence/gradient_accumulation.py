@@ -0,0 +1,60 @@
+import dataclasses
+from collections.abc import Iterable
+from typing import Any
+
+def add_gradient_accumulation_arguments(group):
+    group.add_argument('--gradient-accumulation-tokens', type=int,
+        help='Accumulate the gradients of consecutive batches until they '
+             'contain at least this many target tokens, and only then '
+             'update the parameters. The loss is averaged over all of the '
+             'sequences in the accumulated batches, so this is equivalent '
+             'to training on one larger batch, but uses only as much memory '
+             'as the largest of the smaller batches. When '
+             '--data-parallel-workers is used, the budget applies to each '
+             'process. By default, the parameters are updated after every '
+             'batch.')
+
+@dataclasses.dataclass
+class AccumulatedBatch:
+    """Several batches whose gradients are accumulated into one parameter
+    update."""
+
+    batches: list[Any]
+
+    def __len__(self) -> int:
+        return sum(len(batch) for batch in self.batches)
+
+    def __iter__(self):
+        return (pair for batch in self.batches for pair in batch)
+
+def get_micro_batches(batch) -> list[Any]:
+    """Get the batches that are run through the model separately to compute
+    the gradient of a parameter update."""
+    if isinstance(batch, AccumulatedBatch):
+        return batch.batches
+    else:
+        return [batch]
+
+def get_num_target_tokens(batch) -> int:
+    return sum(len(t) for s, t in batch)
+
+def group_batches_by_target_tokens(
+    batches: Iterable[Any],
+    max_tokens: int
+) -> list[AccumulatedBatch]:
+    """Group consecutive batches, in order, into accumulated batches that
+    each contain at least a certain number of target tokens. The last group
+    may contain fewer."""
+    result = []
+    group = []
+    num_tokens = 0
+    for batch in batches:
+        group.append(batch)
+        num_tokens += get_num_target_tokens(batch)
+        if num_tokens >= max_tokens:
+            result.append(AccumulatedBatch(group))
+            group = []
+            num_tokens = 0
+    if group:
+        result.append(AccumulatedBatch(group))
+    return result
@@ -10,18 +10,35 @@ from torch_extras.init import smart_init, uniform_fallback
 from torch_extras.compose import Composable
 from torch_unidirectional import SimpleLayerUnidirectional, OutputUnidirectional
 from transformer_model.positional_encodings import SinusoidalPositionalEncodingCacher
+from transformer_model.mask import CausalAttentionMaskCacher
 from transformer_model.input_layer import get_transformer_input_unidirectional
 from transformer_model.encoder_decoder import get_shared_embeddings
 from transformer_model.encoder import get_transformer_encoder, TransformerEncoderLayers
 from transformer_model.decoder import get_transformer_decoder, TransformerDecoderLayers
+from rnn_model.encoder import RNNEncoderLayers
+from rnn_model.decoder import RNNDecoderLayers
 from .beam_search import beam_search
 
 class SequenceToSequenceModelInterface(ModelInterface):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The padded length of every batch is rounded up to a multiple of
+        # this. See compilation.compile_model().
+        self.length_multiple = 1
+
     def add_more_init_arguments(self, group):
-        group.add_argument('--encoder-layers')
+        group.add_argument('--encoder-layers',
+            help='The layers of the encoder, as a list of stacks separated '
+                 'by periods. A stack is either a number of transformer '
+                 'layers, such as 6, or an RNN type and number of layers, '
+                 'such as lstm:2 or gru:1. RNN stacks in the encoder are '
+                 'bidirectional.')
         group.add_argument('--use-standard-encoder', action='store_true', default=False)
-        group.add_argument('--decoder-layers')
+        group.add_argument('--decoder-layers',
+            help='The layers of the decoder, in the same format as '
+                 '--encoder-layers. RNN stacks in the decoder attend to the '
+                 'encoder output after their last layer.')
         group.add_argument('--use-standard-decoder', action='store_true', default=False)
         group.add_argument('--d-model', type=int)
         group.add_argument('--num-heads', type=int)
@@ -69,12 +86,16 @@ class SequenceToSequenceModelInterface(ModelInterface):
             raise ValueError
         if decoder_layers is None:
             raise ValueError
+        encoder_layers = list(parse_layers(encoder_layers))
+        decoder_layers = list(parse_layers(decoder_layers))
         if d_model is None:
             raise ValueError
-        if num_heads is None:
-            raise ValueError
-        if feedforward_size is None:
-            raise ValueError
+        # Only transformer layers need these.
+        if any(layer_type == 'transformer' for layer_type, _ in encoder_layers + decoder_layers):
+            if num_heads is None:
+                raise ValueError
+            if feedforward_size is None:
+                raise ValueError
         if dropout is None:
             raise ValueError
         return get_encoder_decoder(
@@ -82,9 +103,9 @@ class SequenceToSequenceModelInterface(ModelInterface):
             target_input_vocabulary_size=target_input_vocab_size,
             target_output_vocabulary_size=target_output_vocab_size,
             tie_embeddings=tie_embeddings,
-            encoder_layers=list(parse_layers(encoder_layers)),
+            encoder_layers=encoder_layers,
             use_standard_encoder=use_standard_encoder,
-            decoder_layers=list(parse_layers(decoder_layers)),
+            decoder_layers=decoder_layers,
             use_standard_decoder=use_standard_decoder,
             d_model=d_model,
             num_heads=num_heads,
@@ -109,19 +130,20 @@ class SequenceToSequenceModelInterface(ModelInterface):
 
     def prepare_batch(self, batch, device, data):
         model_source = self.prepare_source([s for s, t in batch], device, data)
+        # Flatten the targets once and build both the target input and output
+        # from the same buffer.
+        targets = FlatSequences.from_sequences([t for s, t in batch], device)
         target_input_pad = len(data.target_input_vocab)
-        target_input = pad_sequences(
-            [t for s, t in batch],
-            device,
+        target_input, _ = targets.pad(
             bos=data.target_input_vocab.bos_index,
-            pad=target_input_pad
+            pad=target_input_pad,
+            length_multiple=self.length_multiple
         )
         target_output_pad = len(data.target_output_vocab)
-        target_output = pad_sequences(
-            [t for s, t in batch],
-            device,
+        target_output, _ = targets.pad(
             eos=data.target_output_vocab.eos_index,
-            pad=target_output_pad
+            pad=target_output_pad,
+            length_multiple=self.length_multiple
         )
         model_input = ModelSourceAndTarget(
             source=model_source.source,
@@ -132,15 +154,17 @@ class SequenceToSequenceModelInterface(ModelInterface):
 
     def prepare_source(self, sources, device, data):
         source_pad = len(data.source_vocab)
-        source = pad_sequences(
+        source, source_is_padding_mask = FlatSequences.from_sequences(
             sources,
-            device,
+            device
+        ).pad(
             eos=data.source_vocab.eos_index,
-            pad=source_pad
+            pad=source_pad,
+            length_multiple=self.length_multiple
         )
         return ModelSource(
             source=source,
-            source_is_padding_mask=(source == source_pad)
+            source_is_padding_mask=source_is_padding_mask
         )
 
     def on_before_process_pairs(self, saver, datasets):
@@ -167,10 +191,18 @@ class SequenceToSequenceModelInterface(ModelInterface):
 
     def _preallocate_positional_encodings(self, saver, max_length):
         d_model = saver.kwargs['d_model']
+        # Leave room for lengths that are rounded up.
+        max_length = round_up(max_length, self.length_multiple)
+        # The causal attention masks have the same dtype as the inputs to the
+        # decoder layers, which is that of the parameters.
+        parameter = next(saver.model.parameters())
         for module in saver.model.modules():
             if isinstance(module, SinusoidalPositionalEncodingCacher):
                 module.get_encodings(max_length, d_model)
                 module.set_allow_reallocation(False)
+            elif isinstance(module, CausalAttentionMaskCacher):
+                module.get_mask(max_length, parameter.device, parameter.dtype)
+                module.set_allow_reallocation(False)
 
     def get_logits(self, model, model_input):
         # Note that it is unnecessary to pass a padding mask for the target
@@ -183,6 +215,27 @@ class SequenceToSequenceModelInterface(ModelInterface):
             decoder_kwargs=self.get_decoder_kwargs(model_input)
         )
 
+    def get_logits_at(self, model, model_input, is_output_position):
+        r"""Like :py:meth:`get_logits`, but only compute logits at certain
+        target positions, so that the output layer is not applied to
+        padding.
+
+        :param is_output_position: A :math:`B \times m` boolean tensor that
+            is true at the positions where logits should be computed.
+        :return: A :math:`N \times V` tensor of logits, where :math:`N` is
+            the number of true elements in ``is_output_position``, in
+            row-major order.
+        """
+        hidden_states = model.get_decoder_hidden_states(
+            source_sequence=model_input.source,
+            target_sequence=model_input.target,
+            encoder_kwargs=self.get_encoder_kwargs(model_input),
+            decoder_kwargs=self.get_decoder_kwargs(model_input)
+        )
+        # hidden_states : B x m x d_model
+        # return : N x V
+        return model.get_output_logits(hidden_states[is_output_position])
+
     def decode(self, model, model_source, bos_symbol, beam_size, eos_symbol, max_length):
         model.eval()
         with torch.no_grad():
@@ -202,17 +255,32 @@ class SequenceToSequenceModelInterface(ModelInterface):
             return beam_search(decoder_state, beam_size, eos_symbol, max_length, device)
 
     def get_encoder_kwargs(self, model_source):
-        return dict(tag_kwargs=dict(
-            transformer=dict(
-                is_padding_mask=model_source.source_is_padding_mask
-            )
+        if isinstance(model_source, PackedModelSourceAndTarget):
+            return dict(tag_kwargs=dict(
+                **get_layer_tag_kwargs(
+                    segment_ids=model_source.source_segment_ids
+                ),
+                # The input layer of the encoder is wrapped in a Composable,
+                # so its tag_kwargs need to be passed explicitly.
+                input=dict(tag_kwargs=dict(
+                    position=dict(positions=model_source.source_positions)
+                ))
+            ))
+        return dict(tag_kwargs=get_layer_tag_kwargs(
+            is_padding_mask=model_source.source_is_padding_mask
         ))
 
     def get_decoder_kwargs(self, model_source):
-        return dict(tag_kwargs=dict(
-            transformer=dict(
-                encoder_is_padding_mask=model_source.source_is_padding_mask
-            )
+        if isinstance(model_source, PackedModelSourceAndTarget):
+            return dict(tag_kwargs=dict(
+                **get_layer_tag_kwargs(
+                    input_segment_ids=model_source.target_segment_ids,
+                    encoder_segment_ids=model_source.source_segment_ids
+                ),
+                position=dict(positions=model_source.target_positions)
+            ))
+        return dict(tag_kwargs=get_layer_tag_kwargs(
+            encoder_is_padding_mask=model_source.source_is_padding_mask
         ))
 
 @dataclasses.dataclass
@@ -224,36 +292,139 @@ class ModelSource:
 class ModelSourceAndTarget(ModelSource):
     target: torch.Tensor
 
+@dataclasses.dataclass
+class PackedModelSourceAndTarget(ModelSourceAndTarget):
+    """Model input where each row contains several source/target pairs
+    packed one after another."""
+
+    source_segment_ids: torch.Tensor
+    r"""A :math:`B \times n` tensor giving the index within its row of the
+    pair that each source position belongs to, or -1 for padding."""
+    source_positions: torch.Tensor
+    r"""A :math:`B \times n` tensor giving the position of each source
+    token within its own sequence."""
+    target_segment_ids: torch.Tensor
+    r"""Like :py:attr:`source_segment_ids`, but for the target."""
+    target_positions: torch.Tensor
+    r"""Like :py:attr:`source_positions`, but for the target."""
+    target_example_ids: torch.Tensor
+    r"""A :math:`B \times m` tensor giving the index within the batch of
+    the pair that each target position belongs to, or 0 for padding."""
+
+@dataclasses.dataclass
+class FlatSequences:
+    """A batch of variable-length sequences stored as a single flat tensor of
+    tokens, which can be padded without looping over the sequences in
+    Python."""
+
+    tokens: torch.Tensor
+    r"""A 1D tensor containing the tokens of all sequences, concatenated."""
+    lengths: torch.Tensor
+    r"""A 1D :py:class:`torch.long` tensor of size :math:`B` containing the
+    length of each sequence."""
+
+    @staticmethod
+    def from_sequences(sequences, device):
+        """Concatenate a list of sequences into a flat buffer and move it to
+        a device.
+
+        :param sequences: A list of 1D tensors or lists of ints.
+        :param device: The device to move the tokens to.
+        """
+        lengths = torch.tensor([len(x) for x in sequences], dtype=torch.long)
+        if sequences and all(isinstance(x, torch.Tensor) for x in sequences):
+            # This is a single copy. The tokens keep their (possibly compact)
+            # dtype until they are on the device.
+            tokens = torch.cat(sequences)
+        else:
+            tokens = torch.tensor(
+                [x for sequence in sequences for x in sequence],
+                dtype=torch.long
+            )
+        return FlatSequences(
+            tokens=tokens.to(device, non_blocking=True),
+            lengths=lengths.to(device, non_blocking=True)
+        )
+
+    def pad(self, pad, bos=None, eos=None, length_multiple=1):
+        r"""Create a padded tensor of token indexes, optionally with BOS and
+        EOS added, along with its padding mask.
+
+        :param pad: Index used for padding.
+        :param bos: Optional index to prepend to every sequence.
+        :param eos: Optional index to append to every sequence.
+        :param length_multiple: Add extra padding to round the length
+            :math:`n` up to a multiple of this.
+        :return: A :math:`B \times n` :py:class:`torch.long` tensor and a
+            :math:`B \times n` boolean tensor that is true at padding
+            positions.
+        """
+        lengths = self.lengths
+        batch_size = lengths.size(0)
+        max_length = int(lengths.max()) if batch_size > 0 else 0
+        bos_offset = int(bos is not None)
+        eos_offset = int(eos is not None)
+        sequence_length = round_up(bos_offset + max_length + eos_offset, length_multiple)
+        device = self.tokens.device
+        positions = torch.arange(sequence_length, device=device)
+        # is_token : B x n
+        is_token = (
+            (positions >= bos_offset) &
+            (positions < (lengths + bos_offset)[:, None])
+        )
+        result = torch.full(
+            (batch_size, sequence_length),
+            pad,
+            dtype=torch.long,
+            device=device
+        )
+        # Boolean indexing visits positions in row-major order, which is the
+        # order of the tokens in the flat buffer.
+        result[is_token] = self.tokens.long()
+        if bos is not None:
+            result[:, 0] = bos
+        if eos is not None:
+            result[torch.arange(batch_size, device=device), lengths + bos_offset] = eos
+        is_padding = positions >= (lengths + (bos_offset + eos_offset))[:, None]
+        return result, is_padding
+
 def pad_sequences(sequences, device, pad, bos=None, eos=None):
-    batch_size = len(sequences)
-    max_length = max(map(len, sequences))
-    add_bos = bos is not None
-    bos_offset = int(add_bos)
-    add_eos = eos is not None
-    sequence_length = bos_offset + max_length + int(add_eos)
-    result = torch.full(
-        (batch_size, sequence_length),
-        pad,
-        dtype=torch.long,
-        device=device
-    )
-    if add_bos:
-        result[:, 0] = bos
-    for i, sequence in enumerate(sequences):
-        result[i, bos_offset:bos_offset+len(sequence)] = sequence
-        if add_eos:
-            result[i, bos_offset+len(sequence)] = eos
+    result, _ = FlatSequences.from_sequences(sequences, device).pad(pad, bos, eos)
     return result
 
-LAYER_RE = re.compile(r'^(\d+)$')
+def round_up(n, multiple):
+    return -(-n // multiple) * multiple
+
+LAYER_RE = re.compile(r'^(?:(lstm|gru):)?(\d+)$')
+
+LAYER_TYPES = ('transformer', 'lstm', 'gru')
 
 def parse_layers(s):
     for part in s.split('.'):
         m = LAYER_RE.match(part)
         if m is None:
             raise ValueError(f'layer type not recognized: {part!r}')
-        trans_num_layers, = m.groups()
-        yield 'transformer', (int(trans_num_layers),)
+        rnn_type, num_layers = m.groups()
+        if rnn_type is None:
+            yield 'transformer', (int(num_layers),)
+        else:
+            yield rnn_type, (int(num_layers),)
+
+def has_only_transformer_layers(model_kwargs):
+    return all(
+        layer_type == 'transformer'
+        for key in ('encoder_layers', 'decoder_layers')
+        for layer_type, _ in parse_layers(model_kwargs[key])
+    )
+
+def get_layer_tag_kwargs(**kwargs):
+    # Every type of layer receives the same kwargs through its tag. Each gets
+    # its own copy, since the encoder output is added to the decoder's later.
+    return {layer_type: dict(kwargs) for layer_type in LAYER_TYPES}
+
+def set_encoder_sequence(decoder_kwargs, encoder_sequence):
+    for layer_type in LAYER_TYPES:
+        decoder_kwargs['tag_kwargs'][layer_type]['encoder_sequence'] = encoder_sequence
 
 def get_encoder_decoder(
     source_vocabulary_size,
@@ -281,6 +452,7 @@ def get_encoder_decoder(
         use_target_padding
     )
     positional_encoding_cacher = SinusoidalPositionalEncodingCacher()
+    causal_mask_cacher = CausalAttentionMaskCacher()
     return EncoderDecoder(
         get_encoder(
             vocabulary_size=source_vocabulary_size,
@@ -299,6 +471,7 @@ def get_encoder_decoder(
             output_vocabulary_size=target_output_vocabulary_size,
             shared_embeddings=shared_embeddings,
             positional_encoding_cacher=positional_encoding_cacher,
+            causal_mask_cacher=causal_mask_cacher,
             layers=decoder_layers,
             use_standard_decoder=use_standard_decoder,
             d_model=d_model,
@@ -371,7 +544,7 @@ def get_encoder_layer_modules(
             shared_embeddings=shared_embeddings,
             positional_encoding_cacher=positional_encoding_cacher
         )
-    ).kwargs(include_first=False)
+    ).kwargs(include_first=False).tag('input')
     for module in get_encoder_middle_layer_modules(
         layers,
         d_model,
@@ -403,6 +576,14 @@ def get_encoder_middle_layer_modules(
                 use_final_layer_norm=False,
                 enable_nested_tensor=use_padding
             )).tag(layer_type)
+        elif layer_type in ('lstm', 'gru'):
+            num_layers, = layer_args
+            yield Composable(RNNEncoderLayers(
+                rnn_type=layer_type,
+                num_layers=num_layers,
+                d_model=d_model,
+                dropout=dropout
+            )).tag(layer_type)
         else:
             raise ValueError
 
@@ -411,6 +592,7 @@ def get_decoder(
     output_vocabulary_size,
     shared_embeddings,
     positional_encoding_cacher,
+    causal_mask_cacher,
     layers,
     use_standard_decoder,
     d_model,
@@ -435,13 +617,15 @@ def get_decoder(
             feedforward_size,
             dropout,
             use_padding,
-            tag='transformer'
+            tag='transformer',
+            causal_mask_cacher=causal_mask_cacher
         )
     layers = get_decoder_layer_modules(
         input_vocabulary_size,
         output_vocabulary_size,
         shared_embeddings,
         positional_encoding_cacher,
+        causal_mask_cacher,
         layers,
         d_model,
         num_heads,
@@ -456,6 +640,7 @@ def get_decoder_layer_modules(
     output_vocabulary_size,
     shared_embeddings,
     positional_encoding_cacher,
+    causal_mask_cacher,
     layers,
     d_model,
     num_heads,
@@ -476,7 +661,8 @@ def get_decoder_layer_modules(
         d_model,
         num_heads,
         feedforward_size,
-        dropout
+        dropout,
+        causal_mask_cacher
     ):
         yield module
     yield SimpleLayerUnidirectional(torch.nn.LayerNorm(d_model))
@@ -491,7 +677,8 @@ def get_decoder_middle_layer_modules(
     d_model,
     num_heads,
     feedforward_size,
-    dropout
+    dropout,
+    causal_mask_cacher
 ):
     for layer_type, layer_args in layers:
         if layer_type == 'transformer':
@@ -502,7 +689,16 @@ def get_decoder_middle_layer_modules(
                 num_heads=num_heads,
                 feedforward_size=feedforward_size,
                 dropout=dropout,
-                use_final_layer_norm=False
+                use_final_layer_norm=False,
+                causal_mask_cacher=causal_mask_cacher
+            ).tag(layer_type)
+        elif layer_type in ('lstm', 'gru'):
+            num_layers, = layer_args
+            yield RNNDecoderLayers(
+                rnn_type=layer_type,
+                num_layers=num_layers,
+                d_model=d_model,
+                dropout=dropout
             ).tag(layer_type)
         else:
             raise ValueError
@@ -513,6 +709,18 @@ class EncoderDecoder(torch.nn.Module):
         super().__init__()
         self.encoder = encoder
         self.decoder = decoder
+        self.freeze()
+
+    def freeze(self):
+        """Flatten the compositions of modules that make up the encoder and
+        decoder, which are used in their place from then on. This is called
+        when the model is constructed, and only needs to be called again if
+        the structure of the encoder or decoder changes."""
+        self.frozen_encoder = self.encoder.freeze()
+        self.frozen_decoder = self.decoder.freeze()
+        # The decoder is composed from left to right, so its last module is
+        # the output layer.
+        self.frozen_decoder_without_output = self.decoder.first.freeze()
 
     def forward(self,
         source_sequence,
@@ -520,24 +728,44 @@ class EncoderDecoder(torch.nn.Module):
         encoder_kwargs,
         decoder_kwargs
     ):
-        encoder_outputs = self.encoder(
+        return self.get_output_logits(self.get_decoder_hidden_states(
+            source_sequence,
+            target_sequence,
+            encoder_kwargs,
+            decoder_kwargs
+        ))
+
+    def get_decoder_hidden_states(self,
+        source_sequence,
+        target_sequence,
+        encoder_kwargs,
+        decoder_kwargs
+    ):
+        """Like :py:meth:`forward`, but return the inputs to the output layer
+        of the decoder instead of the logits."""
+        encoder_outputs = self.frozen_encoder(
             source_sequence,
             **encoder_kwargs
         )
-        decoder_kwargs['tag_kwargs']['transformer']['encoder_sequence'] = encoder_outputs
-        return self.decoder(
+        set_encoder_sequence(decoder_kwargs, encoder_outputs)
+        return self.frozen_decoder_without_output(
             target_sequence,
             **decoder_kwargs,
             include_first=False
         )
 
+    def get_output_logits(self, hidden_states):
+        """Apply the output layer of the decoder to any tensor of hidden
+        states."""
+        return self.decoder.second.forward_sequence(hidden_states)
+
     def initial_decoder_state(self, source_sequence, encoder_kwargs, decoder_kwargs):
-        encoder_outputs = self.encoder(
+        encoder_outputs = self.frozen_encoder(
             source_sequence,
             **encoder_kwargs
         )
-        decoder_kwargs['tag_kwargs']['transformer']['encoder_sequence'] = encoder_outputs
-        return self.decoder.initial_state(
+        set_encoder_sequence(decoder_kwargs, encoder_outputs)
+        return self.frozen_decoder.initial_state(
             batch_size=encoder_outputs.size(0),
             **decoder_kwargs
         )
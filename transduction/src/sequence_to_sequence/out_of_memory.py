@@ -0,0 +1,131 @@
+import dataclasses
+import math
+from collections.abc import Callable
+from typing import Any
+
+import torch
+
+from .gradient_accumulation import get_micro_batches
+from .packing import PackedBatch
+
+# When a batch runs out of memory, the maximum cost of later batches is set
+# to this fraction of its estimated cost.
+MAX_COST_BACKOFF = 0.9
+
+def add_out_of_memory_arguments(group):
+    group.add_argument('--no-out-of-memory-recovery', action='store_true', default=False,
+        help='Do not recover from running out of memory during a parameter '
+             'update. By default, a batch that runs out of memory is split '
+             'in half and the gradients of the halves are accumulated, '
+             'which gives the same update, and the maximum cost of the '
+             'batches of later epochs is lowered to '
+             f'{MAX_COST_BACKOFF} times the estimated cost of the batch. '
+             'Training only stops if a single example runs out of memory.')
+
+@dataclasses.dataclass
+class OutOfMemorySplit:
+    """Describes a batch that ran out of memory and was split."""
+
+    batch_size: int
+    """The number of rows in the batch."""
+    source_length: int
+    """The length of the longest source row, including EOS."""
+    target_length: int
+    """The length of the longest target row, including BOS or EOS."""
+
+def is_out_of_memory_error(e: BaseException) -> bool:
+    # Errors may be wrapped, so check their causes as well.
+    while e is not None:
+        if isinstance(e, (torch.cuda.OutOfMemoryError, MemoryError)):
+            return True
+        if isinstance(e, RuntimeError) and 'DefaultCPUAllocator' in str(e):
+            return True
+        e = e.__cause__
+    return False
+
+def split_batch(batch) -> list[Any]:
+    """Split a batch of training pairs into two halves, or return ``None``
+    if it has only one example."""
+    if isinstance(batch, PackedBatch):
+        if len(batch.rows) > 1:
+            middle = len(batch.rows) // 2
+            return [PackedBatch(batch.rows[:middle]), PackedBatch(batch.rows[middle:])]
+        row, = batch.rows
+        if len(row) > 1:
+            middle = len(row) // 2
+            return [PackedBatch([row[:middle]]), PackedBatch([row[middle:]])]
+        return None
+    # Prepared batches are split into lists of pairs, which are padded again
+    # to the lengths of their own examples.
+    pairs = list(batch)
+    if len(pairs) > 1:
+        middle = len(pairs) // 2
+        return [pairs[:middle], pairs[middle:]]
+    return None
+
+def get_batch_dimensions(batch, model_interface) -> OutOfMemorySplit:
+    if isinstance(batch, PackedBatch):
+        row_lengths = [
+            (
+                sum(model_interface.adjust_source_length(len(s)) for s, t in row),
+                sum(model_interface.adjust_target_length(len(t)) for s, t in row)
+            )
+            for row in batch.rows
+        ]
+        return OutOfMemorySplit(
+            len(batch.rows),
+            max(s for s, t in row_lengths),
+            max(t for s, t in row_lengths)
+        )
+    return OutOfMemorySplit(
+        len(batch),
+        max(model_interface.adjust_source_length(len(s)) for s, t in batch),
+        max(model_interface.adjust_target_length(len(t)) for s, t in batch)
+    )
+
+def run_with_out_of_memory_recovery(
+    batch,
+    zero_grad: Callable[[], None],
+    run_micro_batch: Callable[[Any], Any],
+    model_interface,
+    enabled: bool
+) -> tuple[list[Any], list[OutOfMemorySplit]]:
+    """Compute the gradient of a batch one micro-batch at a time. If a
+    micro-batch runs out of memory, split it in half, and start over.
+
+    :param batch: A batch, which may be an
+        :py:class:`~sequence_to_sequence.gradient_accumulation.AccumulatedBatch`.
+    :param zero_grad: Called before every attempt.
+    :param run_micro_batch: Adds the gradient of a micro-batch to the
+        parameters' gradients and returns statistics about it.
+    :param enabled: If false, errors are raised immediately.
+    :return: The results of ``run_micro_batch`` for the micro-batches of the
+        last attempt, and the micro-batches that were split.
+    """
+    micro_batches = list(get_micro_batches(batch))
+    splits = []
+    while True:
+        zero_grad()
+        results = []
+        failed_micro_batch_no = None
+        for micro_batch_no, micro_batch in enumerate(micro_batches):
+            try:
+                results.append(run_micro_batch(micro_batch))
+            except Exception as e:
+                if not (enabled and is_out_of_memory_error(e) and len(micro_batch) > 1):
+                    raise
+                failed_micro_batch_no = micro_batch_no
+                break
+        if failed_micro_batch_no is None:
+            return results, splits
+        # The tensors of the failed attempt have been released by now.
+        del results
+        torch.cuda.empty_cache()
+        micro_batch = micro_batches[failed_micro_batch_no]
+        splits.append(get_batch_dimensions(micro_batch, model_interface))
+        micro_batches[failed_micro_batch_no:failed_micro_batch_no+1] = split_batch(micro_batch)
+
+def get_reduced_max_cost(batcher, split: OutOfMemorySplit):
+    """Get the maximum batch cost to use after a batch ran out of memory."""
+    cost = batcher.estimate_cost(split.batch_size, split.source_length, split.target_length)
+    return min(batcher.max_cost, math.floor(cost * MAX_COST_BACKOFF))
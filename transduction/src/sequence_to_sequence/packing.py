@@ -0,0 +1,151 @@
+import dataclasses
+from collections.abc import Iterable
+
+import torch
+
+from .batching import get_pair_sort_key
+from .model_util import FlatSequences, PackedModelSourceAndTarget
+
+@dataclasses.dataclass
+class PackedBatch:
+    """A batch of training pairs grouped into rows, where the pairs in each
+    row are concatenated so that little padding is needed."""
+
+    rows: list[list[tuple[torch.Tensor, torch.Tensor]]]
+
+    def __len__(self) -> int:
+        return sum(len(row) for row in self.rows)
+
+    def __iter__(self):
+        return (pair for row in self.rows for pair in row)
+
+def generate_packed_batches(
+    pairs: list[tuple[torch.Tensor, torch.Tensor]],
+    batcher,
+    row_length: int
+) -> Iterable[PackedBatch]:
+    """Pack pairs into rows, and group rows into batches.
+
+    Pairs are sorted by length, so that pairs of similar length are packed
+    together, and then added to rows in order until a row is full. Rows are
+    then grouped greedily into batches whose cost, according to ``batcher``,
+    does not exceed its maximum cost.
+
+    :param pairs: The pairs to pack. This list is sorted in place.
+    :param batcher: The batcher used to estimate the cost of a batch of rows.
+    :param row_length: The maximum length of a row, for both the source and
+        target side, including EOS and BOS.
+    """
+    model_interface = batcher.model_interface
+    pairs.sort(key=get_pair_sort_key)
+    rows = []
+    row = []
+    row_source_length = 0
+    row_target_length = 0
+    for pair in pairs:
+        source_length = model_interface.adjust_source_length(len(pair[0]))
+        target_length = model_interface.adjust_target_length(len(pair[1]))
+        if row and (
+            row_source_length + source_length > row_length or
+            row_target_length + target_length > row_length
+        ):
+            rows.append((row, row_source_length, row_target_length))
+            row = []
+            row_source_length = 0
+            row_target_length = 0
+        row.append(pair)
+        row_source_length += source_length
+        row_target_length += target_length
+    if row:
+        rows.append((row, row_source_length, row_target_length))
+    batch = []
+    max_source_length = 0
+    max_target_length = 0
+    for row, row_source_length, row_target_length in rows:
+        new_max_source_length = max(max_source_length, row_source_length)
+        new_max_target_length = max(max_target_length, row_target_length)
+        # The row lengths already include EOS and BOS, so the cost is
+        # estimated directly rather than with is_small_enough.
+        if batch and batcher.estimate_cost(
+            len(batch) + 1,
+            new_max_source_length,
+            new_max_target_length
+        ) > batcher.max_cost:
+            yield PackedBatch(batch)
+            batch = []
+            new_max_source_length = row_source_length
+            new_max_target_length = row_target_length
+        batch.append(row)
+        max_source_length = new_max_source_length
+        max_target_length = new_max_target_length
+    if batch:
+        yield PackedBatch(batch)
+
+def prepare_packed_batch(batch, device, data):
+    """Build the padded tensors for a :py:class:`PackedBatch`.
+
+    :return: A :py:class:`PackedModelSourceAndTarget` and the correct target
+        output, in the same format as
+        :py:meth:`SequenceToSequenceModelInterface.prepare_batch`.
+    """
+    pairs = list(batch)
+    source_lengths = torch.tensor([len(s) + 1 for s, t in pairs])
+    target_lengths = torch.tensor([len(t) + 1 for s, t in pairs])
+    row_sizes = torch.tensor([len(row) for row in batch.rows])
+    eos = torch.tensor([data.source_vocab.eos_index])
+    bos = torch.tensor([data.target_input_vocab.bos_index])
+    target_eos = torch.tensor([data.target_output_vocab.eos_index])
+    source_tokens = torch.cat([x for s, t in pairs for x in (torch.as_tensor(s), eos)])
+    target_input_tokens = torch.cat([x for s, t in pairs for x in (bos, torch.as_tensor(t))])
+    target_output_tokens = torch.cat([x for s, t in pairs for x in (torch.as_tensor(t), target_eos)])
+    example_ids = torch.arange(len(pairs))
+    # The index of each pair within its row.
+    row_starts = torch.cumsum(row_sizes, dim=0) - row_sizes
+    segment_ids = example_ids - torch.repeat_interleave(row_starts, row_sizes)
+    row_indexes = torch.repeat_interleave(torch.arange(len(batch.rows)), row_sizes)
+
+    def get_row_lengths(lengths):
+        return torch.zeros(len(batch.rows), dtype=torch.long).index_add_(0, row_indexes, lengths)
+
+    def pad_rows(tokens, row_lengths, pad):
+        return FlatSequences(
+            tokens=tokens.to(device, non_blocking=True),
+            lengths=row_lengths.to(device, non_blocking=True)
+        ).pad(pad)
+
+    def get_token_info(lengths):
+        # For every token, the index of its pair in the batch, the index of
+        # its pair in the row, and its position within the pair.
+        token_example_ids = torch.repeat_interleave(example_ids, lengths)
+        token_segment_ids = torch.repeat_interleave(segment_ids, lengths)
+        starts = torch.cumsum(lengths, dim=0) - lengths
+        token_positions = (
+            torch.arange(int(lengths.sum())) -
+            torch.repeat_interleave(starts, lengths)
+        )
+        return token_example_ids, token_segment_ids, token_positions
+
+    source_row_lengths = get_row_lengths(source_lengths)
+    target_row_lengths = get_row_lengths(target_lengths)
+    source_pad = len(data.source_vocab)
+    source, source_is_padding_mask = pad_rows(source_tokens, source_row_lengths, source_pad)
+    _, source_segment_ids, source_positions = get_token_info(source_lengths)
+    source_segment_ids, _ = pad_rows(source_segment_ids, source_row_lengths, -1)
+    source_positions, _ = pad_rows(source_positions, source_row_lengths, 0)
+    target_input, _ = pad_rows(target_input_tokens, target_row_lengths, len(data.target_input_vocab))
+    target_output, _ = pad_rows(target_output_tokens, target_row_lengths, len(data.target_output_vocab))
+    target_example_ids, target_segment_ids, target_positions = get_token_info(target_lengths)
+    target_example_ids, _ = pad_rows(target_example_ids, target_row_lengths, 0)
+    target_segment_ids, _ = pad_rows(target_segment_ids, target_row_lengths, -1)
+    target_positions, _ = pad_rows(target_positions, target_row_lengths, 0)
+    model_input = PackedModelSourceAndTarget(
+        source=source,
+        source_is_padding_mask=source_is_padding_mask,
+        target=target_input,
+        source_segment_ids=source_segment_ids,
+        source_positions=source_positions,
+        target_segment_ids=target_segment_ids,
+        target_positions=target_positions,
+        target_example_ids=target_example_ids
+    )
+    return model_input, target_output
@@ -0,0 +1,21 @@
+import contextlib
+
+import torch
+
+def add_precision_arguments(group):
+    group.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32',
+        help='The precision of forward passes. fp32 runs everything in '
+             'float32. bf16 runs matrix multiplications in bfloat16 with '
+             'autocast, which is much faster on CPUs with AMX or '
+             'AVX512-BF16, while the parameters, gradients, optimizer state, '
+             'and loss stay in float32.')
+
+def get_autocast_context(precision, device):
+    """Get a context manager in which forward passes run at a precision
+    given by ``--precision``."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    elif precision == 'bf16':
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    else:
+        raise ValueError(f'unknown precision: {precision!r}')
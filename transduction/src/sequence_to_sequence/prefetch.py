@@ -0,0 +1,95 @@
+import queue
+import threading
+import time
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any
+
+class BatchPrefetcher:
+    """Runs a function on a sequence of batches in a background thread, up to
+    a fixed number of batches ahead of the consumer.
+
+    The results are yielded in the same order as the input batches, so using
+    a prefetcher does not change the order of training.
+    """
+
+    def __init__(self,
+        batches: Iterable[Any],
+        prepare: Callable[[Any], Any],
+        depth: int
+    ):
+        """
+        :param batches: The batches to prepare.
+        :param prepare: The function applied to each batch.
+        :param depth: The maximum number of prepared batches that can be
+            waiting to be consumed.
+        """
+        super().__init__()
+        if depth < 1:
+            raise ValueError(f'prefetch depth must be at least 1, got {depth}')
+        self.depth = depth
+        self.stall_time = 0.0
+        """The total time, in seconds, that the consumer has spent waiting
+        for a batch to be prepared."""
+        self.total_queue_size = 0
+        self.num_gets = 0
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(iter(batches), prepare),
+            daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, batches, prepare):
+        try:
+            for batch in batches:
+                result = (True, prepare(batch))
+                if not self._put(result):
+                    return
+        except BaseException as e:
+            self._put((False, e))
+            return
+        self._put((False, None))
+
+    def _put(self, item):
+        # Block until there is room in the queue, but give up if the consumer
+        # has stopped.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            self.total_queue_size += self._queue.qsize()
+            self.num_gets += 1
+            start_time = time.perf_counter()
+            is_batch, value = self._queue.get()
+            self.stall_time += time.perf_counter() - start_time
+            if is_batch:
+                yield value
+            elif value is None:
+                return
+            else:
+                raise value
+
+    def mean_queue_size(self) -> float:
+        """The average number of prepared batches that were already waiting
+        each time the consumer asked for one."""
+        return self.total_queue_size / self.num_gets if self.num_gets else 0.0
+
+    def close(self) -> None:
+        """Stop the background thread, even if not all batches have been
+        consumed."""
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,6 +1,6 @@
 import sys
 
-import torch
+from sequence_to_sequence.prepared_data import write_prepared_data_file
 
 def add_args(parser):
     parser.add_argument('--unk-string', default='<unk>')
@@ -36,4 +36,4 @@ def prepare_file(vocab, pair):
                 data.append([vocab.to_int(token) for token in line.split()])
             except KeyError as e:
                 raise ValueError(f'{input_path}:{line_no}: in line {line.rstrip()!r}: invalid token: {e}')
-    torch.save(data, output_path)
+    write_prepared_data_file(output_path, data)
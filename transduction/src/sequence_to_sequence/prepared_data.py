@@ -0,0 +1,141 @@
+import json
+import pathlib
+import struct
+from collections.abc import Iterable, Sequence
+
+import numpy
+import torch
+
+# A prepared data file stores a list of sequences of token indexes. It has the
+# following layout:
+# 1. the 8-byte magic string MAGIC
+# 2. the size of the header in bytes, as a little-endian unsigned 64-bit int
+# 3. the header, which is UTF-8-encoded JSON padded with spaces so that the
+#    following arrays are aligned to ALIGNMENT bytes
+# 4. the offsets array, which contains num_sequences + 1 little-endian
+#    signed 64-bit ints; sequence i consists of the tokens from offsets[i] up
+#    to but not including offsets[i+1]
+# 5. the flat token array, which contains num_tokens ints of type
+#    token_dtype
+# Both arrays can be memory-mapped directly, so loading a file does not
+# require unpickling or copying any tokens.
+MAGIC = b'S2SPREP1'
+ALIGNMENT = 64
+OFFSET_DTYPE = numpy.dtype('<i8')
+
+def get_token_dtype(max_token: int) -> numpy.dtype:
+    """Get the smallest integer type that can represent the token indexes
+    ``0`` to ``max_token`` and can be converted to a PyTorch tensor."""
+    # NOTE PyTorch does not support unsigned integer types other than uint8,
+    # so use signed types for larger vocabularies.
+    for dtype in (numpy.dtype('|u1'), numpy.dtype('<i2'), numpy.dtype('<i4')):
+        if max_token <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.dtype('<i8')
+
+def write_prepared_data_file(
+    path: pathlib.Path,
+    sequences: Iterable[Sequence[int]]
+) -> None:
+    """Write a list of sequences of token indexes to a prepared data file.
+
+    :param path: Output file path.
+    :param sequences: The sequences to write.
+    """
+    lengths = []
+    tokens = []
+    for sequence in sequences:
+        lengths.append(len(sequence))
+        tokens.extend(sequence)
+    offsets = numpy.zeros((len(lengths) + 1,), dtype=OFFSET_DTYPE)
+    numpy.cumsum(lengths, out=offsets[1:])
+    token_dtype = get_token_dtype(max(tokens, default=0))
+    header = json.dumps(dict(
+        token_dtype=token_dtype.str,
+        num_sequences=len(lengths),
+        num_tokens=len(tokens)
+    )).encode('utf-8')
+    data_start = len(MAGIC) + 8 + len(header)
+    header += b' ' * (-data_start % ALIGNMENT)
+    with path.open('wb') as fout:
+        fout.write(MAGIC)
+        fout.write(struct.pack('<Q', len(header)))
+        fout.write(header)
+        fout.write(offsets.tobytes())
+        fout.write(numpy.array(tokens, dtype=token_dtype).tobytes())
+
+def is_prepared_data_file(path: pathlib.Path) -> bool:
+    """Check whether a file is in the prepared data format, as opposed to the
+    legacy format written by :py:func:`torch.save`."""
+    with path.open('rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+class PreparedData:
+    """The contents of a prepared data file, consisting of a flat tensor of
+    tokens and the offsets of each sequence in it."""
+
+    def __init__(self, tokens: torch.Tensor, offsets: torch.Tensor):
+        """
+        :param tokens: A 1D integer tensor containing the tokens of all
+            sequences, concatenated.
+        :param offsets: A 1D int64 tensor with one more element than the
+            number of sequences, containing the start of each sequence in
+            ``tokens`` followed by the total number of tokens.
+        """
+        super().__init__()
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return self.offsets.size(0) - 1
+
+    def lengths(self) -> torch.Tensor:
+        return self.offsets[1:] - self.offsets[:-1]
+
+    def sequences(self) -> list[torch.Tensor]:
+        """Get a list of all the sequences. Each sequence is a view of the
+        flat token tensor, so no tokens are copied."""
+        offsets = self.offsets.tolist()
+        tokens = self.tokens
+        return [
+            tokens[start:end]
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+
+def read_prepared_data_file(path: pathlib.Path) -> PreparedData:
+    """Memory-map a file written by :py:func:`write_prepared_data_file`.
+
+    :param path: Path to the file.
+    """
+    with path.open('rb') as fin:
+        magic = fin.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a prepared data file')
+        header_size, = struct.unpack('<Q', fin.read(8))
+        header = json.loads(fin.read(header_size).decode('utf-8'))
+    token_dtype = numpy.dtype(header['token_dtype'])
+    num_sequences = header['num_sequences']
+    num_tokens = header['num_tokens']
+    offsets_start = len(MAGIC) + 8 + header_size
+    tokens_start = offsets_start + (num_sequences + 1) * OFFSET_DTYPE.itemsize
+    # Use copy-on-write mode so that the arrays are writable as far as PyTorch
+    # is concerned, but the file is never modified.
+    offsets = numpy.memmap(
+        path,
+        dtype=OFFSET_DTYPE,
+        mode='c',
+        offset=offsets_start,
+        shape=(num_sequences + 1,)
+    )
+    if num_tokens > 0:
+        tokens = numpy.memmap(
+            path,
+            dtype=token_dtype,
+            mode='c',
+            offset=tokens_start,
+            shape=(num_tokens,)
+        )
+    else:
+        # numpy.memmap does not allow mapping empty arrays.
+        tokens = numpy.empty((0,), dtype=token_dtype)
+    return PreparedData(torch.from_numpy(tokens), torch.from_numpy(offsets))
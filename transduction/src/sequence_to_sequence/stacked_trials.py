@@ -0,0 +1,88 @@
+import pathlib
+
+import torch
+
+try:
+    from torch.func import functional_call, vmap
+    # This version of functional_call replaces all of the names of a shared
+    # parameter when it is given any one of them, and it rejects more than
+    # one.
+    _FUNCTIONAL_CALL_TIES_WEIGHTS = True
+except ImportError:
+    # PyTorch 1.13 has torch.func's functionality in the bundled functorch
+    # package. Its functional_call only replaces the names it is given.
+    from functorch import vmap
+    from torch.nn.utils.stateless import functional_call
+    _FUNCTIONAL_CALL_TIES_WEIGHTS = False
+
+def add_stacked_trials_arguments(group):
+    group.add_argument('--stacked-trials', type=int, default=1,
+        help='Train this many models with the same architecture but '
+             'different parameter seeds at the same time, by stacking their '
+             'parameters and running them as one batched model. All trials '
+             'are trained on the same batches. Trial i (counting from 1) is '
+             'saved in the subdirectory i of --output, with the same layout '
+             'as a separate run. If --parameter-seed is given, trial i uses '
+             'the parameter seed --parameter-seed + i - 1.')
+
+def get_trial_output(output, trial_no):
+    """Get the output directory of a trial, counting from 0."""
+    if output is None:
+        return None
+    return pathlib.Path(output) / str(trial_no + 1)
+
+def get_trial_parameter_seed(parameter_seed, trial_no):
+    if parameter_seed is None:
+        return None
+    return parameter_seed + trial_no
+
+def get_stacked_logits_at(models, model_interface, model_input, is_output_position):
+    r"""Like :py:meth:`SequenceToSequenceModelInterface.get_logits_at`, but
+    run several models with the same architecture on the same batch at once.
+
+    The parameters of the models are stacked and the first model is run with
+    :py:func:`vmap`, so each layer is run once for all the models. Gradients
+    flow back to the parameters of each model, so each model can still have
+    its own optimizer. Each model gets different dropout masks.
+
+    :param models: A list of :math:`K` models with the same architecture.
+    :return: A :math:`K \times N \times V` tensor of logits.
+    """
+    template = _LogitsAt(models[0], model_interface)
+    parameters = _stack_parameters(models, prefix='model.')
+
+    def get_logits_at(parameters):
+        return functional_call(template, parameters, (model_input, is_output_position))
+
+    return vmap(get_logits_at, randomness='different')(parameters)
+
+def _stack_parameters(models, prefix=''):
+    # Map the names of the parameters of the first model to the stacked
+    # parameters of all the models. Parameters that are shared by several
+    # modules, such as tied embeddings, are stacked only once.
+    stacked = {}
+    result = {}
+    for named_parameters in zip(*(_get_all_named_parameters(m) for m in models)):
+        name, first_parameter = named_parameters[0]
+        key = id(first_parameter)
+        if key not in stacked:
+            stacked[key] = torch.stack([p for _, p in named_parameters])
+        elif _FUNCTIONAL_CALL_TIES_WEIGHTS:
+            continue
+        result[prefix + name] = stacked[key]
+    return result
+
+def _get_all_named_parameters(model):
+    for module_name, module in model.named_modules(remove_duplicate=False):
+        for name, parameter in module.named_parameters(recurse=False):
+            yield (f'{module_name}.{name}' if module_name else name), parameter
+
+class _LogitsAt(torch.nn.Module):
+
+    def __init__(self, model, model_interface):
+        super().__init__()
+        self.model = model
+        self.model_interface = model_interface
+
+    def forward(self, model_input, is_output_position):
+        return self.model_interface.get_logits_at(self.model, model_input, is_output_position)
@@ -1,21 +1,71 @@
 import argparse
+import contextlib
+import copy
 import logging
+import os
+import pathlib
+import random
 import sys
+import tempfile
 
 import humanize
+import torch
 
+from lib.pytorch_tools.saver import can_start_training_over, read_saver, read_training_state
 from utils.profile_torch import get_current_memory
+from sequence_to_sequence.data_parallel import SingleProcess, init_data_parallel
 from sequence_to_sequence.data_util import add_data_arguments, load_prepared_data
 from sequence_to_sequence.model_util import SequenceToSequenceModelInterface
-from sequence_to_sequence.train_util import add_train_arguments, train
+from sequence_to_sequence.stacked_trials import get_trial_output, get_trial_parameter_seed
+from sequence_to_sequence.train_util import add_train_arguments, train_trials
 
 def main():
 
-    logger = logging.getLogger('main')
-    logger.addHandler(logging.StreamHandler(sys.stdout))
-    logger.setLevel(logging.INFO)
+    logger = get_logger(sys.stdout)
     logger.info(f'arguments: {sys.argv}')
+    model_interface, parser, args = parse_arguments(sys.argv[1:])
+    logger.info(f'parsed arguments: {args}')
+
+    if args.data_parallel_workers > 1:
+        if model_interface.get_device(args).type != 'cpu':
+            parser.error('--data-parallel-workers can only be used on the CPU')
+        if args.batching_calibrate:
+            parser.error('--batching-calibrate cannot be used with --data-parallel-workers')
+        # Every process must initialize the parameters and shuffle the data
+        # in the same way, so choose the random seeds here.
+        argv = sys.argv[1:]
+        if args.parameter_seed is None:
+            argv += ['--parameter-seed', str(random.getrandbits(32))]
+        if args.random_shuffling_seed is None:
+            argv += ['--random-shuffling-seed', str(random.getrandbits(32))]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            init_method = (pathlib.Path(temp_dir) / 'init').as_uri()
+            torch.multiprocessing.spawn(
+                run_data_parallel_worker,
+                args=(argv, args.data_parallel_workers, init_method),
+                nprocs=args.data_parallel_workers
+            )
+    else:
+        run(parser, args, model_interface, logger, SingleProcess())
+
+def run_data_parallel_worker(rank, argv, world_size, init_method):
+    parallel = init_data_parallel(rank, world_size, init_method)
+    # Only the first process prints output, writes to the model directory, and
+    # logs events.
+    logger = get_logger(sys.stdout if parallel.is_main else None)
+    model_interface, parser, args = parse_arguments(argv)
+    if not parallel.is_main:
+        args.output = None
+    run(parser, args, model_interface, logger, parallel)
+
+def get_logger(stream):
+    logger = logging.getLogger('main')
+    if stream is not None:
+        logger.addHandler(logging.StreamHandler(stream))
+    logger.setLevel(logging.INFO if stream is not None else logging.WARNING)
+    return logger
 
+def parse_arguments(argv):
     model_interface = SequenceToSequenceModelInterface(
         use_load=True,
         use_init=True,
@@ -31,8 +81,10 @@ def main():
     model_interface.add_arguments(parser)
     model_interface.add_forward_arguments(parser)
     add_train_arguments(parser)
-    args = parser.parse_args()
-    logger.info(f'parsed arguments: {args}')
+    args = parser.parse_args(argv)
+    return model_interface, parser, args
+
+def run(parser, args, model_interface, logger, parallel):
 
     device = model_interface.get_device(args)
     logger.info(f'device: {device}')
@@ -40,38 +92,111 @@ def main():
 
     data = load_prepared_data(args, parser)
 
-    if do_profile_memory:
-        memory_before = get_current_memory(device)
-    saver = model_interface.construct_saver(
-        args,
-        source_vocab_size=len(data.source_vocab),
-        target_input_vocab_size=len(data.target_input_vocab),
-        target_output_vocab_size=len(data.target_output_vocab),
-        tie_embeddings=data.vocab_is_shared
-    )
-    if model_interface.parameter_seed is not None:
-        logger.info(f'parameter random seed: {model_interface.parameter_seed}')
-    num_parameters = sum(p.numel() for p in saver.model.parameters())
-    logger.info(f'number of parameters: {num_parameters}')
-    if do_profile_memory:
-        model_size_in_bytes = get_current_memory(device) - memory_before
-        logger.info(f'model size: {humanize.naturalsize(model_size_in_bytes)}')
-    else:
-        model_size_in_bytes = None
-
-    with saver.logger() as events:
-        events.log('model_info', dict(
-            size_in_bytes=model_size_in_bytes,
-            num_parameters=num_parameters
-        ))
-        train(
+    savers = []
+    model_sizes_in_bytes = []
+    numbers_of_parameters = []
+    training_states = []
+    restarted_outputs = []
+    for trial_no in range(args.stacked_trials):
+        if args.stacked_trials > 1:
+            logger.info(f'trial {trial_no + 1}')
+            trial_args = copy.copy(args)
+            trial_args.output = get_trial_output(args.output, trial_no)
+            trial_args.parameter_seed = get_trial_parameter_seed(args.parameter_seed, trial_no)
+        else:
+            trial_args = args
+        if args.resume and trial_args.output is not None:
+            training_state = read_training_state(trial_args.output, device)
+            # A run with --resume that was interrupted before it saved a
+            # training state leaves behind a directory without one, so start
+            # over in it. Any other existing directory is left alone.
+            is_restarted_output = (
+                training_state is None and
+                os.path.exists(trial_args.output) and
+                can_start_training_over(trial_args.output)
+            )
+        else:
+            training_state = None
+            is_restarted_output = False
+        if do_profile_memory:
+            memory_before = get_current_memory(device)
+        if training_state is not None:
+            logger.info(f'resuming training in {trial_args.output}')
+            # The parameters are loaded from the training state.
+            saver = read_saver(
+                model_interface.construct_model,
+                trial_args.output,
+                parameter_file=None,
+                device=device
+            )
+            saver.model.to(device)
+        else:
+            if is_restarted_output:
+                logger.info(f'no training state in {trial_args.output}; starting over')
+            saver = model_interface.construct_saver(
+                trial_args,
+                source_vocab_size=len(data.source_vocab),
+                target_input_vocab_size=len(data.target_input_vocab),
+                target_output_vocab_size=len(data.target_output_vocab),
+                tie_embeddings=data.vocab_is_shared,
+                allow_existing_output=is_restarted_output
+            )
+            if args.resume:
+                saver.mark_training_state_pending()
+            if model_interface.parameter_seed is not None:
+                logger.info(f'parameter random seed: {model_interface.parameter_seed}')
+        num_parameters = sum(p.numel() for p in saver.model.parameters())
+        logger.info(f'number of parameters: {num_parameters}')
+        if do_profile_memory:
+            model_size_in_bytes = get_current_memory(device) - memory_before
+            logger.info(f'model size: {humanize.naturalsize(model_size_in_bytes)}')
+        else:
+            model_size_in_bytes = None
+        savers.append(saver)
+        model_sizes_in_bytes.append(model_size_in_bytes)
+        numbers_of_parameters.append(num_parameters)
+        training_states.append(training_state)
+        restarted_outputs.append(is_restarted_output)
+
+    is_resuming = training_states[0] is not None
+    if any((s is not None) != is_resuming for s in training_states):
+        parser.error(
+            'some of the stacked trials in --output have a saved training '
+            'state and some do not'
+        )
+
+    with contextlib.ExitStack() as stack:
+        trials = []
+        for saver, model_size_in_bytes, num_parameters, training_state, is_restarted_output in zip(
+            savers,
+            model_sizes_in_bytes,
+            numbers_of_parameters,
+            training_states,
+            restarted_outputs
+        ):
+            if training_state is not None:
+                # Continue the log from the last checkpoint.
+                events = stack.enter_context(saver.logger(
+                    resume_position=training_state['log_position']
+                ))
+            else:
+                # Overwrite the log of an interrupted run that is being
+                # started over.
+                events = stack.enter_context(saver.logger(overwrite=is_restarted_output))
+                events.log('model_info', dict(
+                    size_in_bytes=model_size_in_bytes,
+                    num_parameters=num_parameters
+                ))
+            trials.append((saver, events))
+        train_trials(
             parser,
             args,
-            saver,
+            trials,
             data,
             model_interface,
-            events,
-            logger
+            logger,
+            parallel,
+            training_states if is_resuming else None
         )
 
 if __name__ == '__main__':
@@ -1,15 +1,51 @@
+import contextlib
+import copy
 import dataclasses
 import datetime
+import functools
 import random
+import time
+from typing import Any, Optional
 
 import humanfriendly
 import torch
 
+from lib.pytorch_tools.saver import AsyncParameterWriter
 from lib.ticker import TimedTicker
 from utils.profile_torch import reset_memory_profiler, get_peak_memory
 from torch_extras.early_stopping import UpdatesWithoutImprovement
 
 from .batcher import add_batching_arguments, get_batcher, get_batching_dict
+from .batch_cache import (
+    CachedBatchPlan,
+    PreparedBatch,
+    prepare_batch,
+    prepare_batches
+)
+from .prefetch import BatchPrefetcher
+from .packing import generate_packed_batches
+from .model_util import PackedModelSourceAndTarget, has_only_transformer_layers
+from .calibration import (
+    add_calibration_arguments,
+    calibrate_training,
+    check_calibration_arguments
+)
+from .data_parallel import SingleProcess, add_data_parallel_arguments
+from .stacked_trials import add_stacked_trials_arguments, get_stacked_logits_at
+from .async_evaluation import AsyncCheckpointEvaluator, add_async_evaluation_arguments
+from .gradient_accumulation import (
+    AccumulatedBatch,
+    add_gradient_accumulation_arguments,
+    group_batches_by_target_tokens
+)
+from .precision import add_precision_arguments, get_autocast_context
+from .compilation import add_compile_arguments, check_compile_arguments, compile_model
+from .out_of_memory import (
+    OutOfMemorySplit,
+    add_out_of_memory_arguments,
+    get_reduced_max_cost,
+    run_with_out_of_memory_recovery
+)
 
 def add_train_arguments(parser):
     group = parser.add_argument_group('Training options')
@@ -19,6 +55,48 @@ def add_train_arguments(parser):
     add_filtering_arguments(group)
     group.add_argument('--filter-validation-data', action='store_true', default=False)
     add_batching_arguments(group)
+    add_calibration_arguments(group)
+    group.add_argument('--cache-training-batches', action='store_true', default=False,
+        help='Group the training data into batches and pad them only once, '
+             'and only shuffle the order of the batches in each epoch.')
+    group.add_argument('--bucket-reshuffle-probability', type=float, default=0.0,
+        help='When --cache-training-batches is used, the probability that '
+             'the examples with the same length are reshuffled among their '
+             'batches at the start of each epoch after the first. Only the '
+             'affected batches are re-packed.')
+    group.add_argument('--pack-sequences', action='store_true', default=False,
+        help='Concatenate several training examples into each row of a '
+             'batch to reduce padding. Attention is masked so that examples '
+             'in the same row do not interact, and positions restart at 0 '
+             'for each example. Validation batches are not packed.')
+    group.add_argument('--packing-row-length', type=int,
+        help='When --pack-sequences is used, the maximum number of source '
+             'or target tokens in a row, including EOS and BOS. The default '
+             'is the length of the longest training example.')
+    group.add_argument('--prefetch-batches', type=int, default=0,
+        help='Pad training batches and move them to the device in a '
+             'background thread, up to this many batches ahead of the batch '
+             'being trained on. The default, 0, disables prefetching.')
+    add_data_parallel_arguments(group)
+    add_stacked_trials_arguments(group)
+    add_async_evaluation_arguments(group)
+    group.add_argument('--async-save', action='store_true', default=False,
+        help='When a checkpoint is the best so far, copy the parameters to '
+             'CPU memory and write them to disk on a background thread '
+             'instead of blocking training. If a newer best checkpoint '
+             'arrives before the previous one has been written, only the '
+             'newer one is written. The time spent blocked and the latency '
+             'of the last completed write are logged in the checkpoint '
+             'event.')
+    group.add_argument('--resume', action='store_true', default=False,
+        help='Save the full training state, including the optimizer, '
+             'learning rate schedule, early stopping, and random number '
+             'generator states, at every checkpoint. If --output already '
+             'contains a saved training state, resume training from it '
+             'instead of starting over. Training is resumed from the last '
+             'checkpoint, and anything logged after it is discarded. If '
+             '--output was left by a run with --resume that was interrupted '
+             'before it saved a training state, training starts over in it.')
     add_optimizer_arguments(group)
     add_parameter_update_arguments(group)
     group.add_argument('--early-stopping-patience', type=int, required=True)
@@ -36,6 +114,10 @@ def add_optimizer_arguments(group):
 def add_parameter_update_arguments(group):
     group.add_argument('--label-smoothing', type=float, default=0.0)
     group.add_argument('--gradient-clipping-threshold', type=float)
+    add_gradient_accumulation_arguments(group)
+    add_out_of_memory_arguments(group)
+    add_precision_arguments(group)
+    add_compile_arguments(group)
 
 def filter_pairs(data, batcher, max_length):
     if max_length is not None:
@@ -49,32 +131,181 @@ def filter_pairs(data, batcher, max_length):
         if batcher.is_small_enough(1, len(pair[0]), len(pair[1]))
     ]
 
-def train(parser, args, saver, data, model_interface, events, logger):
+def train(parser, args, saver, data, model_interface, events, logger, parallel=None, training_state=None):
     """
     NOTE: When this function returns, the model's parameters will be those of
     the *last* epoch, not necessarily the *best* epoch.
+
+    :param parallel: A :py:class:`~sequence_to_sequence.data_parallel.DataParallel`
+        if this process is one of several data-parallel processes. Every
+        process must call this function with the same arguments, except that
+        only the first process should write to the model directory and log
+        events.
+    :param training_state: A training state saved with --resume, from which
+        to resume training.
+    """
+    train_trials(
+        parser,
+        args,
+        [(saver, events)],
+        data,
+        model_interface,
+        logger,
+        parallel,
+        [training_state] if training_state is not None else None
+    )
+
+@dataclasses.dataclass
+class TrainingTrial:
+    """The training state of one of the models trained by
+    :py:func:`train_trials`."""
+
+    saver: Any
+    events: Any
+    log_prefix: str
+    optimizer: Any = None
+    lr_scheduler: Any = None
+    early_stopping: Any = None
+    epoch_loss: 'Optional[LossAccumulator]' = None
+    should_stop: bool = False
+    best_validation_scores: Optional[dict] = None
+    best_checkpoint_no: Optional[int] = None
+    best_epoch_no: Optional[int] = None
+    num_epochs: Optional[int] = None
+    num_checkpoints: int = 0
+    duration: Optional[datetime.timedelta] = None
+
+def train_trials(
+    parser,
+    args,
+    trials,
+    data,
+    model_interface,
+    logger,
+    parallel=None,
+    training_states=None
+):
+    """Like :py:func:`train`, but train several models with the same
+    architecture at once on the same batches. If there is more than one
+    model, they are run as one stacked model.
+
+    Each model has its own optimizer, learning rate schedule, and early
+    stopping, and its own events are logged in the same way as in a separate
+    run. A model that stops early is removed from the stack, and training
+    continues until all models have stopped.
+
+    :param trials: A list of (saver, events) pairs, one for each model.
+    :param training_states: If training is being resumed, a list of the
+        training states saved for each model.
     """
+    if parallel is None:
+        parallel = SingleProcess()
     do_show_progress = not args.no_progress
     device = model_interface.get_device(args)
     do_profile_memory = device.type == 'cuda'
+    is_resuming = training_states is not None
+    if is_resuming:
+        # The state of the training loop is the same for all trials.
+        resume_state = training_states[0]['training']
+        random_shuffling_seed = resume_state['random_shuffling_seed']
+    else:
+        random_shuffling_seed = args.random_shuffling_seed
     random_shuffling_generator, random_shuffling_seed = \
-        get_random_generator_and_seed(args.random_shuffling_seed)
+        get_random_generator_and_seed(random_shuffling_seed)
     logger.info(f'random shuffling seed: {random_shuffling_seed}')
-    optimizer = get_optimizer(saver, args)
+    if args.resume and parallel.world_size > 1:
+        parser.error('--resume cannot be used with --data-parallel-workers')
+    if len(trials) > 1:
+        if parallel.world_size > 1:
+            parser.error('--stacked-trials cannot be used with --data-parallel-workers')
+        if args.batching_calibrate:
+            parser.error('--stacked-trials cannot be used with --batching-calibrate')
+    trials = [
+        TrainingTrial(
+            saver,
+            events,
+            f'trial {trial_no + 1}: ' if len(trials) > 1 else ''
+        )
+        for trial_no, (saver, events) in enumerate(trials)
+    ]
     validation_criterion = 'cross_entropy_per_token'
-    early_stopping = UpdatesWithoutImprovement(
-        'min',
-        patience=args.early_stopping_patience
-    )
-    lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
-        optimizer,
-        mode=early_stopping.mode,
-        patience=args.learning_rate_patience,
-        factor=args.learning_rate_decay_factor
-    )
+    for trial in trials:
+        parallel.broadcast_parameters(trial.saver.model)
+        trial.optimizer = get_optimizer(trial.saver, args)
+        trial.early_stopping = UpdatesWithoutImprovement(
+            'min',
+            patience=args.early_stopping_patience
+        )
+        trial.lr_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
+            trial.optimizer,
+            mode=trial.early_stopping.mode,
+            patience=args.learning_rate_patience,
+            factor=args.learning_rate_decay_factor
+        )
+    if is_resuming:
+        for trial, training_state in zip(trials, training_states):
+            load_trial_state(trial, training_state)
+    # All of the models have the same architecture, so the first one is used
+    # wherever only the architecture matters.
+    saver = trials[0].saver
     num_training_examples_before = len(data.training_data)
     logger.info(f'training examples before filtering: {num_training_examples_before}')
-    batcher = get_batcher(parser, args, model_interface)
+    check_calibration_arguments(parser, args)
+    if args.pack_sequences and args.cache_training_batches:
+        parser.error('--pack-sequences cannot be used with --cache-training-batches')
+    if args.pack_sequences and not has_only_transformer_layers(saver.kwargs):
+        parser.error('--pack-sequences can only be used with transformer layers')
+    if len(trials) > 1 and not has_only_transformer_layers(saver.kwargs):
+        # The built-in RNNs cannot be vectorized with torch.func.vmap.
+        parser.error('--stacked-trials can only be used with transformer layers')
+    if args.gradient_accumulation_tokens is not None and args.gradient_accumulation_tokens < 1:
+        parser.error('--gradient-accumulation-tokens must be at least 1')
+    if args.async_checkpoint_evaluation:
+        if parallel.world_size > 1:
+            parser.error('--async-checkpoint-evaluation cannot be used with --data-parallel-workers')
+        if args.async_evaluation_max_lag < 1:
+            parser.error('--async-evaluation-max-lag must be at least 1')
+    check_compile_arguments(parser, args)
+    if args.compile:
+        if len(trials) > 1:
+            parser.error('--compile cannot be used with --stacked-trials')
+        # Compile before calibrating, so that the calibration measures the
+        # compiled model, and before preparing any batches, so that their
+        # lengths are rounded up.
+        compile_model(model_interface, saver, args.compile_length_multiple, logger)
+    if args.batching_calibrate:
+        max_probe_length = max(max(len(s), len(t)) for s, t in data.training_data)
+        if args.max_length is not None:
+            max_probe_length = min(max_probe_length, args.max_length)
+        # The probes run real training steps with a throwaway optimizer. Out-
+        # of-memory recovery is disabled, so that a probe that runs out of
+        # memory fails instead of being split.
+        calibration_args = copy.copy(args)
+        calibration_args.no_out_of_memory_recovery = True
+        max_cost, calibration = calibrate_training(
+            parser,
+            args,
+            saver,
+            model_interface,
+            data,
+            device,
+            max_probe_length,
+            logger,
+            functools.partial(
+                run_parameter_update,
+                saver,
+                get_optimizer(saver, args),
+                model_interface=model_interface,
+                data=data,
+                device=device,
+                args=calibration_args
+            )
+        )
+        if not is_resuming:
+            trials[0].events.log('batching_calibration', calibration)
+    else:
+        max_cost = None
+    batcher = get_batcher(parser, args, model_interface, saver.kwargs, max_cost)
     data.training_data = filter_pairs(
         data.training_data,
         batcher,
@@ -91,44 +322,277 @@ def train(parser, args, saver, data, model_interface, events, logger):
             batcher,
             args.max_length
         )
-    validation_batches = list(batcher.generate_batches(data.validation_data))
-    logger.info(f'validation batches: {len(validation_batches)}')
-    model_interface.on_before_process_pairs(
-        saver,
-        [data.training_data, data.validation_data]
+    # The validation batches are the same at every checkpoint, so pad them
+    # only once.
+    validation_batches = prepare_batches(
+        batcher.generate_batches(data.validation_data),
+        model_interface,
+        device,
+        data
     )
+    logger.info(f'validation batches: {len(validation_batches)}')
+    for trial in trials:
+        model_interface.on_before_process_pairs(
+            trial.saver,
+            [data.training_data, data.validation_data]
+        )
+    if args.pack_sequences:
+        if args.packing_row_length is not None:
+            packing_row_length = args.packing_row_length
+        else:
+            packing_row_length = max(
+                max(
+                    model_interface.adjust_source_length(len(s)),
+                    model_interface.adjust_target_length(len(t))
+                )
+                for s, t in data.training_data
+            )
+        logger.info(f'packing row length: {packing_row_length}')
     data.validation_data = None
-    events.log('start_training', dict(
-        training_examples_before_filtering=num_training_examples_before,
-        training_examples_after_filtering=num_training_examples_after,
-        validation_examples=num_validation_examples,
-        validation_batches=len(validation_batches),
-        batching=get_batching_dict(args),
-        epochs=args.epochs,
-        random_shuffling_seed=random_shuffling_seed,
-        optimizer=args.optimizer,
-        learning_rate=args.learning_rate,
-        label_smoothing=args.label_smoothing,
-        early_stopping_patience=args.early_stopping_patience,
-        learning_rate_patience=args.learning_rate_patience,
-        learning_rate_decay_factor=args.learning_rate_decay_factor,
-        gradient_clipping_threshold=args.gradient_clipping_threshold,
-        checkpoint_interval_sequences=args.checkpoint_interval_sequences
-    ))
+    # When resuming, these events have already been logged.
+    if not is_resuming:
+        for trial in trials:
+            trial.events.log('start_training', dict(
+                training_examples_before_filtering=num_training_examples_before,
+                training_examples_after_filtering=num_training_examples_after,
+                validation_examples=num_validation_examples,
+                validation_batches=len(validation_batches),
+                batching=get_batching_dict(args, batcher),
+                epochs=args.epochs,
+                random_shuffling_seed=random_shuffling_seed,
+                optimizer=args.optimizer,
+                learning_rate=args.learning_rate,
+                label_smoothing=args.label_smoothing,
+                early_stopping_patience=args.early_stopping_patience,
+                learning_rate_patience=args.learning_rate_patience,
+                learning_rate_decay_factor=args.learning_rate_decay_factor,
+                gradient_clipping_threshold=args.gradient_clipping_threshold,
+                gradient_accumulation_tokens=args.gradient_accumulation_tokens,
+                out_of_memory_recovery=not args.no_out_of_memory_recovery,
+                precision=args.precision,
+                compile=args.compile,
+                compile_length_multiple=args.compile_length_multiple if args.compile else None,
+                checkpoint_interval_sequences=args.checkpoint_interval_sequences,
+                cache_training_batches=args.cache_training_batches,
+                bucket_reshuffle_probability=args.bucket_reshuffle_probability,
+                prefetch_batches=args.prefetch_batches,
+                async_save=args.async_save,
+                resume=args.resume,
+                pack_sequences=args.pack_sequences,
+                packing_row_length=packing_row_length if args.pack_sequences else None,
+                async_checkpoint_evaluation=args.async_checkpoint_evaluation,
+                async_evaluation_max_lag=args.async_evaluation_max_lag if args.async_checkpoint_evaluation else None
+            ))
+    if args.cache_training_batches:
+        random_shuffling_generator.shuffle(data.training_data)
+        batch_plan = CachedBatchPlan(
+            data.training_data,
+            batcher,
+            model_interface,
+            device,
+            data
+        )
+        logger.info(f'cached training batches: {len(batch_plan.batches)}')
+    else:
+        batch_plan = None
+    if args.async_checkpoint_evaluation:
+        evaluator = AsyncCheckpointEvaluator(
+            functools.partial(evaluate, precision=args.precision),
+            saver.kwargs,
+            validation_batches,
+            data,
+            device,
+            args.async_evaluation_threads
+        )
+    else:
+        evaluator = None
+    if args.async_save:
+        parameter_writer = AsyncParameterWriter()
+    else:
+        parameter_writer = None
+    # The trials that have not stopped early.
+    active_trials = [trial for trial in trials if not trial.should_stop]
     epoch_no = 0
     sequences_since_checkpoint = 0
+    total_sequences = 0
     checkpoint_no = 0
-    best_validation_scores = None
-    best_checkpoint_no = None
-    best_epoch_no = None
     total_start_time = datetime.datetime.now()
-    for _ in range(args.epochs):
-        epoch_start_time = datetime.datetime.now()
+    # The index of the batch at which to continue the current epoch, if
+    # training is being resumed in the middle of it.
+    resume_batch_no = None
+
+    def apply_validation_scores(trial, validation_scores, checkpoint_no, epoch_no, state_dict=None, lag=None):
+        validation_score = validation_scores[validation_criterion]
+        logger.info(f'    {trial.log_prefix}validation cross entropy: {validation_score:.2f}')
+        # Update the learning rate.
+        trial.lr_scheduler.step(validation_score)
+        # Show the current learning rate.
+        curr_learning_rate = trial.optimizer.param_groups[0]['lr']
+        logger.info(f'    {trial.log_prefix}learning rate: {curr_learning_rate}')
+        # Decide whether to save the model parameters and whether to stop
+        # early.
+        is_best, trial.should_stop = trial.early_stopping.update(validation_score)
+        if is_best:
+            logger.info(f'    {trial.log_prefix}saving parameters')
+            if parameter_writer is not None:
+                save_start_time = time.perf_counter()
+                parameter_writer.save(trial.saver, state_dict=state_dict)
+                save_blocking_seconds = time.perf_counter() - save_start_time
+            else:
+                trial.saver.save(state_dict=state_dict)
+            trial.best_validation_scores = validation_scores
+            trial.best_checkpoint_no = checkpoint_no
+            trial.best_epoch_no = epoch_no
+        event = dict(
+            is_best=is_best,
+            scores=validation_scores
+        )
+        if lag is not None:
+            event.update(lag)
+        if parameter_writer is not None:
+            event.update(
+                save_blocking_seconds=save_blocking_seconds if is_best else None,
+                last_write_seconds=parameter_writer.last_write_seconds
+            )
+        trial.events.log('checkpoint', event)
+        trial.num_checkpoints = checkpoint_no + 1
+
+    def apply_checkpoint_result(result):
+        result_checkpoint_no, result_epoch_no, result_total_sequences, result_trials = result.key
+        logger.info(f'  checkpoint #{result_checkpoint_no + 1} evaluated')
+        lag = dict(
+            evaluation_lag_sequences=total_sequences - result_total_sequences,
+            evaluation_lag_seconds=result.lag_seconds
+        )
+        for trial, state_dict, validation_scores in zip(result_trials, result.state_dicts, result.scores):
+            # Ignore results for trials that stopped early because of an
+            # earlier checkpoint.
+            if not trial.should_stop:
+                apply_validation_scores(
+                    trial,
+                    validation_scores,
+                    result_checkpoint_no,
+                    result_epoch_no,
+                    state_dict,
+                    lag
+                )
+
+    def finish_trial(trial):
+        trial.num_epochs = epoch_no
+        trial.duration = datetime.datetime.now() - total_start_time
+
+    def remove_stopped_trials(active_trials):
+        for trial in active_trials:
+            if trial.should_stop:
+                logger.info(f'  {trial.log_prefix}stopping early')
+                finish_trial(trial)
+        return [trial for trial in active_trials if not trial.should_stop]
+
+    # The maximum batch cost used to generate the batches of each epoch,
+    # which can be lowered when a batch runs out of memory.
+    epoch_max_costs = []
+
+    def get_epoch_batches(epoch_no):
+        if epoch_no < len(epoch_max_costs):
+            # The shuffling of this epoch is being replayed.
+            batcher.max_cost = epoch_max_costs[epoch_no]
+        else:
+            # Every process must generate the same batches.
+            batcher.max_cost = parallel.reduce_min(batcher.max_cost)
+            epoch_max_costs.append(batcher.max_cost)
+        if batch_plan is not None:
+            if epoch_no > 0 and args.bucket_reshuffle_probability > 0:
+                num_repacked_batches = batch_plan.reshuffle_buckets(
+                    random_shuffling_generator,
+                    args.bucket_reshuffle_probability
+                )
+                logger.info(f'  re-packed batches: {num_repacked_batches}')
+            batches = batch_plan.get_batches(random_shuffling_generator)
+        elif args.pack_sequences:
+            random_shuffling_generator.shuffle(data.training_data)
+            batches = list(generate_packed_batches(
+                data.training_data,
+                batcher,
+                packing_row_length
+            ))
+            random_shuffling_generator.shuffle(batches)
+        else:
+            random_shuffling_generator.shuffle(data.training_data)
+            batches = list(batcher.generate_batches(data.training_data))
+            random_shuffling_generator.shuffle(batches)
+        if args.gradient_accumulation_tokens is not None:
+            # Each accumulated batch is one parameter update.
+            batches = group_batches_by_target_tokens(
+                batches,
+                args.gradient_accumulation_tokens
+            )
+        # Every process has the same batches, and each one trains on its own
+        # share of them.
+        return parallel.shard(batches)
+
+    def save_training_states(next_batch_no, epoch_start_time):
+        now = datetime.datetime.now()
+        training = dict(
+            random_shuffling_seed=random_shuffling_seed,
+            epoch_no=epoch_no,
+            batch_no=next_batch_no,
+            sequences_since_checkpoint=sequences_since_checkpoint,
+            total_sequences=total_sequences,
+            checkpoint_no=checkpoint_no,
+            epoch_max_costs=list(epoch_max_costs),
+            max_cost=batcher.max_cost,
+            elapsed_seconds=(now - total_start_time).total_seconds(),
+            epoch_elapsed_seconds=(now - epoch_start_time).total_seconds(),
+            rng_state=torch.get_rng_state(),
+            cuda_rng_state=torch.cuda.get_rng_state(device) if device.type == 'cuda' else None
+        )
+        for trial in trials:
+            trial.saver.save_training_state(get_trial_state(trial, training))
+
+    if is_resuming:
+        epoch_no = resume_state['epoch_no']
+        # Restore the maximum batch costs before replaying the completed
+        # epochs, since they determine how many batches were shuffled.
+        epoch_max_costs = list(resume_state['epoch_max_costs'])
+        # Replay the shuffling of the completed epochs, so the random
+        # shuffling generator and the order of the training data are the
+        # same as they were when the state was saved.
+        for completed_epoch_no in range(epoch_no):
+            get_epoch_batches(completed_epoch_no)
+        resume_batch_no = resume_state['batch_no']
+        sequences_since_checkpoint = resume_state['sequences_since_checkpoint']
+        total_sequences = resume_state['total_sequences']
+        checkpoint_no = resume_state['checkpoint_no']
+        total_start_time -= datetime.timedelta(seconds=resume_state['elapsed_seconds'])
+        torch.set_rng_state(resume_state['rng_state'])
+        if device.type == 'cuda':
+            torch.cuda.set_rng_state(resume_state['cuda_rng_state'], device)
+        logger.info(f'resuming from epoch #{epoch_no + 1}, checkpoint #{checkpoint_no}')
+    elif args.resume:
+        # Save a training state before the first batch, so that a run that
+        # is interrupted before its first checkpoint can be resumed.
+        for trial in trials:
+            trial.epoch_loss = LossAccumulator()
+        save_training_states(0, total_start_time)
+
+    while epoch_no < args.epochs:
         logger.info(f'epoch #{epoch_no + 1}')
-        random_shuffling_generator.shuffle(data.training_data)
-        batches = list(batcher.generate_batches(data.training_data))
-        random_shuffling_generator.shuffle(batches)
-        epoch_loss = LossAccumulator()
+        batches = get_epoch_batches(epoch_no)
+        if resume_batch_no is None:
+            epoch_start_time = datetime.datetime.now()
+            first_batch_no = 0
+            for trial in active_trials:
+                trial.epoch_loss = LossAccumulator()
+        else:
+            # Continue the epoch in which the state was saved. The epoch
+            # losses were restored with the trials.
+            epoch_start_time = (
+                datetime.datetime.now() -
+                datetime.timedelta(seconds=resume_state['epoch_elapsed_seconds'])
+            )
+            first_batch_no = resume_batch_no
+            resume_batch_no = None
+            batcher.max_cost = resume_state['max_cost']
         if do_show_progress:
             progress_loss = LossAccumulator()
             progress_num_examples = 0
@@ -136,135 +600,262 @@ def train(parser, args, saver, data, model_interface, events, logger):
             ticker = TimedTicker(len(batches), 1)
         if do_profile_memory:
             reset_memory_profiler(device)
-        should_stop = False
-        for batch_no, batch in enumerate(batches):
-            try:
-                result = run_parameter_update(
-                    saver,
-                    optimizer,
-                    batch,
-                    model_interface,
-                    data,
-                    device,
-                    args
-                )
-                epoch_loss.update(result.loss_numer, result.num_symbols)
-                if do_show_progress:
-                    progress_loss.update(result.loss_numer, result.num_symbols)
-            except OutOfCUDAMemoryError as e:
-                handle_out_of_cuda_memory(data, events, logger, device, batch, e.parts)
-                raise
-            batch_size = len(batch)
-            if do_show_progress:
-                progress_num_examples += batch_size
-                ticker.progress = batch_no + 1
-                if ticker.tick():
-                    progress_loss_value = progress_loss.get_value()
-                    progress_duration = datetime.datetime.now() - progress_start_time
-                    progress_examples_per_second = progress_num_examples / progress_duration.total_seconds()
+        if args.prefetch_batches > 0:
+            # The prefetcher prepares the batches in the same order as
+            # `batches`, so the order of training is not affected.
+            prefetcher = BatchPrefetcher(
+                batches[first_batch_no:],
+                lambda batch: prefetch_batch(batch, model_interface, device, data),
+                args.prefetch_batches
+            )
+            batch_iter = prefetcher
+        else:
+            prefetcher = None
+            batch_iter = batches[first_batch_no:]
+        # Close the prefetcher even if the epoch is interrupted, so that its
+        # thread does not keep preparing batches in the background.
+        with prefetcher if prefetcher is not None else contextlib.nullcontext():
+            for batch_no, batch in enumerate(batch_iter, first_batch_no):
+                try:
+                    results = run_trials_parameter_update(
+                        active_trials,
+                        batch,
+                        model_interface,
+                        data,
+                        device,
+                        args,
+                        parallel
+                    )
+                    for trial, result in zip(active_trials, results):
+                        trial.epoch_loss.update(result.loss_numer, result.num_symbols)
+                        if do_show_progress:
+                            progress_loss.update(result.loss_numer, result.num_symbols)
+                except OutOfCUDAMemoryError as e:
+                    for trial in active_trials:
+                        handle_out_of_cuda_memory(data, trial.events, logger, device, batch, e.parts)
+                    raise
+                # When training is data-parallel, this counts the examples in the
+                # batches of all processes.
+                batch_size = results[0].batch_size
+                for split in results[0].out_of_memory_splits:
+                    # Lower the maximum cost of the batches of later epochs.
+                    max_cost = get_reduced_max_cost(batcher, split)
                     logger.info(
-                        f'  {ticker.int_percent}% '
-                        f'| loss: {progress_loss_value:.2f} '
-                        f'| examples/s: {progress_examples_per_second:.2f}'
+                        f'  out of memory; split a batch of size {split.batch_size} '
+                        f'with source length {split.source_length} and target '
+                        f'length {split.target_length}'
                     )
-                    progress_loss = LossAccumulator()
-                    progress_start_time = datetime.datetime.now()
-                    progress_num_examples = 0
-            sequences_since_checkpoint += batch_size
-            if sequences_since_checkpoint >= args.checkpoint_interval_sequences:
-                logger.info(f'  checkpoint #{checkpoint_no + 1}')
-                validation_scores = evaluate(
-                    saver.model,
-                    validation_batches,
-                    data,
-                    model_interface,
-                    device
-                )
-                validation_score = validation_scores[validation_criterion]
-                logger.info(f'    validation cross entropy: {validation_score:.2f}')
-                # Update the learning rate.
-                lr_scheduler.step(validation_score)
-                # Show the current learning rate.
-                curr_learning_rate = optimizer.param_groups[0]['lr']
-                logger.info(f'    learning rate: {curr_learning_rate}')
-                # Decide whether to save the model parameters and whether to
-                # stop early.
-                is_best, should_stop = early_stopping.update(validation_score)
-                if is_best:
-                    logger.info('    saving parameters')
-                    saver.save()
-                    best_validation_scores = validation_scores
-                    best_checkpoint_no = checkpoint_no
-                    best_epoch_no = epoch_no
-                events.log('checkpoint', dict(
-                    is_best=is_best,
-                    scores=validation_scores
-                ))
-                # Reset the count of sequences seen since the last checkpoint.
-                # If `sequences_since_checkpoint` is not exactly equal to
-                # `args.checkpoint_interval_sequences` after `batch_size` is
-                # added to it, but is greater than it, include the extra
-                # sequences in the updated count.
-                sequences_since_checkpoint %= args.checkpoint_interval_sequences
-                checkpoint_no += 1
-                if should_stop:
-                    logger.info('  stopping early')
+                    logger.info(f'  max batch cost: {max_cost}')
+                    for trial in active_trials:
+                        trial.events.log('out_of_memory_split', dict(
+                            batch_size=split.batch_size,
+                            source_length=split.source_length,
+                            target_length=split.target_length,
+                            max_cost=max_cost
+                        ))
+                    batcher.max_cost = max_cost
+                if do_show_progress:
+                    progress_num_examples += batch_size
+                    ticker.progress = batch_no + 1
+                    if ticker.tick():
+                        progress_loss_value = progress_loss.get_value()
+                        progress_duration = datetime.datetime.now() - progress_start_time
+                        progress_examples_per_second = progress_num_examples / progress_duration.total_seconds()
+                        logger.info(
+                            f'  {ticker.int_percent}% '
+                            f'| loss: {progress_loss_value:.2f} '
+                            f'| examples/s: {progress_examples_per_second:.2f}'
+                        )
+                        progress_loss = LossAccumulator()
+                        progress_start_time = datetime.datetime.now()
+                        progress_num_examples = 0
+                sequences_since_checkpoint += batch_size
+                total_sequences += batch_size
+                if evaluator is not None:
+                    for result in evaluator.poll():
+                        apply_checkpoint_result(result)
+                if sequences_since_checkpoint >= args.checkpoint_interval_sequences:
+                    logger.info(f'  checkpoint #{checkpoint_no + 1}')
+                    if evaluator is not None:
+                        # Bound the number of checkpoints whose results are
+                        # pending by waiting for the oldest ones.
+                        while evaluator.num_pending() >= args.async_evaluation_max_lag:
+                            apply_checkpoint_result(evaluator.wait())
+                        checkpoint_trials = [trial for trial in active_trials if not trial.should_stop]
+                        if checkpoint_trials:
+                            evaluator.submit(
+                                (checkpoint_no, epoch_no, total_sequences, checkpoint_trials),
+                                [trial.saver.model for trial in checkpoint_trials]
+                            )
+                    else:
+                        for trial in active_trials:
+                            # Only the first process evaluates the model, but all
+                            # of them update the learning rate and early stopping
+                            # in the same way.
+                            validation_scores = parallel.broadcast_object(evaluate(
+                                trial.saver.model,
+                                validation_batches,
+                                data,
+                                model_interface,
+                                device,
+                                args.precision
+                            ) if parallel.is_main else None)
+                            apply_validation_scores(
+                                trial,
+                                validation_scores,
+                                checkpoint_no,
+                                epoch_no
+                            )
+                    # Reset the count of sequences seen since the last checkpoint.
+                    # If `sequences_since_checkpoint` is not exactly equal to
+                    # `args.checkpoint_interval_sequences` after `batch_size` is
+                    # added to it, but is greater than it, include the extra
+                    # sequences in the updated count.
+                    sequences_since_checkpoint %= args.checkpoint_interval_sequences
+                    checkpoint_no += 1
+                    if args.resume:
+                        if evaluator is not None:
+                            # The saved state must reflect the results of all
+                            # checkpoints up to this one.
+                            while evaluator.num_pending() > 0:
+                                apply_checkpoint_result(evaluator.wait())
+                        active_trials = remove_stopped_trials(active_trials)
+                        if active_trials:
+                            if parameter_writer is not None:
+                                # Make sure the best parameters are on disk
+                                # before the state that refers to them.
+                                parameter_writer.flush()
+                            save_training_states(batch_no + 1, epoch_start_time)
+                active_trials = remove_stopped_trials(active_trials)
+                if not active_trials:
                     break
-        if should_stop:
+        if not active_trials:
             break
-        epoch_loss_value = epoch_loss.get_value()
         epoch_duration = datetime.datetime.now() - epoch_start_time
-        logger.info(f'  epoch loss: {epoch_loss_value:.2f}')
+        for trial in active_trials:
+            logger.info(f'  {trial.log_prefix}epoch loss: {trial.epoch_loss.get_value():.2f}')
         logger.info(f'  epoch duration: {epoch_duration}')
         if do_profile_memory:
             peak_memory = get_peak_memory(device)
             logger.info(f'  peak CUDA memory: {humanfriendly.format_size(peak_memory)}')
         else:
             peak_memory = None
-        events.log('epoch', dict(
-            loss=epoch_loss_value,
-            duration=epoch_duration.total_seconds(),
-            peak_memory=peak_memory
-        ))
+        if prefetcher is not None:
+            logger.info(f'  prefetch stall time: {prefetcher.stall_time:.2f}s')
+            prefetch_stall_time = prefetcher.stall_time
+            prefetch_mean_queue_size = prefetcher.mean_queue_size()
+        else:
+            prefetch_stall_time = None
+            prefetch_mean_queue_size = None
+        for trial in active_trials:
+            trial.events.log('epoch', dict(
+                loss=trial.epoch_loss.get_value(),
+                duration=epoch_duration.total_seconds(),
+                peak_memory=peak_memory,
+                prefetch_depth=args.prefetch_batches,
+                prefetch_stall_time=prefetch_stall_time,
+                prefetch_mean_queue_size=prefetch_mean_queue_size
+            ))
         epoch_no += 1
-    total_duration = datetime.datetime.now() - total_start_time
-    if best_validation_scores is None:
+    if evaluator is not None:
+        # Apply the results of the remaining checkpoints.
+        while evaluator.num_pending() > 0:
+            apply_checkpoint_result(evaluator.wait())
+        evaluator.close()
+        active_trials = remove_stopped_trials(active_trials)
+    if parameter_writer is not None:
+        parameter_writer.close()
+    for trial in active_trials:
+        finish_trial(trial)
+    if trials[0].best_validation_scores is None:
         raise ValueError(
             'the maximum number of epochs has been reached, but no '
             'checkpoints have been made'
         )
-    best_validation_score = best_validation_scores[validation_criterion]
-    logger.info(f'best validation cross entropy: {best_validation_score:.2f}')
-    logger.info(f'completed epochs: {epoch_no}')
-    logger.info(f'best epoch: #{best_epoch_no+1}')
-    logger.info(f'completed checkpoints: {checkpoint_no}')
-    logger.info(f'best checkpoint: #{best_checkpoint_no+1}')
-    logger.info(f'checkpoints since improvement: {early_stopping.updates_since_improvement}')
-    logger.info(f'total training duration: {total_duration}')
-    events.log('train', dict(
-        best_validation_scores=best_validation_scores,
-        num_epochs=epoch_no,
-        best_epoch=best_epoch_no,
-        num_checkpoints=checkpoint_no,
-        best_checkpoint=best_checkpoint_no,
-        checkpoints_since_improvement=early_stopping.updates_since_improvement,
-        duration=total_duration.total_seconds()
-    ))
+    for trial in trials:
+        best_validation_score = trial.best_validation_scores[validation_criterion]
+        logger.info(f'{trial.log_prefix}best validation cross entropy: {best_validation_score:.2f}')
+        logger.info(f'{trial.log_prefix}completed epochs: {trial.num_epochs}')
+        logger.info(f'{trial.log_prefix}best epoch: #{trial.best_epoch_no+1}')
+        logger.info(f'{trial.log_prefix}completed checkpoints: {trial.num_checkpoints}')
+        logger.info(f'{trial.log_prefix}best checkpoint: #{trial.best_checkpoint_no+1}')
+        logger.info(f'{trial.log_prefix}checkpoints since improvement: {trial.early_stopping.updates_since_improvement}')
+        logger.info(f'{trial.log_prefix}total training duration: {trial.duration}')
+        trial.events.log('train', dict(
+            best_validation_scores=trial.best_validation_scores,
+            num_epochs=trial.num_epochs,
+            best_epoch=trial.best_epoch_no,
+            num_checkpoints=trial.num_checkpoints,
+            best_checkpoint=trial.best_checkpoint_no,
+            checkpoints_since_improvement=trial.early_stopping.updates_since_improvement,
+            duration=trial.duration.total_seconds()
+        ))
+
+def get_trial_state(trial, training):
+    """Get everything needed to resume training a trial.
 
-def evaluate(model, batches, data, model_interface, device):
+    :param training: The state of the training loop, which is shared by all
+        trials.
+    """
+    return dict(
+        model=trial.saver.model.state_dict(),
+        optimizer=trial.optimizer.state_dict(),
+        lr_scheduler=trial.lr_scheduler.state_dict(),
+        early_stopping=trial.early_stopping.state_dict(),
+        trial=dict(
+            epoch_loss_numerator=trial.epoch_loss.numerator,
+            epoch_loss_denominator=trial.epoch_loss.denominator,
+            should_stop=trial.should_stop,
+            best_validation_scores=trial.best_validation_scores,
+            best_checkpoint_no=trial.best_checkpoint_no,
+            best_epoch_no=trial.best_epoch_no,
+            num_epochs=trial.num_epochs,
+            num_checkpoints=trial.num_checkpoints,
+            duration=trial.duration.total_seconds() if trial.duration is not None else None
+        ),
+        training=training,
+        # Events logged after this position are discarded when resuming.
+        log_position=trial.events.tell()
+    )
+
+def load_trial_state(trial, state):
+    """Restore a trial from a state returned by :py:func:`get_trial_state`.
+    The trial's optimizer, learning rate scheduler, and early stopping
+    criterion must already have been constructed."""
+    trial.saver.model.load_state_dict(state['model'])
+    trial.optimizer.load_state_dict(state['optimizer'])
+    trial.lr_scheduler.load_state_dict(state['lr_scheduler'])
+    trial.early_stopping.load_state_dict(state['early_stopping'])
+    trial_state = state['trial']
+    trial.epoch_loss = LossAccumulator()
+    trial.epoch_loss.update(
+        trial_state['epoch_loss_numerator'],
+        trial_state['epoch_loss_denominator']
+    )
+    trial.should_stop = trial_state['should_stop']
+    trial.best_validation_scores = trial_state['best_validation_scores']
+    trial.best_checkpoint_no = trial_state['best_checkpoint_no']
+    trial.best_epoch_no = trial_state['best_epoch_no']
+    trial.num_epochs = trial_state['num_epochs']
+    trial.num_checkpoints = trial_state['num_checkpoints']
+    if trial_state['duration'] is not None:
+        trial.duration = datetime.timedelta(seconds=trial_state['duration'])
+
+def evaluate(model, batches, data, model_interface, device, precision='fp32'):
     model.eval()
     with torch.no_grad():
         cumulative_loss = LossAccumulator()
         for batch in batches:
-            parts = get_loss_parts(
-                model,
-                batch,
-                data,
-                model_interface,
-                device,
-                reduction='sum',
-                label_smoothing=0.0
-            )
+            with get_autocast_context(precision, device):
+                parts = get_loss_parts(
+                    model,
+                    batch,
+                    data,
+                    model_interface,
+                    device,
+                    reduction='sum',
+                    label_smoothing=0.0
+                )
             cumulative_loss.update(parts.cross_entropy.item(), parts.num_symbols)
     return dict(cross_entropy_per_token=cumulative_loss.get_value())
 
@@ -282,25 +873,54 @@ class LossParts:
     source_input_size: torch.Size
     target_input_size: torch.Size
     target_output_size: torch.Size
+    example_ids: torch.Tensor
 
 def get_loss_parts(model, batch, data, model_interface, device, reduction, label_smoothing):
     pad_index = len(data.target_output_vocab)
-    model_input, correct_target = model_interface.prepare_batch(batch, device, data)
-    logits = model_interface.get_logits(model, model_input)
+    model_input, correct_target = prepare_batch(batch, model_interface, device, data)
+    # Only compute the output layer and the loss at non-padding positions.
+    # is_symbol : B x m
+    is_symbol = correct_target != pad_index
+    # logits : N x V
+    logits = model_interface.get_logits_at(model, model_input, is_symbol)
+    # cross_entropy : N if reduction is 'none'
+    # The loss is computed in float32 even if the model runs in lower
+    # precision.
     cross_entropy = torch.nn.functional.cross_entropy(
-        logits.permute(0, 2, 1),
-        correct_target,
-        ignore_index=pad_index,
+        logits.float(),
+        correct_target[is_symbol],
         reduction=reduction,
         label_smoothing=label_smoothing
     )
-    num_symbols = torch.sum(correct_target != pad_index).item()
+    num_symbols = logits.size(0)
     return LossParts(
         cross_entropy,
         num_symbols,
         model_input.source.size(),
         model_input.target.size(),
-        correct_target.size()
+        correct_target.size(),
+        get_example_ids(model_input, correct_target)[is_symbol]
+    )
+
+def get_example_ids(model_input, correct_target):
+    """Get the index of the example that each target position belongs to."""
+    if isinstance(model_input, PackedModelSourceAndTarget):
+        # When examples are packed, a row can contain several examples.
+        return model_input.target_example_ids
+    else:
+        batch_size = correct_target.size(0)
+        return torch.arange(
+            batch_size,
+            device=correct_target.device
+        )[:, None].expand_as(correct_target)
+
+def get_sequence_losses(parts, batch_size):
+    """Sum the unreduced cross entropy of the symbols of each example in a
+    batch."""
+    return parts.cross_entropy.new_zeros(batch_size).index_add_(
+        0,
+        parts.example_ids,
+        parts.cross_entropy
     )
 
 class OutOfCUDAMemoryError(RuntimeError):
@@ -309,6 +929,52 @@ class OutOfCUDAMemoryError(RuntimeError):
         super().__init__()
         self.parts = parts
 
+def prefetch_batch(batch, model_interface, device, data):
+    """Pad a batch and move it to the device ahead of time."""
+    if batch is None:
+        return None
+    elif isinstance(batch, AccumulatedBatch):
+        return AccumulatedBatch([
+            prefetch_batch(micro_batch, model_interface, device, data)
+            for micro_batch in batch.batches
+        ])
+    else:
+        return PreparedBatch(
+            list(batch),
+            *prepare_batch(batch, model_interface, device, data)
+        )
+
+def run_trials_parameter_update(
+    trials,
+    batch,
+    model_interface,
+    data,
+    device,
+    args,
+    parallel
+):
+    if len(trials) == 1:
+        trial, = trials
+        return [run_parameter_update(
+            trial.saver,
+            trial.optimizer,
+            batch,
+            model_interface,
+            data,
+            device,
+            args,
+            parallel
+        )]
+    else:
+        return run_stacked_parameter_update(
+            trials,
+            batch,
+            model_interface,
+            data,
+            device,
+            args
+        )
+
 def run_parameter_update(
     saver,
     optimizer,
@@ -316,42 +982,166 @@ def run_parameter_update(
     model_interface,
     data,
     device,
-    args
+    args,
+    parallel=None
 ):
-    parts = None
-    try:
-        optimizer.zero_grad()
-        saver.model.train()
-        parts = get_loss_parts(
-            saver.model,
+    if parallel is None:
+        parallel = SingleProcess()
+    saver.model.train()
+    if batch is not None:
+        batch_size = len(batch)
+        # When training is data-parallel, the loss is averaged over the
+        # sequences of all processes when the gradients are reduced.
+        loss_denominator = parallel.get_loss_denominator(batch_size)
+
+        # If gradients are accumulated over several batches, or a batch is
+        # split because it ran out of memory, each piece is run separately,
+        # and the loss is averaged over the sequences of all of them.
+        def run_micro_batch(micro_batch):
+            parts = None
+            try:
+                # Only the forward pass runs under autocast.
+                with get_autocast_context(args.precision, device):
+                    parts = get_loss_parts(
+                        saver.model,
+                        micro_batch,
+                        data,
+                        model_interface,
+                        device,
+                        reduction='none',
+                        label_smoothing=args.label_smoothing
+                    )
+                sequence_loss = get_sequence_losses(parts, len(micro_batch))
+                parts.cross_entropy = None
+                loss = torch.sum(sequence_loss) / loss_denominator
+                loss_numer = torch.sum(sequence_loss.detach()).item()
+                del sequence_loss
+                loss.backward()
+                del loss
+                return loss_numer, parts.num_symbols
+            except torch.cuda.OutOfMemoryError as e:
+                raise OutOfCUDAMemoryError(parts) from e
+
+        micro_batch_results, out_of_memory_splits = run_with_out_of_memory_recovery(
             batch,
-            data,
+            optimizer.zero_grad,
+            run_micro_batch,
             model_interface,
-            device,
-            reduction='none',
-            label_smoothing=args.label_smoothing
+            not args.no_out_of_memory_recovery
+        )
+        loss_numer = sum(r[0] for r in micro_batch_results)
+        num_symbols = sum(r[1] for r in micro_batch_results)
+    else:
+        # This data-parallel process has no batch in the last step of the
+        # epoch, but it must still take part in averaging the gradients.
+        optimizer.zero_grad()
+        loss_numer = 0.0
+        num_symbols = 0
+        batch_size = 0
+        out_of_memory_splits = []
+    loss_numer, num_symbols, batch_size = parallel.reduce_gradients(
+        saver.model,
+        loss_numer,
+        num_symbols,
+        batch_size
+    )
+    if args.gradient_clipping_threshold is not None:
+        torch.nn.utils.clip_grad_norm_(
+            saver.model.parameters(),
+            args.gradient_clipping_threshold
         )
-        sequence_loss = torch.sum(parts.cross_entropy, dim=1)
-        parts.cross_entropy = None
-        loss = torch.mean(sequence_loss)
-        loss_numer = torch.sum(sequence_loss.detach()).item()
-        del sequence_loss
-        loss.backward()
-        del loss
+    optimizer.step()
+    return ParameterUpdateResult(loss_numer, num_symbols, batch_size, out_of_memory_splits)
+
+def run_stacked_parameter_update(
+    trials,
+    batch,
+    model_interface,
+    data,
+    device,
+    args
+):
+    """Like :py:func:`run_parameter_update`, but update the parameters of
+    several trials at once by running them as one stacked model."""
+    for trial in trials:
+        trial.saver.model.train()
+    pad_index = len(data.target_output_vocab)
+    batch_size = len(batch)
+    num_trials = len(trials)
+
+    def zero_grad():
+        for trial in trials:
+            trial.optimizer.zero_grad()
+
+    def run_micro_batch(micro_batch):
+        try:
+            model_input, correct_target = prepare_batch(micro_batch, model_interface, device, data)
+            # is_symbol : B x m
+            is_symbol = correct_target != pad_index
+            # logits : K x N x V
+            with get_autocast_context(args.precision, device):
+                logits = get_stacked_logits_at(
+                    [trial.saver.model for trial in trials],
+                    model_interface,
+                    model_input,
+                    is_symbol
+                )
+            _, num_symbols, vocab_size = logits.size()
+            # cross_entropy : K x N
+            cross_entropy = torch.nn.functional.cross_entropy(
+                logits.float().reshape(num_trials * num_symbols, vocab_size),
+                correct_target[is_symbol].repeat(num_trials),
+                reduction='none',
+                label_smoothing=args.label_smoothing
+            ).view(num_trials, num_symbols)
+            del logits
+            # sequence_loss : K x B
+            sequence_loss = cross_entropy.new_zeros(num_trials, len(micro_batch)).index_add_(
+                1,
+                get_example_ids(model_input, correct_target)[is_symbol],
+                cross_entropy
+            )
+            del cross_entropy
+            # Summing the losses of the trials gives each trial's parameters
+            # the same gradient as its own loss would.
+            loss = torch.sum(sequence_loss) / batch_size
+            # loss_numers : K
+            loss_numers = torch.sum(sequence_loss.detach(), dim=1).to('cpu', torch.float64)
+            del sequence_loss
+            loss.backward()
+            del loss
+            return loss_numers, num_symbols
+        except torch.cuda.OutOfMemoryError as e:
+            raise OutOfCUDAMemoryError(None) from e
+
+    micro_batch_results, out_of_memory_splits = run_with_out_of_memory_recovery(
+        batch,
+        zero_grad,
+        run_micro_batch,
+        model_interface,
+        not args.no_out_of_memory_recovery
+    )
+    loss_numers = sum(r[0] for r in micro_batch_results)
+    num_symbols = sum(r[1] for r in micro_batch_results)
+    for trial in trials:
         if args.gradient_clipping_threshold is not None:
             torch.nn.utils.clip_grad_norm_(
-                saver.model.parameters(),
+                trial.saver.model.parameters(),
                 args.gradient_clipping_threshold
             )
-        optimizer.step()
-        return ParameterUpdateResult(loss_numer, parts.num_symbols)
-    except torch.cuda.OutOfMemoryError as e:
-        raise OutOfCUDAMemoryError(parts) from e
+        trial.optimizer.step()
+    return [
+        ParameterUpdateResult(loss_numer, num_symbols, batch_size, out_of_memory_splits)
+        for loss_numer in loss_numers.tolist()
+    ]
 
 @dataclasses.dataclass
 class ParameterUpdateResult:
     loss_numer: float
     num_symbols: int
+    batch_size: int
+    out_of_memory_splits: list[OutOfMemorySplit] = dataclasses.field(default_factory=list)
+    """The batches that ran out of memory and were split."""
 
 class LossAccumulator:
 
@@ -1,5 +1,7 @@
 import argparse
+import logging
 import pathlib
+import sys
 
 import more_itertools
 
@@ -13,6 +15,17 @@ from sequence_to_sequence.batcher import (
     add_batching_arguments,
     get_batcher
 )
+from sequence_to_sequence.calibration import (
+    add_calibration_arguments,
+    calibrate_decoding,
+    check_calibration_arguments
+)
+from sequence_to_sequence.precision import add_precision_arguments, get_autocast_context
+from sequence_to_sequence.compilation import (
+    add_compile_arguments,
+    check_compile_arguments,
+    compile_model
+)
 
 def main():
 
@@ -28,30 +41,55 @@ def main():
     parser.add_argument('--beam-size', type=int, required=True)
     parser.add_argument('--max-target-length', type=int, required=True)
     add_batching_arguments(parser)
+    add_calibration_arguments(parser)
+    add_precision_arguments(parser)
+    add_compile_arguments(parser)
     model_interface.add_arguments(parser)
     model_interface.add_forward_arguments(parser)
     add_vocabulary_arguments(parser)
     args = parser.parse_args()
+    check_calibration_arguments(parser, args)
+    check_compile_arguments(parser, args)
 
     device = model_interface.get_device(args)
     sources = load_prepared_data_file(args.input)
     vocabs = load_vocabularies(args, parser)
     saver = model_interface.construct_saver(args)
+    # Log to stderr, because the translations are written to stdout.
+    logger = logging.getLogger('main')
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.INFO)
+    if args.compile:
+        compile_model(model_interface, saver, args.compile_length_multiple, logger)
     model_interface.on_before_decode(saver, [sources], args.max_target_length)
-    batcher = get_batcher(parser, args, model_interface)
+    if args.batching_calibrate:
+        max_cost, _ = calibrate_decoding(
+            parser,
+            args,
+            saver,
+            model_interface,
+            vocabs,
+            device,
+            max(map(len, sources)),
+            logger
+        )
+    else:
+        max_cost = None
+    batcher = get_batcher(parser, args, model_interface, saver.kwargs, max_cost)
     batches = list(batcher.generate_source_batches(sources))
     del batcher
     ordered_outputs = [None] * len(sources)
     for batch in batches:
         source = model_interface.prepare_source([s for i, s in batch], device, vocabs)
-        output = model_interface.decode(
-            model=saver.model,
-            model_source=source,
-            bos_symbol=vocabs.target_input_vocab.bos_index,
-            beam_size=args.beam_size,
-            eos_symbol=vocabs.target_output_vocab.eos_index,
-            max_length=args.max_target_length
-        )
+        with get_autocast_context(args.precision, device):
+            output = model_interface.decode(
+                model=saver.model,
+                model_source=source,
+                bos_symbol=vocabs.target_input_vocab.bos_index,
+                beam_size=args.beam_size,
+                eos_symbol=vocabs.target_output_vocab.eos_index,
+                max_length=args.max_target_length
+            )
         for (i, s), output_sequence in more_itertools.zip_equal(batch, output):
             ordered_outputs[i] = output_sequence
     for output_sequence in ordered_outputs:
@@ -71,3 +71,13 @@ class UpdatesWithoutImprovement(EarlyStoppingCriterion):
             self.updates_since_improvement >= self.patience or
             not self.is_better(self.goal, value))
         return UpdateResult(is_best, should_stop)
+
+    def state_dict(self):
+        return dict(
+            best=self.best,
+            updates_since_improvement=self.updates_since_improvement
+        )
+
+    def load_state_dict(self, state_dict):
+        self.best = state_dict['best']
+        self.updates_since_improvement = state_dict['updates_since_improvement']
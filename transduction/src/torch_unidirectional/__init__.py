@@ -5,8 +5,8 @@ from .simple import (
     SimpleReshapingLayerUnidirectional
 )
 from .positional import PositionalUnidirectional
-from .composed import ComposedUnidirectional
-from .rnn import UnidirectionalSimpleRNN, UnidirectionalLSTM
+from .composed import ComposedUnidirectional, FrozenComposedUnidirectional
+from .rnn import UnidirectionalSimpleRNN, UnidirectionalLSTM, UnidirectionalGRU
 from .dropout import DropoutUnidirectional
 from .embedding import EmbeddingUnidirectional
 from .output import OutputUnidirectional
@@ -109,7 +109,14 @@ class ComposedUnidirectional(Unidirectional):
             ))
 
         def fastforward(self, input_sequence: torch.Tensor) -> Unidirectional.State:
-            return self.second_state.fastforward(self._get_first_outputs(input_sequence))
+            # Get the outputs and the new state of the first module in one
+            # pass, so that modules that can process the whole sequence at
+            # once do not step through it one timestep at a time.
+            first_output, first_state = _forward_with_state(self.first_state, input_sequence)
+            return ComposedUnidirectional.State(
+                first_state,
+                self.second_state.fastforward(first_output)
+            )
 
         def outputs(self,
             input_sequence: torch.Tensor,
@@ -174,6 +181,219 @@ class ComposedUnidirectional(Unidirectional):
             self.second.initial_state(batch_size, *second_args, **second_kwargs)
         )
 
+    def freeze(self) -> 'FrozenComposedUnidirectional':
+        """Get a flat equivalent of this module that is faster to call. See
+        :py:class:`FrozenComposedUnidirectional`."""
+        return FrozenComposedUnidirectional(self)
+
+class FrozenComposedUnidirectional:
+    r"""A flat equivalent of a tree of :py:class:`ComposedUnidirectional`\ s.
+
+    Every level of the tree works out which of its two children receive the
+    extra args and tag kwargs on every call, and every level adds a nested
+    state object, so generating one symbol at a time walks the whole tree
+    once per symbol. This walks the tree only once, and keeps the modules at
+    its leaves in order together with what they receive. Calls and states
+    then just loop over the leaves.
+
+    It can be called like a :py:class:`Unidirectional`, but it is not a
+    module itself, so it does not add anything to the parameters or state
+    dict of the model that it belongs to. It shares the leaves of the tree,
+    so it only needs to be frozen again if the structure of the tree
+    changes.
+    """
+
+    def __init__(self, module: ComposedUnidirectional):
+        self.is_main = 'main' in module._tags
+        # A list of (module, receives_args, tags) tuples. A module receives
+        # the extra args only if it and every composition between it and
+        # the root are tagged as main.
+        self.leaves = list(_get_frozen_leaves(module, True))
+
+    def __call__(self,
+        input_sequence: torch.Tensor,
+        *args: Any,
+        initial_state: Optional['FrozenComposedUnidirectional.State']=None,
+        return_state: bool=False,
+        include_first: bool=True,
+        tag_kwargs=None,
+        **kwargs: Any
+    ) -> Union[torch.Tensor, ForwardResult]:
+        if (args or kwargs) and not self.is_main:
+            raise ValueError('this module does not accept extra args or kwargs')
+        if initial_state is None and not return_state:
+            output = input_sequence
+            last_leaf_no = len(self.leaves) - 1
+            for leaf_no, leaf in enumerate(self.leaves):
+                leaf_args, leaf_kwargs = _get_leaf_args(leaf, args, kwargs, tag_kwargs, include_first)
+                output = leaf[0](
+                    output,
+                    *leaf_args,
+                    return_state=False,
+                    **leaf_kwargs
+                )
+                if leaf_no < last_leaf_no and not isinstance(output, torch.Tensor):
+                    # TODO Handle extra outputs.
+                    raise TypeError
+            return output
+        else:
+            if initial_state is not None:
+                if not isinstance(initial_state, self.State):
+                    raise TypeError(f'initial_state must be of type {self.State.__name__}')
+                state = initial_state
+            else:
+                state = self.initial_state(
+                    input_sequence.size(0),
+                    *args,
+                    tag_kwargs=tag_kwargs,
+                    **kwargs
+                )
+            return state.forward(
+                input_sequence,
+                return_state=return_state,
+                include_first=include_first
+            )
+
+    class State(Unidirectional.State):
+
+        states: list[Unidirectional.State]
+
+        def __init__(self, states: list[Unidirectional.State]):
+            self.states = states
+
+        def next(self, input_tensor: torch.Tensor) -> Unidirectional.State:
+            new_states = []
+            last_state_no = len(self.states) - 1
+            for state_no, state in enumerate(self.states):
+                state = state.next(input_tensor)
+                new_states.append(state)
+                if state_no < last_state_no:
+                    input_tensor = state.output()
+                    if not isinstance(input_tensor, torch.Tensor):
+                        # TODO Handle extra outputs.
+                        raise TypeError
+            return FrozenComposedUnidirectional.State(new_states)
+
+        def output(self) -> Union[torch.Tensor, tuple[torch.Tensor, ...]]:
+            return self.states[-1].output()
+
+        def detach(self) -> Unidirectional.State:
+            return FrozenComposedUnidirectional.State([s.detach() for s in self.states])
+
+        def batch_size(self) -> int:
+            return self.states[0].batch_size()
+
+        def slice_batch(self, s: slice) -> Unidirectional.State:
+            return FrozenComposedUnidirectional.State([x.slice_batch(s) for x in self.states])
+
+        def transform_tensors(self,
+            func: Callable[[torch.Tensor], torch.Tensor]
+        ) -> Unidirectional.State:
+            return FrozenComposedUnidirectional.State([
+                s.transform_tensors(func)
+                for s in self.states
+            ])
+
+        def fastforward(self, input_sequence: torch.Tensor) -> Unidirectional.State:
+            new_states = []
+            for state in self.states[:-1]:
+                input_sequence, state = _forward_with_state(state, input_sequence)
+                new_states.append(state)
+            new_states.append(self.states[-1].fastforward(input_sequence))
+            return FrozenComposedUnidirectional.State(new_states)
+
+        def outputs(self,
+            input_sequence: torch.Tensor,
+            include_first: bool
+        ) -> Union[Iterable[torch.Tensor], Iterable[tuple[torch.Tensor, ...]]]:
+            for state in self.states[:-1]:
+                # TODO Handle extra outputs.
+                input_sequence = _ensure_outputs_are_tensor(state.outputs(
+                    input_sequence,
+                    include_first=False
+                ))
+            return self.states[-1].outputs(input_sequence, include_first=include_first)
+
+        def forward(self,
+            input_sequence: torch.Tensor,
+            return_state: bool,
+            include_first: bool
+        ) -> Union[torch.Tensor, ForwardResult]:
+            output = input_sequence
+            extra_outputs = []
+            new_states = []
+            last_state_no = len(self.states) - 1
+            for state_no, state in enumerate(self.states):
+                result = state.forward(
+                    output,
+                    return_state=return_state,
+                    include_first=include_first if state_no == last_state_no else False
+                )
+                if isinstance(result, ForwardResult):
+                    output = result.output
+                    extra_outputs.extend(result.extra_outputs)
+                    if return_state:
+                        assert result.state is not None
+                        new_states.append(result.state)
+                else:
+                    assert not return_state
+                    output = result
+            if return_state:
+                return ForwardResult(
+                    output,
+                    extra_outputs,
+                    FrozenComposedUnidirectional.State(new_states)
+                )
+            else:
+                return _unwrap_output_tensor(ForwardResult(output, extra_outputs, None))
+
+    def initial_state(self, batch_size, *args, tag_kwargs=None, **kwargs):
+        if (args or kwargs) and not self.is_main:
+            raise ValueError('this module does not accept extra args or kwargs')
+        states = []
+        for leaf in self.leaves:
+            leaf_args, leaf_kwargs = _get_leaf_args(leaf, args, kwargs, tag_kwargs, None)
+            states.append(leaf[0].initial_state(batch_size, *leaf_args, **leaf_kwargs))
+        return self.State(states)
+
+def _get_frozen_leaves(module, receives_args):
+    if isinstance(module, ComposedUnidirectional):
+        for child in (module.first, module.second):
+            yield from _get_frozen_leaves(child, receives_args and 'main' in child._tags)
+    else:
+        yield module, receives_args, tuple(module._tags)
+
+def _get_leaf_args(leaf, args, kwargs, tag_kwargs, include_first):
+    # This is the same as get_args(), except that whether the module
+    # receives the extra args was worked out in advance.
+    module, receives_args, tags = leaf
+    result_args = ()
+    result_kwargs = dict(include_first=False) if include_first is not None else {}
+    if receives_args:
+        result_args = args
+        if include_first is not None:
+            result_kwargs['include_first'] = include_first
+        result_kwargs.update(kwargs)
+    if tag_kwargs:
+        for tag in tags:
+            if tag in tag_kwargs:
+                result_kwargs.update(tag_kwargs[tag])
+    return result_args, result_kwargs
+
+def _forward_with_state(
+    state: Unidirectional.State,
+    input_sequence: torch.Tensor
+) -> tuple[torch.Tensor, Unidirectional.State]:
+    # Feed a sequence to a state and return both its outputs and the
+    # resulting state.
+    if input_sequence.size(1) == 0:
+        return input_sequence, state
+    result = state.forward(input_sequence, return_state=True, include_first=False)
+    assert isinstance(result, ForwardResult)
+    assert result.state is not None
+    # TODO Handle extra outputs.
+    return result.output, result.state
+
 def _ensure_outputs_are_tensor(x):
     if isinstance(x, torch.Tensor):
         return x
@@ -106,8 +106,25 @@ class ResidualUnidirectional(Unidirectional):
             include_first: bool
         ) -> Union[torch.Tensor, ForwardResult]:
             if return_state:
-                # TODO
-                raise NotImplementedError
+                wrapped_result = self.wrapped_state.forward(
+                    input_sequence,
+                    return_state=True,
+                    include_first=include_first
+                )
+                if input_sequence.size(1) == 0:
+                    last_input = self.input_tensor
+                else:
+                    last_input = input_sequence[:, -1]
+                if include_first:
+                    input_sequence = torch.concat([
+                        self._get_input_tensor()[:, None],
+                        input_sequence
+                    ], dim=1)
+                return ForwardResult(
+                    input_sequence + wrapped_result.output,
+                    wrapped_result.extra_outputs,
+                    ResidualUnidirectional.State(last_input, wrapped_result.state)
+                )
             else:
                 return self.outputs(input_sequence, include_first)
 
@@ -3,7 +3,7 @@ from typing import Any, Literal, Optional
 
 import torch
 
-from .unidirectional import Unidirectional
+from .unidirectional import Unidirectional, ForwardResult
 
 class UnidirectionalBuiltinRNN(Unidirectional):
     """Wraps a built-in PyTorch RNN class in the :py:class:`Unidirectional`
@@ -58,10 +58,46 @@ class UnidirectionalBuiltinRNN(Unidirectional):
     ) -> Any:
         raise NotImplementedError
 
+    def _initial_hidden_tensor(self,
+        batch_size: int,
+        first_layer: Optional[torch.Tensor]
+    ) -> torch.Tensor:
+        # The initial tensor is a tensor of all the hidden states of all layers
+        # before the first timestep.
+        # Its size needs to be num_layers x batch_size x hidden_units, where
+        # index 0 is the first layer and -1 is the last layer.
+        # Note that the batch dimension is always the second dimension even
+        # when batch_first=True.
+        if first_layer is None:
+            h = torch.zeros(
+                self._layers,
+                batch_size,
+                self._hidden_units,
+                device=next(self.parameters()).device
+            )
+        else:
+            expected_size = (batch_size, self._hidden_units)
+            if first_layer.size() != expected_size:
+                raise ValueError(
+                    f'first_layer should be of size {expected_size}, but '
+                    f'got {first_layer.size()}')
+            h = torch.cat([
+                first_layer[None],
+                torch.zeros(
+                    self._layers - 1,
+                    batch_size,
+                    self._hidden_units,
+                    device=next(self.parameters()).device
+                )
+            ], dim=0)
+        return h
+
     def _apply_to_hidden_state(self,
         hidden_state: Any,
         func: Callable[[torch.Tensor], torch.Tensor]
     ) -> Any:
+        r"""Apply a function that operates on the batch dimension to every
+        tensor in the hidden state."""
         raise NotImplementedError
 
     class State(Unidirectional.State):
@@ -90,9 +126,6 @@ class UnidirectionalBuiltinRNN(Unidirectional):
         def batch_size(self):
             return self._output.size(0)
 
-        def slice_batch(self, s):
-            return self.transform_tensors(lambda x: x[..., s, :].contiguous())
-
         def transform_tensors(self, func):
             return self.rnn.State(
                 self.rnn,
@@ -102,12 +135,10 @@ class UnidirectionalBuiltinRNN(Unidirectional):
         def fastforward(self, input_sequence):
             """This method is overridden to use the builtin RNN class
             efficiently."""
-            input_tensors = input_sequence.transpose(0, 1)
-            output_sequence, state = self.forward(
-                input_tensors,
+            return self.forward(
+                input_sequence,
                 return_state=True,
-                include_first=False)
-            return state
+                include_first=False).state
 
         def outputs(self, input_sequence, include_first):
             """This method is overridden to use the builtin RNN class
@@ -132,7 +163,7 @@ class UnidirectionalBuiltinRNN(Unidirectional):
                     batch_size, hidden_units = first_output.size()
                     output_sequence = first_output.new_empty(batch_size, 0, hidden_units)
                 if return_state:
-                    return output_sequence, self
+                    return ForwardResult(output_sequence, [], self)
                 else:
                     return output_sequence
             # output_sequence : batch_size x sequence_length x hidden_units
@@ -155,7 +186,7 @@ class UnidirectionalBuiltinRNN(Unidirectional):
                 # last_output : batch_size x hidden_units
                 last_output = output_sequence[:, -1, :]
                 state = self.rnn.State(self.rnn, new_hidden_state, last_output)
-                return output_sequence, state
+                return ForwardResult(output_sequence, [], state)
             else:
                 return output_sequence
 
@@ -213,38 +244,11 @@ class UnidirectionalSimpleRNN(UnidirectionalBuiltinRNN):
     RNN_CLASS = torch.nn.RNN
 
     def _initial_tensors(self, batch_size, first_layer):
-        # The initial tensor is a tensor of all the hidden states of all layers
-        # before the first timestep.
-        # Its size needs to be num_layers x batch_size x hidden_units, where
-        # index 0 is the first layer and -1 is the last layer.
-        # Note that the batch dimension is always the second dimension even
-        # when batch_first=True.
-        if first_layer is None:
-            h = torch.zeros(
-                self._layers,
-                batch_size,
-                self._hidden_units,
-                device=next(self.parameters()).device
-            )
-        else:
-            expected_size = (batch_size, self._hidden_units)
-            if first_layer.size() != expected_size:
-                raise ValueError(
-                    f'first_layer should be of size {expected_size}, but '
-                    f'got {first_layer.size()}')
-            h = torch.cat([
-                first_layer[None],
-                torch.zeros(
-                    self._layers - 1,
-                    batch_size,
-                    self._hidden_units,
-                    device=next(self.parameters()).device
-                )
-            ], dim=0)
+        h = self._initial_hidden_tensor(batch_size, first_layer)
         return h, h[-1]
 
     def _apply_to_hidden_state(self, hidden_state, func):
-        return func(hidden_state)
+        return _apply_to_batch(func, hidden_state)
 
 class UnidirectionalLSTM(UnidirectionalBuiltinRNN):
     """An LSTM wrapped in the :py:class:`Unidirectional` API."""
@@ -312,7 +316,58 @@ class UnidirectionalLSTM(UnidirectionalBuiltinRNN):
         return (h, c), h[-1]
 
     def _apply_to_hidden_state(self, hidden_state, func):
-        return tuple(map(func, hidden_state))
+        return tuple(_apply_to_batch(func, x) for x in hidden_state)
+
+class UnidirectionalGRU(UnidirectionalBuiltinRNN):
+    """A GRU wrapped in the :py:class:`Unidirectional` API."""
+
+    def __init__(self,
+        input_size: int,
+        hidden_units: int,
+        layers: int=1,
+        dropout: Optional[float]=None,
+        bias: bool=True,
+        use_extra_bias: bool=True
+    ):
+        """
+        :param input_size: The size of the input vectors to the GRU.
+        :param hidden_units: The number of hidden units in each layer.
+        :param layers: The number of layers in the GRU.
+        :param dropout: The amount of dropout applied in between layers. If
+            ``layers`` is 1, then this value is ignored.
+        :param bias: Whether to use bias terms.
+        :param use_extra_bias: Unlike in the other RNNs, not all of the extra
+            bias terms of the built-in PyTorch implementation of the GRU are
+            redundant, since the one for the candidate activation is
+            multiplied by the reset gate. So, they are kept by default. If
+            this is false, they are removed anyway.
+        """
+        super().__init__(
+            input_size=input_size,
+            hidden_units=hidden_units,
+            layers=layers,
+            dropout=dropout,
+            bias=bias,
+            use_extra_bias=use_extra_bias
+        )
+
+    RNN_CLASS = torch.nn.GRU
+
+    def _initial_tensors(self, batch_size, first_layer):
+        h = self._initial_hidden_tensor(batch_size, first_layer)
+        return h, h[-1]
+
+    def _apply_to_hidden_state(self, hidden_state, func):
+        return _apply_to_batch(func, hidden_state)
+
+def _apply_to_batch(
+    func: Callable[[torch.Tensor], torch.Tensor],
+    hidden_tensor: torch.Tensor
+) -> torch.Tensor:
+    # hidden_tensor : num_layers x batch_size x hidden_units
+    # The batch dimension of the hidden state is the second one, even when
+    # batch_first=True, so move it to the front while func is applied.
+    return func(hidden_tensor.transpose(0, 1)).transpose(0, 1).contiguous()
 
 def remove_extra_bias_parameters(module: torch.nn.Module):
     pairs = [
@@ -149,7 +149,7 @@ class SimpleUnidirectional(Unidirectional):
                     state = self.parent.State(
                         self.parent,
                         input_sequence[:, -1],
-                        self._batch_size,
+                        None,
                         self.args,
                         self.kwargs
                     )
@@ -1,4 +1,7 @@
-from collections.abc import Callable, Iterable
+from collections.abc import Callable
+import dataclasses
+import inspect
+import math
 from typing import Optional, Union
 
 import torch
@@ -11,7 +14,7 @@ from torch_unidirectional import (
 
 from .positional_encodings import SinusoidalPositionalEncodingCacher
 from .input_layer import get_transformer_input_unidirectional
-from .mask import make_causal_attention_mask
+from .mask import CausalAttentionMaskCacher, make_segment_attention_mask
 
 def get_transformer_decoder(
     input_vocabulary_size: int,
@@ -24,7 +27,8 @@ def get_transformer_decoder(
     feedforward_size: int,
     dropout: float,
     use_padding: bool,
-    tag: Optional[str]=None
+    tag: Optional[str]=None,
+    causal_mask_cacher: Optional[CausalAttentionMaskCacher]=None
 ) -> Unidirectional:
     return (
         get_transformer_input_unidirectional(
@@ -41,7 +45,8 @@ def get_transformer_decoder(
             num_heads=num_heads,
             feedforward_size=feedforward_size,
             dropout=dropout,
-            use_final_layer_norm=True
+            use_final_layer_norm=True,
+            causal_mask_cacher=causal_mask_cacher
         ), tag) |
         OutputUnidirectional(
             input_size=d_model,
@@ -50,6 +55,12 @@ def get_transformer_decoder(
         )
     )
 
+# Unless it is told whether the target mask is causal, the decoder in PyTorch
+# 2 finds out by comparing it with a new causal mask, which waits for the
+# device and breaks graphs under torch.compile. Older versions do not have
+# this argument.
+_DECODER_HAS_IS_CAUSAL = 'tgt_is_causal' in inspect.signature(torch.nn.TransformerDecoder.forward).parameters
+
 def add_tag(model, tag):
     if tag is None:
         return model.main()
@@ -64,7 +75,8 @@ class TransformerDecoderLayers(Unidirectional):
         num_heads: int,
         feedforward_size: int,
         dropout: float,
-        use_final_layer_norm: bool
+        use_final_layer_norm: bool,
+        causal_mask_cacher: Optional[CausalAttentionMaskCacher]=None
     ):
         super().__init__()
         self.layers = torch.nn.TransformerDecoder(
@@ -79,12 +91,17 @@ class TransformerDecoderLayers(Unidirectional):
             num_layers=num_layers,
             norm=torch.nn.LayerNorm(d_model) if use_final_layer_norm else None
         )
+        if causal_mask_cacher is None:
+            causal_mask_cacher = CausalAttentionMaskCacher()
+        self.causal_mask_cacher = causal_mask_cacher
 
     def forward(self,
         input_sequence: torch.Tensor,
         encoder_sequence: torch.Tensor,
         input_is_padding_mask: Optional[torch.Tensor]=None,
         encoder_is_padding_mask: Optional[torch.Tensor]=None,
+        input_segment_ids: Optional[torch.Tensor]=None,
+        encoder_segment_ids: Optional[torch.Tensor]=None,
         initial_state: Optional[Unidirectional.State]=None,
         return_state: bool=False,
         include_first: bool=True
@@ -99,6 +116,14 @@ class TransformerDecoderLayers(Unidirectional):
             occurs at the end of a sequence, then providing this mask is not
             necessary, because the attention mechanism is causally masked
             anyway.
+        :param input_segment_ids: If several sequences are packed into each
+            row of the batch, an integer tensor giving the index within its
+            row of the target sequence that each decoder input belongs to, or
+            -1 for padding. Must be given together with
+            ``encoder_segment_ids``.
+        :param encoder_segment_ids: Like ``input_segment_ids``, but for the
+            encoder output. Each target sequence only attends to the source
+            sequence with the same index.
         """
         if initial_state is not None:
             # TODO
@@ -108,110 +133,438 @@ class TransformerDecoderLayers(Unidirectional):
             raise NotImplementedError
         if include_first:
             raise ValueError('include_first must be False')
-        return self.layers(
-            tgt=input_sequence,
-            memory=encoder_sequence,
-            tgt_mask=make_causal_attention_mask(
+        if input_segment_ids is not None:
+            num_heads = self.layers.layers[0].self_attn.num_heads
+            tgt_mask = make_segment_attention_mask(
+                input_segment_ids,
+                input_segment_ids,
+                num_heads,
+                causal=True
+            )
+            memory_mask = make_segment_attention_mask(
+                input_segment_ids,
+                encoder_segment_ids,
+                num_heads,
+                causal=False
+            )
+            is_causal = False
+        else:
+            tgt_mask = self.causal_mask_cacher.get_mask(
                 sequence_length=input_sequence.size(1),
                 device=input_sequence.device,
                 dtype=input_sequence.dtype
-            ),
+            )
+            memory_mask = None
+            is_causal = True
+        if _DECODER_HAS_IS_CAUSAL:
+            is_causal_kwargs = dict(tgt_is_causal=is_causal)
+        else:
+            is_causal_kwargs = {}
+        return self.layers(
+            tgt=input_sequence,
+            memory=encoder_sequence,
+            tgt_mask=tgt_mask,
+            memory_mask=memory_mask,
             tgt_key_padding_mask=input_is_padding_mask,
-            memory_key_padding_mask=encoder_is_padding_mask
+            memory_key_padding_mask=encoder_is_padding_mask,
+            **is_causal_kwargs
+        )
+
+    def _forward_step(self,
+        input_tensor: torch.Tensor,
+        encoder_memory: 'EncoderMemory',
+        encoder_groups: Optional['AttentionGroups'],
+        self_attention_keys: list[torch.Tensor],
+        self_attention_values: list[torch.Tensor]
+    ) -> tuple[torch.Tensor, list[torch.Tensor], list[torch.Tensor]]:
+        r"""Compute the output for a single new decoder position, reusing the
+        cached self-attention keys and values of all previous positions and
+        the precomputed cross-attention keys and values of the encoder.
+
+        :param input_tensor: A :math:`B \times d` tensor for the new position.
+        :param encoder_memory: The precomputed cross-attention inputs for
+            :math:`B'` source sequences.
+        :param encoder_groups: If not ``None``, describes which of the
+            :math:`B'` source sequences each of the :math:`B` batch elements
+            attends to. Otherwise, :math:`B' = B`, and batch element
+            :math:`i` attends to source sequence :math:`i`.
+        :param self_attention_keys: For each layer, a
+            :math:`B \times h \times t \times d_h` tensor of the keys of the
+            :math:`t` previous positions.
+        :param self_attention_values: Like ``self_attention_keys``, but for
+            values.
+        :return: The :math:`B \times d` output for the new position, and the
+            per-layer keys and values extended to :math:`t+1` positions.
+        """
+        # x : B x 1 x d_model
+        x = input_tensor[:, None, :]
+        new_keys = []
+        new_values = []
+        for layer, keys, values, layer_encoder_keys, layer_encoder_values in zip(
+            self.layers.layers,
+            self_attention_keys,
+            self_attention_values,
+            encoder_memory.keys,
+            encoder_memory.values
+        ):
+            # This follows torch.nn.TransformerDecoderLayer with
+            # norm_first=True, except that the self-attention sublayer only
+            # computes the query, key, and value of the new position, and the
+            # cross-attention sublayer only computes the query.
+            self_attention_input = layer.norm1(x)
+            key, value = _project_keys_and_values(layer.self_attn, self_attention_input)
+            # keys, values : B x h x (t+1) x d_h
+            keys = torch.concat([keys, key], dim=2)
+            values = torch.concat([values, value], dim=2)
+            # Since the new position is the last one, causal masking is
+            # unnecessary.
+            x = x + layer.dropout1(_attend(
+                layer.self_attn,
+                self_attention_input,
+                keys,
+                values,
+                None,
+                None
+            ))
+            x = x + layer.dropout2(_attend(
+                layer.multihead_attn,
+                layer.norm2(x),
+                layer_encoder_keys,
+                layer_encoder_values,
+                encoder_memory.attention_mask,
+                encoder_groups
+            ))
+            x = x + layer._ff_block(layer.norm3(x))
+            new_keys.append(keys)
+            new_values.append(values)
+        if self.layers.norm is not None:
+            x = self.layers.norm(x)
+        return x.squeeze(1), new_keys, new_values
+
+    def _get_encoder_memory(self,
+        encoder_sequence: torch.Tensor,
+        encoder_is_padding_mask: Optional[torch.Tensor]
+    ) -> 'EncoderMemory':
+        keys = []
+        values = []
+        for layer in self.layers.layers:
+            layer_keys, layer_values = _project_keys_and_values(
+                layer.multihead_attn,
+                encoder_sequence
+            )
+            keys.append(layer_keys)
+            values.append(layer_values)
+        return EncoderMemory(
+            keys,
+            values,
+            _get_additive_attention_mask(encoder_is_padding_mask, encoder_sequence.dtype)
         )
 
     class State(Unidirectional.State):
 
         decoder: 'TransformerDecoderLayers'
-        encoder_sequence: torch.Tensor
-        encoder_is_padding_mask: torch.Tensor
-        previous_inputs: torch.Tensor
+        encoder_memory: 'EncoderMemory'
+        encoder_indexes: Optional[torch.Tensor]
+        encoder_groups: Optional['AttentionGroups']
+        self_attention_keys: list[torch.Tensor]
+        self_attention_values: list[torch.Tensor]
+        _output: Optional[torch.Tensor]
 
         def __init__(self,
             decoder: 'TransformerDecoderLayers',
-            encoder_sequence: torch.Tensor,
-            encoder_is_padding_mask: torch.Tensor,
-            previous_inputs: torch.Tensor
+            encoder_memory: 'EncoderMemory',
+            encoder_indexes: Optional[torch.Tensor],
+            encoder_groups: Optional['AttentionGroups'],
+            self_attention_keys: list[torch.Tensor],
+            self_attention_values: list[torch.Tensor],
+            output: Optional[torch.Tensor]
         ):
             super().__init__()
             self.decoder = decoder
-            self.encoder_sequence = encoder_sequence
-            self.encoder_is_padding_mask = encoder_is_padding_mask
-            self.previous_inputs = previous_inputs
+            # The cross-attention keys and values of the encoder output are
+            # computed once for every layer when the initial state is
+            # created, since they do not change from one timestep to the next.
+            # They are stored once per source sequence and are never
+            # rearranged by transform_tensors(). Instead, encoder_indexes
+            # maps each batch element to the source sequence it attends to
+            # (None means the identity mapping), so that many batch elements
+            # (e.g. beam items) can share one copy of the encoder output.
+            self.encoder_memory = encoder_memory
+            self.encoder_indexes = encoder_indexes
+            self.encoder_groups = encoder_groups
+            # The keys and values of all previous inputs are cached for every
+            # layer, so each call to next() only needs to compute one new
+            # position instead of re-running the decoder on the whole prefix.
+            self.self_attention_keys = self_attention_keys
+            self.self_attention_values = self_attention_values
+            self._output = output
 
         def next(self, input_tensor: torch.Tensor) -> Unidirectional.State:
+            output, keys, values = self.decoder._forward_step(
+                input_tensor,
+                self.encoder_memory,
+                self.encoder_groups,
+                self.self_attention_keys,
+                self.self_attention_values
+            )
             return TransformerDecoderLayers.State(
                 self.decoder,
-                self.encoder_sequence,
-                self.encoder_is_padding_mask,
-                # Simply concatenate this input to the tensor of all previous
-                # inputs.
-                torch.concat([
-                    self.previous_inputs,
-                    input_tensor[:, None, :]
-                ], dim=1)
+                self.encoder_memory,
+                self.encoder_indexes,
+                self.encoder_groups,
+                keys,
+                values,
+                output
             )
 
         def output(self) -> Union[torch.Tensor, tuple[torch.Tensor, ...]]:
-            # TODO This is very inefficient
             # NOTE This assumes there is no padding in the decoder input
-            full_output = self.decoder.forward(
-                self.previous_inputs,
-                self.encoder_sequence,
-                encoder_is_padding_mask=self.encoder_is_padding_mask,
-                include_first=False
+            if self._output is None:
+                raise ValueError(
+                    'initial state of TransformerDecoderLayers does not have '
+                    'an output'
+                )
+            return self._output
+
+        def detach(self) -> Unidirectional.State:
+            return TransformerDecoderLayers.State(
+                self.decoder,
+                self.encoder_memory.detach(),
+                self.encoder_indexes,
+                self.encoder_groups,
+                [x.detach() for x in self.self_attention_keys],
+                [x.detach() for x in self.self_attention_values],
+                self._output.detach() if self._output is not None else None
             )
-            return full_output[:, -1]
 
         def batch_size(self) -> int:
-            return self.previous_inputs.size(0)
+            return self.self_attention_keys[0].size(0)
 
         def transform_tensors(self,
             func: Callable[[torch.Tensor], torch.Tensor]
         ) -> Unidirectional.State:
+            # Only the tensors that belong to individual batch elements are
+            # passed through func. The encoder memory is shared, so instead
+            # func is used to rearrange the indexes into it.
+            if self.encoder_indexes is None:
+                encoder_indexes = torch.arange(
+                    self.batch_size(),
+                    device=self.self_attention_keys[0].device
+                )
+            else:
+                encoder_indexes = self.encoder_indexes
+            encoder_indexes = func(encoder_indexes)
             return TransformerDecoderLayers.State(
                 self.decoder,
-                func(self.encoder_sequence),
-                func(self.encoder_is_padding_mask),
-                func(self.previous_inputs)
+                self.encoder_memory,
+                encoder_indexes,
+                _get_attention_groups(encoder_indexes, self.encoder_memory.batch_size()),
+                [func(x) for x in self.self_attention_keys],
+                [func(x) for x in self.self_attention_values],
+                func(self._output) if self._output is not None else None
             )
 
-        # TODO
-
-        def fastforward(self, input_sequence: torch.Tensor) -> Unidirectional.State:
-            raise NotImplementedError
-
-        def states(self,
-            input_sequence: torch.Tensor,
-            include_first: bool
-        ) -> Iterable[Unidirectional.State]:
-            raise NotImplementedError
-
-        def outputs(self,
-            input_sequence: torch.Tensor,
-            include_first: bool
-        ) -> Union[Iterable[torch.Tensor], Iterable[tuple[torch.Tensor, ...]]]:
-            raise NotImplementedError
-
-        def forward(self,
-            input_sequence: torch.Tensor,
-            return_state: bool,
-            include_first: bool
-        ) -> Union[torch.Tensor, ForwardResult]:
-            raise NotImplementedError
-
     def initial_state(self,
         batch_size: int,
         encoder_sequence: torch.Tensor,
-        encoder_is_padding_mask: torch.Tensor
+        encoder_is_padding_mask: Optional[torch.Tensor]
     ) -> Unidirectional.State:
+        empty_cache = [
+            encoder_sequence.new_empty((
+                batch_size,
+                layer.self_attn.num_heads,
+                0,
+                layer.self_attn.head_dim
+            ))
+            for layer in self.layers.layers
+        ]
         return self.State(
             self,
-            encoder_sequence,
-            encoder_is_padding_mask,
-            torch.empty(
-                (batch_size, 0, encoder_sequence.size(2)),
-                dtype=encoder_sequence.dtype,
-                device=encoder_sequence.device
-            )
+            self._get_encoder_memory(encoder_sequence, encoder_is_padding_mask),
+            None,
+            None,
+            empty_cache,
+            list(empty_cache),
+            None
         )
+
+@dataclasses.dataclass
+class EncoderMemory:
+    r"""The cross-attention inputs of a batch of :math:`B'` source sequences
+    of length :math:`m`, precomputed for every decoder layer."""
+
+    keys: list[torch.Tensor]
+    r"""For each layer, a :math:`B' \times h \times m \times d_h` tensor."""
+    values: list[torch.Tensor]
+    r"""For each layer, a :math:`B' \times h \times m \times d_h` tensor."""
+    attention_mask: Optional[torch.Tensor]
+    r"""An optional additive :math:`B' \times 1 \times 1 \times m` mask."""
+
+    def batch_size(self) -> int:
+        return self.keys[0].size(0)
+
+    def detach(self) -> 'EncoderMemory':
+        return EncoderMemory(
+            [x.detach() for x in self.keys],
+            [x.detach() for x in self.values],
+            self.attention_mask.detach() if self.attention_mask is not None else None
+        )
+
+@dataclasses.dataclass
+class AttentionGroups:
+    r"""Describes how :math:`B` queries are grouped by the :math:`B'` sets of
+    keys and values they attend to, so that attention can be computed without
+    copying the keys and values for every query."""
+
+    indexes: torch.Tensor
+    r"""A :math:`B` tensor of ints in :math:`[0, B')` indicating the group of
+    each query."""
+    slots: torch.Tensor
+    r"""A :math:`B` tensor indicating the position of each query within its
+    group."""
+    num_slots: int
+    r"""The size of the largest group."""
+
+def _get_attention_groups(indexes: torch.Tensor, num_groups: int) -> AttentionGroups:
+    # indexes : B of ints in [0, num_groups)
+    num_indexes, = indexes.size()
+    if num_indexes == 0:
+        return AttentionGroups(indexes, indexes, 0)
+    sorted_indexes, order = torch.sort(indexes, stable=True)
+    # counts, starts : num_groups
+    counts = torch.bincount(indexes, minlength=num_groups)
+    starts = torch.cumsum(counts, dim=0) - counts
+    slots = torch.empty_like(indexes)
+    slots[order] = torch.arange(num_indexes, device=indexes.device) - starts[sorted_indexes]
+    return AttentionGroups(indexes, slots, counts.max().item())
+
+def _split_heads(
+    attention: torch.nn.MultiheadAttention,
+    x: torch.Tensor
+) -> torch.Tensor:
+    # x : B x n x d_model
+    # return : B x h x n x d_h
+    batch_size, sequence_length, _ = x.size()
+    return x.view(
+        batch_size,
+        sequence_length,
+        attention.num_heads,
+        attention.head_dim
+    ).transpose(1, 2)
+
+def _project_keys_and_values(
+    attention: torch.nn.MultiheadAttention,
+    input_sequence: torch.Tensor
+) -> tuple[torch.Tensor, torch.Tensor]:
+    r"""Apply the key and value projections of an attention module.
+
+    :param input_sequence: A :math:`B \times n \times d` tensor.
+    :return: Two :math:`B \times h \times n \times d_h` tensors containing the
+        keys and values.
+    """
+    d_model = attention.embed_dim
+    weight = attention.in_proj_weight[d_model:]
+    bias = attention.in_proj_bias
+    if bias is not None:
+        bias = bias[d_model:]
+    keys, values = torch.nn.functional.linear(input_sequence, weight, bias).chunk(2, dim=-1)
+    return _split_heads(attention, keys), _split_heads(attention, values)
+
+def _attend(
+    attention: torch.nn.MultiheadAttention,
+    input_sequence: torch.Tensor,
+    keys: torch.Tensor,
+    values: torch.Tensor,
+    mask: Optional[torch.Tensor],
+    groups: Optional[AttentionGroups]
+) -> torch.Tensor:
+    r"""Apply the query projection, attention, and output projection of an
+    attention module to precomputed keys and values.
+
+    :param input_sequence: A :math:`B \times n \times d` tensor from which the
+        queries are computed.
+    :param keys: A :math:`B' \times h \times m \times d_h` tensor.
+    :param values: A :math:`B' \times h \times m \times d_h` tensor.
+    :param mask: An optional additive mask that can be broadcast to
+        :math:`B' \times h \times n \times m`.
+    :param groups: If not ``None``, indicates which of the :math:`B'` sets of
+        keys and values each of the :math:`B` queries attends to. Otherwise,
+        :math:`B' = B`.
+    :return: A :math:`B \times n \times d` tensor.
+    """
+    batch_size, sequence_length, d_model = input_sequence.size()
+    num_heads = attention.num_heads
+    head_dim = attention.head_dim
+    bias = attention.in_proj_bias
+    if bias is not None:
+        bias = bias[:d_model]
+    # query : B x h x n x d_h
+    query = _split_heads(attention, torch.nn.functional.linear(
+        input_sequence,
+        attention.in_proj_weight[:d_model],
+        bias
+    ))
+    if groups is not None:
+        # Move the queries into a B' x h x (num_slots * n) x d_h tensor, so
+        # each group of queries can attend to its keys and values in one
+        # batched matrix multiplication.
+        num_groups = keys.size(0)
+        grouped_query = query.new_zeros((
+            num_groups,
+            groups.num_slots,
+            num_heads,
+            sequence_length,
+            head_dim
+        ))
+        grouped_query[groups.indexes, groups.slots] = query
+        query = grouped_query.transpose(1, 2).reshape(
+            num_groups,
+            num_heads,
+            groups.num_slots * sequence_length,
+            head_dim
+        )
+    # scores : B' x h x n' x m
+    scores = torch.matmul(query / math.sqrt(head_dim), keys.transpose(2, 3))
+    if mask is not None:
+        scores = scores + mask
+    weights = torch.nn.functional.dropout(
+        torch.softmax(scores, dim=-1),
+        p=attention.dropout,
+        training=attention.training
+    )
+    # output : B' x h x n' x d_h
+    output = torch.matmul(weights, values)
+    if groups is not None:
+        # output : B x h x n x d_h
+        output = output.view(
+            num_groups,
+            num_heads,
+            groups.num_slots,
+            sequence_length,
+            head_dim
+        ).transpose(1, 2)[groups.indexes, groups.slots]
+    # output : B x n x d_model
+    output = output.transpose(1, 2).reshape(
+        batch_size,
+        sequence_length,
+        d_model
+    )
+    return attention.out_proj(output)
+
+def _get_additive_attention_mask(
+    is_padding_mask: Optional[torch.Tensor],
+    dtype: torch.dtype
+) -> Optional[torch.Tensor]:
+    # is_padding_mask : B x m
+    # return : B x 1 x 1 x m
+    # Like torch.nn.MultiheadAttention, a boolean mask is true for positions
+    # that should be ignored, and any other mask is added to the attention
+    # logits as-is.
+    if is_padding_mask is None:
+        return None
+    if is_padding_mask.dtype == torch.bool:
+        mask = torch.zeros(is_padding_mask.size(), dtype=dtype, device=is_padding_mask.device)
+        mask.masked_fill_(is_padding_mask, -math.inf)
+    else:
+        mask = is_padding_mask.to(dtype)
+    return mask[:, None, None, :]
@@ -6,6 +6,7 @@ from torch_extras.compose import Composable
 
 from .positional_encodings import SinusoidalPositionalEncodingCacher
 from .input_layer import get_transformer_input_unidirectional
+from .mask import make_segment_attention_mask
 
 def get_transformer_encoder(
     vocabulary_size: int,
@@ -29,7 +30,7 @@ def get_transformer_encoder(
                 shared_embeddings,
                 positional_encoding_cacher
             )
-        ).kwargs(include_first=False) |
+        ).kwargs(include_first=False).tag('input') |
         add_tag(Composable(
             TransformerEncoderLayers(
                 num_layers,
@@ -75,5 +76,24 @@ class TransformerEncoderLayers(torch.nn.Module):
             enable_nested_tensor=enable_nested_tensor
         )
 
-    def forward(self, source_sequence, is_padding_mask=None):
-        return self.layers(source_sequence, src_key_padding_mask=is_padding_mask)
+    def forward(self, source_sequence, is_padding_mask=None, segment_ids=None):
+        """
+        :param segment_ids: If several sequences are packed into each row of
+            the batch, an integer tensor giving the index within its row of
+            the sequence that each position belongs to, or -1 for padding.
+            Positions only attend to positions in the same sequence.
+        """
+        if segment_ids is not None:
+            attention_mask = make_segment_attention_mask(
+                segment_ids,
+                segment_ids,
+                self.layers.layers[0].self_attn.num_heads,
+                causal=False
+            )
+        else:
+            attention_mask = None
+        return self.layers(
+            source_sequence,
+            mask=attention_mask,
+            src_key_padding_mask=is_padding_mask
+        )
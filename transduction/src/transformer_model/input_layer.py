@@ -40,6 +40,34 @@ class SinusoidalPositionalEncodingLayer(PositionalUnidirectional):
             cacher = SinusoidalPositionalEncodingCacher()
         self.cacher = cacher
 
+    def forward(self, input_sequence, *args, positions=None, **kwargs):
+        r"""Like :py:meth:`Unidirectional.forward`, but with the option of
+        giving the position of every input explicitly.
+
+        :param positions: An optional :math:`B \times n` integer tensor of
+            positions. This is used when several sequences are packed into
+            one row, so that positions restart at 0 for each sequence. It can
+            only be used when ``include_first`` is false and no state is
+            returned.
+        """
+        if positions is None:
+            return super().forward(input_sequence, *args, **kwargs)
+        if (
+            kwargs.get('initial_state') is not None or
+            kwargs.get('return_state', False) or
+            kwargs.get('include_first', True)
+        ):
+            raise ValueError(
+                'positions can only be used when include_first is false and '
+                'no state is used'
+            )
+        batch_size, sequence_length, d_model = input_sequence.size()
+        return input_sequence + self.cacher.get_encodings_at(
+            positions,
+            sequence_length,
+            d_model
+        )
+
     def forward_from_position(self, input_sequence, position):
         batch_size, sequence_length, d_model = input_sequence.size()
         positional_encodings = self.cacher.get_encodings(
@@ -75,7 +103,7 @@ def get_transformer_input_unidirectional(
         )) |
         SinusoidalPositionalEncodingLayer(
             positional_encoding_cacher
-        )
+        ).tag('position')
     )
     if dropout:
         result = result | DropoutUnidirectional(dropout)
@@ -3,7 +3,7 @@ import math
 import torch
 
 def make_causal_attention_mask(sequence_length, device, dtype):
-    # TODO This can be cached, with slices taken from one big tensor.
+    # See CausalAttentionMaskCacher for a cached version of this.
     # Based on https://pytorch.org/tutorials/beginner/transformer_tutorial.html
     # return : sequence_length x sequence_length
     # The return value will be added to the softmax logits for the attention
@@ -16,3 +16,79 @@ def make_causal_attention_mask(sequence_length, device, dtype):
     neginf = torch.full((1, 1), -math.inf, device=device, dtype=dtype)
     neginf_square = neginf.expand(sequence_length, sequence_length)
     return torch.triu(neginf_square, diagonal=1)
+
+class CausalAttentionMaskCacher(torch.nn.Module):
+    """A module that caches causal attention masks, so that they do not need
+    to be allocated again for every batch.
+
+    One mask is kept for every device and dtype. Masks for shorter sequences
+    are taken as slices of it.
+
+    Like :py:class:`~transformer_model.positional_encodings.SinusoidalPositionalEncodingCacher`,
+    it is highly recommended to set a maximum size up-front before training
+    to avoid CUDA memory fragmentation. The masks are not buffers, so they
+    are not part of the state dict.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._masks = {}
+        self._allow_reallocation = True
+
+    def clear(self):
+        self._masks = {}
+
+    def get_mask(self, sequence_length, device, dtype):
+        """Get a causal attention mask, like
+        :py:func:`make_causal_attention_mask`.
+
+        :return: A view of the cached mask of size
+            ``sequence_length x sequence_length``.
+        """
+        key = (torch.device(device), dtype)
+        mask = self._masks.get(key)
+        if mask is None or mask.size(0) < sequence_length:
+            if not self._allow_reallocation:
+                raise ValueError(
+                    'reallocation of the causal attention mask cache has been '
+                    'intentionally disabled with set_allow_reallocation(False)'
+                )
+            # The cached mask is only ever replaced by a longer one, so it
+            # does not flip-flop between sizes.
+            mask = make_causal_attention_mask(sequence_length, device, dtype)
+            self._masks[key] = mask
+        # Since the mask is upper-triangular, its top-left corner is the mask
+        # for a shorter sequence.
+        return mask[:sequence_length, :sequence_length]
+
+    def set_allow_reallocation(self, value):
+        self._allow_reallocation = value
+
+def make_segment_attention_mask(query_segment_ids, key_segment_ids, num_heads, causal):
+    r"""Make an attention mask for batches where each row contains several
+    packed sequences, so that each sequence only attends to itself.
+
+    :param query_segment_ids: A :math:`B \times n` integer tensor giving the
+        index of the sequence that each query position belongs to, or -1 for
+        padding.
+    :param key_segment_ids: A :math:`B \times m` integer tensor giving the
+        index of the sequence that each key position belongs to, or -1 for
+        padding.
+    :param num_heads: Number of attention heads.
+    :param causal: Whether queries should also be prevented from attending to
+        later positions.
+    :return: A :math:`(B \cdot h) \times n \times m` boolean tensor that is
+        true where attention is not allowed, in the format expected by
+        :py:class:`torch.nn.MultiheadAttention`.
+    """
+    # allowed : B x n x m
+    allowed = query_segment_ids[:, :, None] == key_segment_ids[:, None, :]
+    # Padding positions may attend anywhere, so that no row of the attention
+    # matrix is empty. Their outputs are never used.
+    allowed |= (query_segment_ids < 0)[:, :, None]
+    if causal:
+        n = query_segment_ids.size(1)
+        m = key_segment_ids.size(1)
+        allowed &= torch.ones((n, m), dtype=torch.bool, device=allowed.device).tril()
+    # return : (B * h) x n x m
+    return ~allowed.repeat_interleave(num_heads, dim=0)
@@ -63,5 +63,21 @@ class SinusoidalPositionalEncodingCacher(torch.nn.Module):
             self._set_cache_size(new_size)
         return self.encodings[:sequence_length, :d_model]
 
+    def get_encodings_at(self, positions, sequence_length, d_model):
+        """Get the encodings at arbitrary positions.
+
+        :param positions: An integer tensor of positions, all of which are
+            less than ``sequence_length``.
+        :param sequence_length: An upper bound on the positions.
+        :param d_model: Size of the encodings.
+        """
+        if self._allow_reallocation:
+            encodings = self.get_encodings(sequence_length, d_model)
+        else:
+            # When reallocation is disabled, the cache has been preallocated
+            # to be long enough for every position.
+            encodings = self.encodings[:, :d_model]
+        return encodings[positions]
+
     def set_allow_reallocation(self, value):
         self._allow_reallocation = value
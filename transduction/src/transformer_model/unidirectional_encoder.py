@@ -5,7 +5,7 @@ import torch
 
 from torch_unidirectional import Unidirectional, ForwardResult
 
-from .mask import make_causal_attention_mask
+from .mask import CausalAttentionMaskCacher
 
 class UnidirectionalTransformerEncoderLayers(Unidirectional):
 
@@ -16,7 +16,8 @@ class UnidirectionalTransformerEncoderLayers(Unidirectional):
         feedforward_size: int,
         dropout: float,
         use_final_layer_norm: bool,
-        enable_nested_tensor: bool
+        enable_nested_tensor: bool,
+        causal_mask_cacher: Optional[CausalAttentionMaskCacher]=None
     ):
         super().__init__()
         self.layers = torch.nn.TransformerEncoder(
@@ -33,6 +34,9 @@ class UnidirectionalTransformerEncoderLayers(Unidirectional):
             enable_nested_tensor=enable_nested_tensor
         )
         self.d_model = d_model
+        if causal_mask_cacher is None:
+            causal_mask_cacher = CausalAttentionMaskCacher()
+        self.causal_mask_cacher = causal_mask_cacher
 
     def forward(self,
         input_sequence: torch.Tensor,
@@ -51,7 +55,7 @@ class UnidirectionalTransformerEncoderLayers(Unidirectional):
             raise ValueError('include_first must be False')
         return self.layers(
             src=input_sequence,
-            mask=make_causal_attention_mask(
+            mask=self.causal_mask_cacher.get_mask(
                 sequence_length=input_sequence.size(1),
                 device=input_sequence.device,
                 dtype=input_sequence.dtype
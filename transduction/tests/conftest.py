@@ -0,0 +1,92 @@
+import argparse
+import random
+
+import pytest
+import torch
+
+from torch_extras.init import smart_init, uniform_fallback
+from vocab2 import ToStringVocabularyBuilder
+from sequence_to_sequence.vocabulary import build_shared_vocabularies
+from sequence_to_sequence.data_util import VocabularyContainer
+from sequence_to_sequence.model_util import SequenceToSequenceModelInterface
+
+@pytest.fixture
+def vocabs():
+    """Shared vocabularies with 10 target symbols and 3 symbols that only
+    occur in the source."""
+    shared_vocabs = build_shared_vocabularies(
+        ToStringVocabularyBuilder(),
+        [chr(ord('a') + i) for i in range(10)],
+        [chr(ord('k') + i) for i in range(3)],
+        allow_unk=False
+    )
+    return VocabularyContainer(
+        source_vocab=shared_vocabs.embedding_vocab,
+        target_input_vocab=shared_vocabs.embedding_vocab,
+        target_output_vocab=shared_vocabs.softmax_vocab,
+        vocab_is_shared=True
+    )
+
+@pytest.fixture
+def pairs():
+    """40 random (source, target) pairs of lengths 1 to 9 over the symbols of
+    the ``vocabs`` fixture."""
+    generator = random.Random(123)
+    return [
+        (
+            torch.tensor([generator.randrange(13) for _ in range(generator.randint(1, 9))]),
+            torch.tensor([generator.randrange(10) for _ in range(generator.randint(1, 9))])
+        )
+        for _ in range(40)
+    ]
+
+@pytest.fixture
+def model_interface():
+    return SequenceToSequenceModelInterface(
+        use_load=False,
+        use_init=False,
+        use_output=False,
+        require_output=False
+    )
+
+@pytest.fixture
+def model_kwargs(vocabs):
+    """The kwargs of a small transformer for the ``vocabs`` fixture."""
+    return dict(
+        encoder_layers='2',
+        use_standard_encoder=False,
+        decoder_layers='2',
+        use_standard_decoder=False,
+        d_model=32,
+        num_heads=4,
+        feedforward_size=64,
+        dropout=0.0,
+        source_vocab_size=len(vocabs.source_vocab),
+        target_input_vocab_size=len(vocabs.target_input_vocab),
+        target_output_vocab_size=len(vocabs.target_output_vocab),
+        tie_embeddings=True
+    )
+
+@pytest.fixture
+def construct_model(model_interface, model_kwargs):
+    """A function that constructs a model with the ``model_kwargs`` fixture,
+    overridden by its keyword arguments, and initializes its parameters with
+    a random seed."""
+
+    def construct_model(seed=0, **kwargs):
+        model = model_interface.construct_model(**dict(model_kwargs, **kwargs))
+        smart_init(model, torch.manual_seed(seed), fallback=uniform_fallback(0.1))
+        return model
+
+    return construct_model
+
+@pytest.fixture
+def training_args():
+    """The arguments used by
+    :py:func:`~sequence_to_sequence.train_util.run_parameter_update`."""
+    return argparse.Namespace(
+        label_smoothing=0.1,
+        gradient_clipping_threshold=5.0,
+        no_out_of_memory_recovery=False,
+        precision='fp32'
+    )
@@ -0,0 +1,38 @@
+import torch
+
+from sequence_to_sequence.batch_cache import prepare_batches
+from sequence_to_sequence.async_evaluation import AsyncCheckpointEvaluator
+from sequence_to_sequence.train_util import evaluate
+
+def test_async_evaluation_matches_evaluate(
+    vocabs,
+    pairs,
+    model_interface,
+    model_kwargs,
+    construct_model
+):
+    pairs = pairs[:20]
+    device = torch.device('cpu')
+    batches = prepare_batches([pairs[:10], pairs[10:]], model_interface, device, vocabs)
+    models = []
+    for seed in range(3):
+        models.append(construct_model(seed))
+    with AsyncCheckpointEvaluator(evaluate, model_kwargs, batches, vocabs, device, 1) as evaluator:
+        evaluator.submit('first', models[:2])
+        evaluator.submit('second', models[2:])
+        assert evaluator.num_pending() == 2
+        # The snapshots must not be affected by later changes to the models.
+        with torch.no_grad():
+            for model in models:
+                for p in model.parameters():
+                    p.zero_()
+        first = evaluator.wait()
+        second = evaluator.wait()
+        assert evaluator.num_pending() == 0
+    assert first.key == 'first'
+    assert second.key == 'second'
+    for state_dict, scores in zip(first.state_dicts + second.state_dicts, first.scores + second.scores):
+        model = model_interface.construct_model(**model_kwargs)
+        model.load_state_dict(state_dict)
+        expected = evaluate(model, batches, vocabs, model_interface, device)
+        assert abs(scores['cross_entropy_per_token'] - expected['cross_entropy_per_token']) < 1e-5
@@ -1,9 +1,15 @@
+import random
+
 import torch
 
 from sequence_to_sequence.batching import (
     group_into_batches,
     group_sources_into_batches
 )
+from sequence_to_sequence.batch_cache import CachedBatchPlan
+from sequence_to_sequence.batcher import AttentionCostBatcher, MaxTokensBatcher
+from sequence_to_sequence.model_util import SequenceToSequenceModelInterface
+from sequence_to_sequence.prefetch import BatchPrefetcher
 
 def test_always_too_big():
     num_pairs = 17
@@ -15,3 +21,80 @@ def test_always_too_big():
     assert len(batches) == num_pairs
     batches = list(group_sources_into_batches((s for s, t in pairs), lambda b, n, m: False))
     assert len(batches) == num_pairs
+
+def test_cached_batch_plan_reshuffle_buckets():
+
+    class Data:
+        pass
+    data = Data()
+    generator = random.Random(123)
+    data.source_vocab = data.target_input_vocab = data.target_output_vocab = \
+        VocabStub()
+    pairs = [
+        (
+            torch.tensor([generator.randrange(10) for _ in range(generator.randrange(1, 8))]),
+            torch.tensor([generator.randrange(10) for _ in range(generator.randrange(1, 8))])
+        )
+        for _ in range(200)
+    ]
+    model_interface = SequenceToSequenceModelInterface()
+    batcher = MaxTokensBatcher(32, model_interface)
+    plan = CachedBatchPlan(list(pairs), batcher, model_interface, torch.device('cpu'), data)
+    for _ in range(5):
+        old_batch_ids = { id(b) for b in plan.batches }
+        num_repacked = plan.reshuffle_buckets(generator, 0.2)
+        assert num_repacked > 0
+        assert sum(id(b) not in old_batch_ids for b in plan.batches) == num_repacked
+        assert sorted(id(p) for b in plan.batches for p in b) == sorted(id(p) for p in pairs)
+        for batch in plan.batches:
+            max_source_length = max(len(s) for s, t in batch)
+            max_target_length = max(len(t) for s, t in batch)
+            assert len(batch) == 1 or batcher.is_small_enough(len(batch), max_source_length, max_target_length)
+            assert batch.model_input.source.size() == (len(batch), max_source_length + 1)
+            assert batch.correct_target.size() == (len(batch), max_target_length + 1)
+
+class VocabStub:
+
+    bos_index = 10
+    eos_index = 10
+
+    def __len__(self):
+        return 11
+
+def test_batch_prefetcher_preserves_order():
+    with BatchPrefetcher(range(50), lambda x: x * 2, depth=3) as prefetcher:
+        assert list(prefetcher) == [x * 2 for x in range(50)]
+    # Stopping early should not block.
+    with BatchPrefetcher(range(50), lambda x: x, depth=2) as prefetcher:
+        for x in prefetcher:
+            if x == 5:
+                break
+
+def test_attention_cost_batcher():
+    model_interface = SequenceToSequenceModelInterface()
+    batcher = AttentionCostBatcher.from_model_kwargs(
+        200,
+        model_interface,
+        dict(d_model=32, feedforward_size=64, encoder_layers='2', decoder_layers='1.1'),
+        bucket_width=4
+    )
+    assert batcher.num_decoder_layers == 2
+    # The cost grows faster than linearly in length.
+    assert batcher.estimate_cost_single(40, 40) > 2 * batcher.estimate_cost_single(20, 20)
+    assert batcher.estimate_cost_single(1, 1) >= 1
+    generator = random.Random(123)
+    pairs = [
+        (torch.zeros(generator.randrange(1, 30)), torch.zeros(generator.randrange(1, 30)))
+        for _ in range(300)
+    ]
+    batches = list(batcher.generate_batches(pairs))
+    assert sum(map(len, batches)) == len(pairs)
+    for batch in batches:
+        assert len({ batcher.get_bucket(len(s), len(t)) for s, t in batch }) == 1
+        max_source_length = max(len(s) for s, t in batch)
+        max_target_length = max(len(t) for s, t in batch)
+        assert len(batch) == 1 or batcher.is_small_enough(len(batch), max_source_length, max_target_length)
+    batches = list(batcher.generate_source_batches(s for s, t in pairs))
+    assert sum(map(len, batches)) == len(pairs)
+    for batch in batches:
+        assert len({ batcher.get_source_bucket(len(s)) for i, s in batch }) == 1
@@ -6,7 +6,7 @@ import numpy
 import torch
 
 from torch_unidirectional import Unidirectional
-from sequence_to_sequence.beam_search import beam_search
+from sequence_to_sequence.beam_search import beam_search, beam_search_single
 
 @dataclasses.dataclass
 class CopyState(Unidirectional.State):
@@ -248,3 +248,23 @@ def test_beam_search_matches_reference():
     assert any(len(r) == max_length for r in expected_result)
     result = beam_search(initial_state, beam_size, eos, max_length, torch.device('cpu'))
     assert expected_result == result
+
+def test_batched_beam_search_matches_single():
+    batch_size = 50
+    vocab_size = 11
+    eos = vocab_size - 1
+    max_length = 12
+    initial_state = RandomState(list(range(batch_size)), vocab_size)
+    for beam_size in [1, 3, 8, 20]:
+        expected_result = [
+            beam_search_single(
+                initial_state.transform_tensors(lambda x: x[i:i+1, ...]),
+                beam_size,
+                eos,
+                max_length,
+                torch.device('cpu')
+            )
+            for i in range(batch_size)
+        ]
+        result = beam_search(initial_state, beam_size, eos, max_length, torch.device('cpu'))
+        assert result == expected_result
@@ -0,0 +1,94 @@
+import argparse
+import copy
+import logging
+import math
+
+import pytest
+import torch
+
+from lib.pytorch_tools.saver import construct_saver_from_model
+from sequence_to_sequence.train_util import run_parameter_update
+from sequence_to_sequence.calibration import (
+    calibrate_training,
+    fit_line,
+    get_probe_lengths,
+    run_probe,
+    solve_line
+)
+
+def test_fit_line():
+    a, b = fit_line([1, 2, 4, 8], [3.0, 5.0, 9.0, 17.0])
+    assert math.isclose(a, 1.0, abs_tol=1e-9)
+    assert math.isclose(b, 2.0)
+    assert math.isclose(solve_line([a, b], 21.0), 10.0)
+    assert solve_line([1.0, 0.0], 5.0) == math.inf
+
+def test_get_probe_lengths():
+    assert list(get_probe_lengths(20)) == [4, 8, 16, 20]
+    assert list(get_probe_lengths(16)) == [4, 8, 16]
+    assert list(get_probe_lengths(2)) == [2]
+
+def test_calibrate_training_restores_parameters(
+    tmp_path,
+    vocabs,
+    model_interface,
+    construct_model,
+    training_args
+):
+    model = construct_model(dropout=0.1)
+    saver = construct_saver_from_model(model, str(tmp_path / 'model'))
+    initial_parameters = copy.deepcopy(model.state_dict())
+    args = argparse.Namespace(
+        **vars(training_args),
+        batching_cost_model='max-tokens',
+        batching_bucket_width=1,
+        # Every length is probed with a single batch size.
+        batching_target_step_time=1e-9,
+        batching_target_peak_memory=None,
+        batching_calibration_repeats=1,
+        compile=False
+    )
+    args.no_out_of_memory_recovery = True
+    device = torch.device('cpu')
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+    num_updates = 0
+
+    def run_update(batch):
+        nonlocal num_updates
+        num_updates += 1
+        run_parameter_update(saver, optimizer, batch, model_interface, vocabs, device, args)
+
+    max_cost, calibration = calibrate_training(
+        None,
+        args,
+        saver,
+        model_interface,
+        vocabs,
+        device,
+        8,
+        logging.getLogger('test'),
+        run_update
+    )
+    assert max_cost >= 1
+    assert [(p['batch_size'], p['length']) for p in calibration['probes']] == [(1, 4), (1, 8)]
+    # Each probe is run once to warm up and once to be timed.
+    assert num_updates == 4
+    assert optimizer.state
+    for name, parameter in model.state_dict().items():
+        assert torch.equal(parameter, initial_parameters[name])
+    assert all(p.grad is None for p in model.parameters())
+
+def test_run_probe_records_out_of_memory():
+
+    def run_out_of_memory(batch_size, length):
+        raise MemoryError
+
+    probe = run_probe(run_out_of_memory, 8, 16, 128, torch.device('cpu'), 1)
+    assert probe.out_of_memory
+    assert probe.step_time == math.inf
+
+    def run_with_error(batch_size, length):
+        raise ValueError
+
+    with pytest.raises(ValueError):
+        run_probe(run_with_error, 8, 16, 128, torch.device('cpu'), 1)
@@ -0,0 +1,27 @@
+import pytest
+import torch
+
+from transformer_model.mask import CausalAttentionMaskCacher, make_causal_attention_mask
+
+def test_cached_mask_matches_new_mask():
+    cacher = CausalAttentionMaskCacher()
+    device = torch.device('cpu')
+    for sequence_length in [5, 3, 11, 0, 8]:
+        torch.testing.assert_close(
+            cacher.get_mask(sequence_length, device, torch.float32),
+            make_causal_attention_mask(sequence_length, device, torch.float32)
+        )
+    # The cache only grows.
+    assert cacher.get_mask(2, device, torch.float32).stride() == (11, 1)
+    assert cacher.get_mask(4, device, torch.float64).dtype == torch.float64
+
+def test_set_allow_reallocation():
+    cacher = CausalAttentionMaskCacher()
+    device = torch.device('cpu')
+    cacher.get_mask(10, device, torch.float32)
+    cacher.set_allow_reallocation(False)
+    cacher.get_mask(10, device, torch.float32)
+    with pytest.raises(ValueError):
+        cacher.get_mask(11, device, torch.float32)
+    with pytest.raises(ValueError):
+        cacher.get_mask(10, device, torch.float64)
@@ -0,0 +1,35 @@
+import logging
+
+import pytest
+import torch
+
+from sequence_to_sequence.train_util import evaluate
+from sequence_to_sequence.compilation import CompiledFunction, is_compile_available
+
+def test_rounding_lengths_up_does_not_change_loss(vocabs, pairs, model_interface, construct_model):
+    batch = pairs[:10]
+    device = torch.device('cpu')
+    model = construct_model()
+    scores = evaluate(model, [batch], vocabs, model_interface, device)
+    model_interface.length_multiple = 8
+    model_input, _ = model_interface.prepare_batch(batch, device, vocabs)
+    assert model_input.source.size(1) % 8 == 0
+    assert model_input.target.size(1) % 8 == 0
+    rounded_scores = evaluate(model, [batch], vocabs, model_interface, device)
+    assert abs(rounded_scores['cross_entropy_per_token'] - scores['cross_entropy_per_token']) < 1e-5
+
+@pytest.mark.skipif(not is_compile_available(), reason='torch.compile is not available')
+def test_compiled_function_falls_back_to_eager():
+
+    def function(x):
+        return x * 2
+
+    def fail(x):
+        raise RuntimeError('compilation failed')
+
+    compiled_function = CompiledFunction('function', function, logging.getLogger(__name__))
+    compiled_function.compiled_function = fail
+    x = torch.arange(3)
+    torch.testing.assert_close(compiled_function(x), x * 2)
+    assert compiled_function.failed
+    torch.testing.assert_close(compiled_function(x), x * 2)
@@ -0,0 +1,127 @@
+import copy
+import pathlib
+import tempfile
+
+import torch
+
+from lib.pytorch_tools.saver import construct_saver_from_model
+from sequence_to_sequence.data_parallel import DataParallel, init_data_parallel
+from sequence_to_sequence.gradient_accumulation import AccumulatedBatch
+from sequence_to_sequence.train_util import run_parameter_update
+
+def test_shard():
+    batches = list(range(7))
+    shards = [DataParallel(rank, 3).shard(batches) for rank in range(3)]
+    assert shards == [[0, 3, 6], [1, 4, None], [2, 5, None]]
+
+def run_reduce_gradients(rank, world_size, init_method, results):
+    parallel = init_data_parallel(rank, world_size, init_method)
+    model = torch.nn.Linear(2, 1, bias=False)
+    if rank == 0:
+        model.weight.grad = torch.tensor([[1.0, 2.0]])
+        stats = (3.0, 4, 5)
+    elif rank == 1:
+        model.weight.grad = torch.tensor([[3.0, 6.0]])
+        stats = (1.0, 2, 3)
+    else:
+        # This process has no batch.
+        stats = (0.0, 0, 0)
+    results[rank] = (
+        parallel.reduce_gradients(model, *stats),
+        model.weight.grad.tolist()
+    )
+    torch.distributed.destroy_process_group()
+
+def test_reduce_gradients():
+    world_size = 3
+    with tempfile.TemporaryDirectory() as temp_dir:
+        init_method = (pathlib.Path(temp_dir) / 'init').as_uri()
+        results = torch.multiprocessing.Manager().dict()
+        torch.multiprocessing.spawn(
+            run_reduce_gradients,
+            args=(world_size, init_method, results),
+            nprocs=world_size
+        )
+    for rank in range(world_size):
+        stats, grad = results[rank]
+        assert stats == (4.0, 6, 8)
+        # The summed gradients are divided by the total number of sequences.
+        assert grad == [[0.5, 1.0]]
+
+def run_data_parallel_update(
+    rank,
+    world_size,
+    init_method,
+    model,
+    batches,
+    model_interface,
+    vocabs,
+    training_args,
+    results
+):
+    parallel = init_data_parallel(rank, world_size, init_method)
+    # The parameters passed to the processes are in shared memory, so each
+    # process must update its own copy.
+    model = copy.deepcopy(model)
+    saver = construct_saver_from_model(model, None)
+    result = run_parameter_update(
+        saver,
+        torch.optim.SGD(model.parameters(), lr=0.1),
+        batches[rank],
+        model_interface,
+        vocabs,
+        torch.device('cpu'),
+        training_args,
+        parallel
+    )
+    results[rank] = (
+        (result.loss_numer, result.num_symbols, result.batch_size),
+        {name : value.clone() for name, value in model.state_dict().items()}
+    )
+    torch.distributed.destroy_process_group()
+
+def test_data_parallel_update_matches_accumulated_update(
+    vocabs,
+    pairs,
+    model_interface,
+    construct_model,
+    training_args
+):
+    # The batches have very different sizes, and one process has none.
+    batches = [pairs[:2], pairs[2:12], None]
+    world_size = len(batches)
+    model = construct_model()
+    accumulated_saver = construct_saver_from_model(copy.deepcopy(model), None)
+    accumulated_result = run_parameter_update(
+        accumulated_saver,
+        torch.optim.SGD(accumulated_saver.model.parameters(), lr=0.1),
+        AccumulatedBatch(batches[:2]),
+        model_interface,
+        vocabs,
+        torch.device('cpu'),
+        training_args
+    )
+    with tempfile.TemporaryDirectory() as temp_dir:
+        init_method = (pathlib.Path(temp_dir) / 'init').as_uri()
+        results = torch.multiprocessing.Manager().dict()
+        torch.multiprocessing.spawn(
+            run_data_parallel_update,
+            args=(
+                world_size,
+                init_method,
+                model,
+                batches,
+                model_interface,
+                vocabs,
+                training_args,
+                results
+            ),
+            nprocs=world_size
+        )
+    for rank in range(world_size):
+        (loss_numer, num_symbols, batch_size), state_dict = results[rank]
+        assert batch_size == accumulated_result.batch_size
+        assert num_symbols == accumulated_result.num_symbols
+        assert abs(loss_numer - accumulated_result.loss_numer) < 1e-3
+        for name, accumulated_parameter in accumulated_saver.model.state_dict().items():
+            torch.testing.assert_close(state_dict[name], accumulated_parameter)
@@ -0,0 +1,61 @@
+import copy
+
+import torch
+
+from sequence_to_sequence.gradient_accumulation import (
+    AccumulatedBatch,
+    group_batches_by_target_tokens
+)
+from sequence_to_sequence.train_util import run_parameter_update
+from lib.pytorch_tools.saver import construct_saver_from_model
+
+def test_group_batches_by_target_tokens():
+    def batch(*target_lengths):
+        return [(torch.zeros(1), torch.zeros(n)) for n in target_lengths]
+    batches = [batch(3, 4), batch(5), batch(2, 2, 2), batch(10), batch(1)]
+    groups = group_batches_by_target_tokens(batches, 10)
+    assert [group.batches for group in groups] == [
+        batches[0:2],
+        batches[2:4],
+        batches[4:5]
+    ]
+    assert [len(group) for group in groups] == [3, 4, 1]
+
+def test_accumulated_update_matches_one_large_batch(
+    vocabs,
+    pairs,
+    model_interface,
+    construct_model,
+    training_args
+):
+    batch = pairs[:10]
+    device = torch.device('cpu')
+    model = construct_model()
+    large_batch_saver = construct_saver_from_model(model, None)
+    accumulated_saver = construct_saver_from_model(copy.deepcopy(model), None)
+    large_batch_result = run_parameter_update(
+        large_batch_saver,
+        torch.optim.SGD(large_batch_saver.model.parameters(), lr=0.1),
+        batch,
+        model_interface,
+        vocabs,
+        device,
+        training_args
+    )
+    accumulated_result = run_parameter_update(
+        accumulated_saver,
+        torch.optim.SGD(accumulated_saver.model.parameters(), lr=0.1),
+        AccumulatedBatch([batch[:3], batch[3:4], batch[4:]]),
+        model_interface,
+        vocabs,
+        device,
+        training_args
+    )
+    assert accumulated_result.batch_size == large_batch_result.batch_size
+    assert accumulated_result.num_symbols == large_batch_result.num_symbols
+    assert abs(accumulated_result.loss_numer - large_batch_result.loss_numer) < 1e-3
+    for large_batch_parameter, accumulated_parameter in zip(
+        large_batch_saver.model.parameters(),
+        accumulated_saver.model.parameters()
+    ):
+        torch.testing.assert_close(large_batch_parameter, accumulated_parameter)
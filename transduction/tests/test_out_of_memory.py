@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+from sequence_to_sequence.gradient_accumulation import AccumulatedBatch
+from sequence_to_sequence.out_of_memory import (
+    OutOfMemorySplit,
+    run_with_out_of_memory_recovery
+)
+
+def test_out_of_memory_recovery_splits_batches(model_interface):
+    batch = AccumulatedBatch([
+        [(torch.zeros(2), torch.zeros(3)) for _ in range(2)],
+        [(torch.zeros(4), torch.zeros(1)) for _ in range(5)]
+    ])
+    num_attempts = 0
+
+    def zero_grad():
+        nonlocal num_attempts
+        num_attempts += 1
+
+    def run_micro_batch(micro_batch):
+        # Batches with more than 2 examples run out of memory.
+        if len(micro_batch) > 2:
+            raise MemoryError
+        return len(micro_batch)
+
+    results, splits = run_with_out_of_memory_recovery(
+        batch,
+        zero_grad,
+        run_micro_batch,
+        model_interface,
+        True
+    )
+    assert results == [2, 2, 1, 2]
+    assert splits == [OutOfMemorySplit(5, 5, 2), OutOfMemorySplit(3, 5, 2)]
+    assert num_attempts == 3
+
+def test_out_of_memory_recovery_fails_on_single_example(model_interface):
+
+    def run_micro_batch(micro_batch):
+        raise MemoryError
+
+    with pytest.raises(MemoryError):
+        run_with_out_of_memory_recovery(
+            [(torch.zeros(2), torch.zeros(3)) for _ in range(2)],
+            lambda: None,
+            run_micro_batch,
+            model_interface,
+            True
+        )
@@ -0,0 +1,49 @@
+import torch
+
+from sequence_to_sequence.batcher import MaxTokensBatcher
+from sequence_to_sequence.packing import generate_packed_batches, prepare_packed_batch
+
+def test_packed_losses_match_unpacked(vocabs, pairs, model_interface, construct_model):
+    pairs = pairs[:30]
+    for use_standard in [False, True]:
+        model = construct_model(
+            123,
+            use_standard_encoder=use_standard,
+            use_standard_decoder=use_standard
+        )
+        model.eval()
+        batcher = MaxTokensBatcher(60, model_interface)
+        batches = list(generate_packed_batches(list(pairs), batcher, row_length=20))
+        assert sum(map(len, batches)) == len(pairs)
+        assert any(len(row) > 1 for batch in batches for row in batch.rows)
+        device = torch.device('cpu')
+        pad_index = len(vocabs.target_output_vocab)
+        with torch.no_grad():
+            for batch in batches:
+                model_input, correct_target = prepare_packed_batch(batch, device, vocabs)
+                logits = model_interface.get_logits(model, model_input)
+                is_symbol = correct_target != pad_index
+                torch.testing.assert_close(
+                    model_interface.get_logits_at(model, model_input, is_symbol),
+                    logits[is_symbol]
+                )
+                cross_entropy = torch.nn.functional.cross_entropy(
+                    logits.permute(0, 2, 1),
+                    correct_target,
+                    ignore_index=pad_index,
+                    reduction='none'
+                )
+                packed_losses = cross_entropy.new_zeros(len(batch)).index_add_(
+                    0,
+                    model_input.target_example_ids.flatten(),
+                    cross_entropy.flatten()
+                )
+                for i, pair in enumerate(batch):
+                    model_input, correct_target = model_interface.prepare_batch([pair], device, vocabs)
+                    logits = model_interface.get_logits(model, model_input)
+                    expected_loss = torch.nn.functional.cross_entropy(
+                        logits.permute(0, 2, 1),
+                        correct_target,
+                        reduction='sum'
+                    )
+                    torch.testing.assert_close(packed_losses[i], expected_loss)
@@ -0,0 +1,38 @@
+import random
+
+import torch
+
+from sequence_to_sequence.model_util import FlatSequences, pad_sequences
+
+def reference_pad_sequences(sequences, pad, bos=None, eos=None):
+    prefix = [bos] if bos is not None else []
+    suffix = [eos] if eos is not None else []
+    padded = [prefix + list(s) + suffix for s in sequences]
+    max_length = max(map(len, padded))
+    return torch.tensor([s + [pad] * (max_length - len(s)) for s in padded])
+
+def test_pad_sequences():
+    generator = random.Random(123)
+    sequences = [
+        torch.tensor([generator.randrange(10) for _ in range(length)], dtype=torch.uint8)
+        for length in [5, 0, 3, 9, 1]
+    ]
+    device = torch.device('cpu')
+    for bos, eos in [(None, None), (10, None), (None, 11), (10, 11)]:
+        expected = reference_pad_sequences(sequences, 12, bos, eos)
+        result, is_padding = FlatSequences.from_sequences(sequences, device).pad(12, bos, eos)
+        assert result.dtype == torch.long
+        torch.testing.assert_close(result, expected)
+        torch.testing.assert_close(is_padding, expected == 12)
+        torch.testing.assert_close(pad_sequences([s.tolist() for s in sequences], device, 12, bos, eos), expected)
+
+def test_pad_sequences_to_length_multiple():
+    sequences = [torch.tensor([1, 2, 3]), torch.tensor([4])]
+    device = torch.device('cpu')
+    result, is_padding = FlatSequences.from_sequences(sequences, device).pad(12, bos=10, length_multiple=8)
+    expected = torch.tensor([
+        [10, 1, 2, 3, 12, 12, 12, 12],
+        [10, 4, 12, 12, 12, 12, 12, 12]
+    ])
+    torch.testing.assert_close(result, expected)
+    torch.testing.assert_close(is_padding, expected == 12)
@@ -0,0 +1,40 @@
+import argparse
+
+import torch
+
+from sequence_to_sequence.train_util import evaluate, run_parameter_update
+from sequence_to_sequence.precision import get_autocast_context
+from lib.pytorch_tools.saver import construct_saver_from_model
+
+def test_bf16_matches_fp32(vocabs, pairs, model_interface, construct_model, training_args):
+    batch = pairs[:10]
+    device = torch.device('cpu')
+    model = construct_model()
+    fp32_scores = evaluate(model, [batch], vocabs, model_interface, device, 'fp32')
+    bf16_scores = evaluate(model, [batch], vocabs, model_interface, device, 'bf16')
+    assert abs(bf16_scores['cross_entropy_per_token'] - fp32_scores['cross_entropy_per_token']) < 0.05
+    model_source = model_interface.prepare_source([s for s, t in batch], device, vocabs)
+    with get_autocast_context('bf16', device):
+        output = model_interface.decode(
+            model=model,
+            model_source=model_source,
+            bos_symbol=vocabs.target_input_vocab.bos_index,
+            beam_size=3,
+            eos_symbol=vocabs.target_output_vocab.eos_index,
+            max_length=10
+        )
+    assert len(output) == len(batch)
+    # The parameters and their gradients stay in float32.
+    saver = construct_saver_from_model(model, None)
+    run_parameter_update(
+        saver,
+        torch.optim.SGD(model.parameters(), lr=0.1),
+        batch,
+        model_interface,
+        vocabs,
+        device,
+        argparse.Namespace(**dict(vars(training_args), precision='bf16'))
+    )
+    for parameter in model.parameters():
+        assert parameter.dtype == torch.float32
+        assert parameter.grad.dtype == torch.float32
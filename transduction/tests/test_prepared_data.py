@@ -0,0 +1,50 @@
+import pathlib
+
+import torch
+
+from sequence_to_sequence.prepared_data import (
+    get_token_dtype,
+    is_prepared_data_file,
+    read_prepared_data_file,
+    write_prepared_data_file
+)
+from sequence_to_sequence.data_util import load_prepared_data_file
+
+def test_write_and_read(tmp_path):
+    sequences = [[3, 1, 4], [], [1, 5, 9, 2, 6], [5]]
+    path = tmp_path / 'data.prepared'
+    write_prepared_data_file(path, sequences)
+    assert is_prepared_data_file(path)
+    data = read_prepared_data_file(path)
+    assert len(data) == len(sequences)
+    assert data.tokens.dtype == torch.uint8
+    assert data.lengths().tolist() == [3, 0, 5, 1]
+    assert [s.tolist() for s in data.sequences()] == sequences
+    assert [s.tolist() for s in load_prepared_data_file(path)] == sequences
+
+def test_empty(tmp_path):
+    path = tmp_path / 'data.prepared'
+    write_prepared_data_file(path, [])
+    assert load_prepared_data_file(path) == []
+    write_prepared_data_file(path, [[], []])
+    assert [s.tolist() for s in load_prepared_data_file(path)] == [[], []]
+
+def test_large_vocabulary(tmp_path):
+    sequences = [[0, 70000], [255, 256, 32767]]
+    path = tmp_path / 'data.prepared'
+    write_prepared_data_file(path, sequences)
+    data = read_prepared_data_file(path)
+    assert data.tokens.dtype == torch.int32
+    assert [s.tolist() for s in data.sequences()] == sequences
+
+def test_token_dtype():
+    assert get_token_dtype(255).itemsize == 1
+    assert get_token_dtype(256).itemsize == 2
+    assert get_token_dtype(32768).itemsize == 4
+
+def test_legacy_format(tmp_path):
+    sequences = [[3, 1, 4], [1, 5]]
+    path = tmp_path / 'data.prepared'
+    torch.save(sequences, path)
+    assert not is_prepared_data_file(path)
+    assert [s.tolist() for s in load_prepared_data_file(path)] == sequences
@@ -0,0 +1,300 @@
+import logging
+import random
+
+import pytest
+import torch
+
+from lib.logging import NullLogger, read_log_file
+from lib.pytorch_tools.saver import (
+    DirectoryExists,
+    ModelSaver,
+    construct_saver_from_model,
+    read_training_state
+)
+from torch_extras.early_stopping import UpdatesWithoutImprovement
+from sequence_to_sequence.data_parallel import SingleProcess
+from sequence_to_sequence.prefetch import BatchPrefetcher
+from sequence_to_sequence.prepared_data import write_prepared_data_file
+from sequence_to_sequence import train, train_util
+from sequence_to_sequence.train_util import (
+    LossAccumulator,
+    TrainingTrial,
+    get_trial_state,
+    load_trial_state,
+    run_parameter_update
+)
+
+def test_resumed_trial_matches_uninterrupted_trial(
+    vocabs,
+    pairs,
+    model_interface,
+    construct_model,
+    training_args
+):
+    batches = [pairs[i:i+10] for i in range(0, 40, 10)]
+    device = torch.device('cpu')
+
+    def construct_trial(seed):
+        # Dropout makes the updates depend on the random number generator.
+        model = construct_model(seed, dropout=0.2)
+        optimizer = torch.optim.Adam(model.parameters(), lr=0.01)
+        early_stopping = UpdatesWithoutImprovement('min', patience=2)
+        return TrainingTrial(
+            construct_saver_from_model(model, None),
+            NullLogger(),
+            '',
+            optimizer=optimizer,
+            lr_scheduler=torch.optim.lr_scheduler.ReduceLROnPlateau(
+                optimizer,
+                mode=early_stopping.mode,
+                patience=0,
+                factor=0.5
+            ),
+            early_stopping=early_stopping,
+            epoch_loss=LossAccumulator()
+        )
+
+    def train_on(trial, batches):
+        for batch in batches:
+            result = run_parameter_update(
+                trial.saver,
+                trial.optimizer,
+                batch,
+                model_interface,
+                vocabs,
+                device,
+                training_args
+            )
+            trial.epoch_loss.update(result.loss_numer, result.num_symbols)
+            trial.lr_scheduler.step(result.loss_numer)
+            trial.early_stopping.update(result.loss_numer)
+
+    uninterrupted_trial = construct_trial(1)
+    train_on(uninterrupted_trial, batches)
+
+    interrupted_trial = construct_trial(1)
+    train_on(interrupted_trial, batches[:2])
+    state = get_trial_state(interrupted_trial, dict(rng_state=torch.get_rng_state()))
+    # Disturb the random number generator, as if the process had restarted.
+    torch.rand(100)
+    resumed_trial = construct_trial(2)
+    load_trial_state(resumed_trial, state)
+    torch.set_rng_state(state['training']['rng_state'])
+    train_on(resumed_trial, batches[2:])
+
+    assert resumed_trial.epoch_loss.get_value() == uninterrupted_trial.epoch_loss.get_value()
+    assert resumed_trial.optimizer.param_groups[0]['lr'] == uninterrupted_trial.optimizer.param_groups[0]['lr']
+    assert resumed_trial.early_stopping.state_dict() == uninterrupted_trial.early_stopping.state_dict()
+    for resumed_parameter, uninterrupted_parameter in zip(
+        resumed_trial.saver.model.parameters(),
+        uninterrupted_trial.saver.model.parameters()
+    ):
+        assert torch.equal(resumed_parameter, uninterrupted_parameter)
+
+def write_training_data(directory):
+    generator = random.Random(123)
+    torch.save({
+        'tokens_in_target' : [chr(ord('a') + i) for i in range(10)],
+        'tokens_only_in_source' : [chr(ord('k') + i) for i in range(3)],
+        'allow_unk' : False
+    }, directory / 'both.vocab')
+    for name, num_examples in [('training', 200), ('validation', 10)]:
+        write_prepared_data_file(directory / f'{name}.source', [
+            [generator.randrange(10) for _ in range(generator.randint(1, 12))]
+            for _ in range(num_examples)
+        ])
+        write_prepared_data_file(directory / f'{name}.target', [
+            [generator.randrange(10) for _ in range(generator.randint(1, 12))]
+            for _ in range(num_examples)
+        ])
+
+def run_training(data_dir, output, resume=True, extra_args=()):
+    argv = [
+        '--training-data-source', str(data_dir / 'training.source'),
+        '--training-data-target', str(data_dir / 'training.target'),
+        '--validation-data-source', str(data_dir / 'validation.source'),
+        '--validation-data-target', str(data_dir / 'validation.target'),
+        '--shared-vocabulary', str(data_dir / 'both.vocab'),
+        '--output', str(output),
+        '--encoder-layers', '1',
+        '--decoder-layers', '1',
+        '--d-model', '16',
+        '--num-heads', '2',
+        '--feedforward-size', '32',
+        '--dropout', '0.1',
+        '--init-scale', '0.1',
+        '--epochs', '3',
+        '--learning-rate', '0.01',
+        '--label-smoothing', '0.1',
+        '--gradient-clipping-threshold', '5',
+        '--early-stopping-patience', '100',
+        '--learning-rate-patience', '100',
+        '--learning-rate-decay-factor', '0.5',
+        '--checkpoint-interval-sequences', '50',
+        '--batching-max-tokens', '128',
+        '--parameter-seed', '1',
+        '--random-shuffling-seed', '1',
+        '--no-progress',
+        '--device', 'cpu'
+    ]
+    if resume:
+        argv.append('--resume')
+    argv.extend(extra_args)
+    model_interface, parser, args = train.parse_arguments(argv)
+    train.run(parser, args, model_interface, logging.getLogger('test'), SingleProcess())
+
+def read_logged_results(output):
+    with open(output / 'logs' / 'main.log') as fin:
+        return [
+            event.data['loss'] if event.type == 'epoch' else event.data['scores']
+            for event in read_log_file(fin)
+            if event.type in ('epoch', 'checkpoint')
+        ]
+
+class Interrupted(Exception):
+    pass
+
+def test_resume_after_out_of_memory_split_matches_uninterrupted_training(tmp_path, monkeypatch):
+    write_training_data(tmp_path)
+    original_get_loss_parts = train_util.get_loss_parts
+    num_training_calls = 0
+    interrupt_at = None
+
+    def get_loss_parts(model, batch, *args, **kwargs):
+        nonlocal num_training_calls
+        if model.training:
+            num_training_calls += 1
+            # Simulate running out of memory once, early in the first epoch.
+            if num_training_calls == 2:
+                raise MemoryError
+            if num_training_calls == interrupt_at:
+                raise Interrupted
+        return original_get_loss_parts(model, batch, *args, **kwargs)
+
+    monkeypatch.setattr(train_util, 'get_loss_parts', get_loss_parts)
+    uninterrupted_output = tmp_path / 'uninterrupted'
+    run_training(tmp_path, uninterrupted_output)
+
+    # Interrupt training late in the last epoch, after a training state has
+    # been saved in it.
+    interrupt_at = num_training_calls - 2
+    num_training_calls = 0
+    resumed_output = tmp_path / 'resumed'
+    with pytest.raises(Interrupted):
+        run_training(tmp_path, resumed_output)
+    training_state = read_training_state(resumed_output)['training']
+    assert training_state['epoch_no'] == 2
+    # The maximum batch cost was lowered after the first epoch's batches
+    # were generated.
+    epoch_max_costs = training_state['epoch_max_costs']
+    assert epoch_max_costs[1] < epoch_max_costs[0]
+    # The resumed run neither runs out of memory nor is interrupted.
+    interrupt_at = None
+    num_training_calls = 2
+    run_training(tmp_path, resumed_output)
+
+    assert read_logged_results(resumed_output) == read_logged_results(uninterrupted_output)
+    resumed_parameters = torch.load(resumed_output / 'parameters' / 'main.pt')
+    uninterrupted_parameters = torch.load(uninterrupted_output / 'parameters' / 'main.pt')
+    assert resumed_parameters.keys() == uninterrupted_parameters.keys()
+    for name, uninterrupted_parameter in uninterrupted_parameters.items():
+        assert torch.equal(resumed_parameters[name], uninterrupted_parameter)
+
+def test_resume_before_first_checkpoint_matches_uninterrupted_training(tmp_path, monkeypatch):
+    write_training_data(tmp_path)
+    original_get_loss_parts = train_util.get_loss_parts
+    original_save_training_state = ModelSaver.save_training_state
+    interrupt = False
+    interrupt_saving = False
+
+    def get_loss_parts(model, batch, *args, **kwargs):
+        if model.training and interrupt:
+            raise Interrupted
+        return original_get_loss_parts(model, batch, *args, **kwargs)
+
+    def save_training_state(self, state):
+        if interrupt_saving:
+            raise Interrupted
+        original_save_training_state(self, state)
+
+    monkeypatch.setattr(train_util, 'get_loss_parts', get_loss_parts)
+    monkeypatch.setattr(ModelSaver, 'save_training_state', save_training_state)
+    uninterrupted_output = tmp_path / 'uninterrupted'
+    run_training(tmp_path, uninterrupted_output)
+    uninterrupted_results = read_logged_results(uninterrupted_output)
+
+    # Interrupt training at the first batch. The training state saved before
+    # it is resumed from.
+    resumed_output = tmp_path / 'resumed'
+    interrupt = True
+    with pytest.raises(Interrupted):
+        run_training(tmp_path, resumed_output)
+    training_state = read_training_state(resumed_output)['training']
+    assert training_state['batch_no'] == 0
+    assert training_state['checkpoint_no'] == 0
+    interrupt = False
+    run_training(tmp_path, resumed_output)
+    assert read_logged_results(resumed_output) == uninterrupted_results
+
+    # Interrupt training before it has saved a training state at all, which
+    # leaves a directory with a log but no training state. Training starts
+    # over in it.
+    restarted_output = tmp_path / 'restarted'
+    interrupt_saving = True
+    with pytest.raises(Interrupted):
+        run_training(tmp_path, restarted_output)
+    assert (restarted_output / 'logs' / 'main.log').exists()
+    assert read_training_state(restarted_output) is None
+    interrupt_saving = False
+    run_training(tmp_path, restarted_output)
+    assert read_logged_results(restarted_output) == uninterrupted_results
+    with open(restarted_output / 'logs' / 'main.log') as fin:
+        assert [event.type for event in read_log_file(fin)].count('start_training') == 1
+
+    uninterrupted_parameters = torch.load(uninterrupted_output / 'parameters' / 'main.pt')
+    for output in [resumed_output, restarted_output]:
+        parameters = torch.load(output / 'parameters' / 'main.pt')
+        assert parameters.keys() == uninterrupted_parameters.keys()
+        for name, uninterrupted_parameter in uninterrupted_parameters.items():
+            assert torch.equal(parameters[name], uninterrupted_parameter)
+
+def test_resume_does_not_start_over_in_completed_output(tmp_path):
+    write_training_data(tmp_path)
+    output = tmp_path / 'model'
+    # This run cannot be resumed, so it saves no training state.
+    run_training(tmp_path, output, resume=False)
+    files = {
+        path : path.read_bytes()
+        for path in output.rglob('*')
+        if path.is_file()
+    }
+    with pytest.raises(DirectoryExists):
+        run_training(tmp_path, output)
+    assert {
+        path : path.read_bytes()
+        for path in output.rglob('*')
+        if path.is_file()
+    } == files
+
+def test_interrupted_epoch_closes_prefetcher(tmp_path, monkeypatch):
+    write_training_data(tmp_path)
+    original_get_loss_parts = train_util.get_loss_parts
+    prefetchers = []
+
+    class RecordingBatchPrefetcher(BatchPrefetcher):
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            prefetchers.append(self)
+
+    def get_loss_parts(model, batch, *args, **kwargs):
+        if model.training:
+            raise Interrupted
+        return original_get_loss_parts(model, batch, *args, **kwargs)
+
+    monkeypatch.setattr(train_util, 'BatchPrefetcher', RecordingBatchPrefetcher)
+    monkeypatch.setattr(train_util, 'get_loss_parts', get_loss_parts)
+    with pytest.raises(Interrupted):
+        run_training(tmp_path, tmp_path / 'output', extra_args=['--prefetch-batches', '2'])
+    assert len(prefetchers) == 1
+    assert not prefetchers[0]._thread.is_alive()
@@ -0,0 +1,72 @@
+import pytest
+import torch
+
+from rnn_model.encoder import RNNEncoderLayers
+from rnn_model.decoder import RNNDecoderLayers
+from sequence_to_sequence.model_util import parse_layers
+
+def test_parse_layers():
+    assert list(parse_layers('lstm:2.3.gru:1')) == [
+        ('lstm', (2,)),
+        ('transformer', (3,)),
+        ('gru', (1,))
+    ]
+    with pytest.raises(ValueError):
+        list(parse_layers('rnn:2'))
+
+@pytest.mark.parametrize('rnn_type', ['lstm', 'gru'])
+def test_encoder_ignores_padding(rnn_type):
+    batch_size = 4
+    sequence_length = 7
+    d_model = 32
+    generator = torch.manual_seed(123)
+    model = RNNEncoderLayers(rnn_type, num_layers=2, d_model=d_model, dropout=0)
+    for param in model.parameters():
+        param.data.uniform_(-0.5, 0.5, generator=generator)
+    source = torch.rand((batch_size, sequence_length, d_model), generator=generator)
+    lengths = torch.tensor([7, 3, 5, 1])
+    is_padding_mask = torch.arange(sequence_length)[None, :] >= lengths[:, None]
+    output = model(source, is_padding_mask=is_padding_mask)
+    assert output.size() == (batch_size, sequence_length, d_model)
+    for i, length in enumerate(lengths.tolist()):
+        expected_output = model(source[i:i+1, :length])
+        torch.testing.assert_close(output[i:i+1, :length], expected_output)
+        assert torch.all(output[i, length:] == 0)
+
+@pytest.mark.parametrize('rnn_type', ['lstm', 'gru'])
+def test_decoder_state_matches_forward_after_reordering(rnn_type):
+    batch_size = 4
+    sequence_length = 9
+    encoder_sequence_length = 6
+    d_model = 32
+    generator = torch.manual_seed(123)
+    model = RNNDecoderLayers(rnn_type, num_layers=2, d_model=d_model, dropout=0)
+    for param in model.parameters():
+        param.data.uniform_(-0.5, 0.5, generator=generator)
+    model.eval()
+    encoder_output = torch.rand((batch_size, encoder_sequence_length, d_model), generator=generator)
+    encoder_lengths = torch.tensor([6, 3, 5, 1])
+    encoder_is_padding_mask = (
+        torch.arange(encoder_sequence_length)[None, :] >= encoder_lengths[:, None]
+    )
+    decoder_input = torch.rand((batch_size, sequence_length, d_model), generator=generator)
+    permutation = torch.tensor([2, 0, 0, 3])
+    prefix_length = sequence_length // 2
+    with torch.no_grad():
+        forward_output = model(
+            decoder_input,
+            encoder_output,
+            encoder_is_padding_mask=encoder_is_padding_mask,
+            include_first=False
+        )
+        initial_state = model.initial_state(batch_size, encoder_output, encoder_is_padding_mask)
+        state = initial_state.fastforward(decoder_input[:, :prefix_length])
+        torch.testing.assert_close(state.output(), forward_output[:, prefix_length-1])
+        state = initial_state
+        for i in range(sequence_length):
+            if i == prefix_length:
+                state = state.transform_tensors(lambda x: x[permutation, ...])
+                forward_output = forward_output[permutation]
+                decoder_input = decoder_input[permutation]
+            state = state.next(decoder_input[:, i])
+            torch.testing.assert_close(state.output(), forward_output[:, i])
@@ -0,0 +1,37 @@
+import os
+import tempfile
+
+import torch
+
+from lib.pytorch_tools.saver import AsyncParameterWriter, construct_saver_from_model
+
+def test_async_parameter_writer_writes_last_save():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        model = torch.nn.Linear(3, 2)
+        saver = construct_saver_from_model(model, os.path.join(temp_dir, 'model'))
+        writer = AsyncParameterWriter()
+        for i in range(20):
+            with torch.no_grad():
+                model.weight.fill_(i)
+            writer.save(saver)
+        # Changing the model after saving must not affect what is written.
+        with torch.no_grad():
+            model.weight.fill_(-1)
+        writer.close()
+        parameter_dir = os.path.join(temp_dir, 'model', 'parameters')
+        assert os.listdir(parameter_dir) == ['main.pt']
+        state_dict = torch.load(os.path.join(parameter_dir, 'main.pt'))
+        assert torch.equal(state_dict['weight'], torch.full((2, 3), 19.0))
+        assert writer.last_write_seconds is not None
+
+def test_logger_resumes_from_position():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        saver = construct_saver_from_model(torch.nn.Linear(3, 2), os.path.join(temp_dir, 'model'))
+        with saver.logger() as events:
+            events.log('first', dict(x=1))
+            position = events.tell()
+            events.log('second', dict(x=2))
+        with saver.logger(resume_position=position) as events:
+            events.log('third', dict(x=3))
+        with saver.logs() as logs:
+            assert [event.type for event in logs] == ['first', 'third']
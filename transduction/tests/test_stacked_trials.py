@@ -0,0 +1,64 @@
+import copy
+
+import torch
+
+from sequence_to_sequence.train_util import (
+    TrainingTrial,
+    run_parameter_update,
+    run_stacked_parameter_update
+)
+from lib.pytorch_tools.saver import construct_saver_from_model
+
+def test_stacked_update_matches_separate_updates(
+    vocabs,
+    pairs,
+    model_interface,
+    construct_model,
+    training_args
+):
+    batch = pairs[:10]
+    device = torch.device('cpu')
+
+    def construct_trial(seed):
+        model = construct_model(seed)
+        return TrainingTrial(
+            construct_saver_from_model(model, None),
+            None,
+            '',
+            optimizer=torch.optim.SGD(model.parameters(), lr=0.1)
+        )
+
+    stacked_trials = [construct_trial(seed) for seed in range(3)]
+    separate_trials = [copy.deepcopy(trial) for trial in stacked_trials]
+    for trial in separate_trials:
+        trial.optimizer = torch.optim.SGD(trial.saver.model.parameters(), lr=0.1)
+    for _ in range(2):
+        stacked_results = run_stacked_parameter_update(
+            stacked_trials,
+            batch,
+            model_interface,
+            vocabs,
+            device,
+            training_args
+        )
+        separate_results = [
+            run_parameter_update(
+                trial.saver,
+                trial.optimizer,
+                batch,
+                model_interface,
+                vocabs,
+                device,
+                training_args
+            )
+            for trial in separate_trials
+        ]
+        for stacked_result, separate_result in zip(stacked_results, separate_results):
+            assert stacked_result.num_symbols == separate_result.num_symbols
+            assert abs(stacked_result.loss_numer - separate_result.loss_numer) < 1e-3
+    for stacked_trial, separate_trial in zip(stacked_trials, separate_trials):
+        for stacked_parameter, separate_parameter in zip(
+            stacked_trial.saver.model.parameters(),
+            separate_trial.saver.model.parameters()
+        ):
+            torch.testing.assert_close(stacked_parameter, separate_parameter)
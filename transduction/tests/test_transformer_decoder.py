@@ -1,7 +1,7 @@
 import torch
 
 from transformer_model.input_layer import SinusoidalPositionalEncodingLayer
-from transformer_model.decoder import get_transformer_decoder
+from transformer_model.decoder import get_transformer_decoder, TransformerDecoderLayers
 
 def test_positional_encoding_forward_matches_iterative():
     batch_size = 3
@@ -64,3 +64,43 @@ def test_forward_matches_iterative():
         decoder_output_i = state.output()
         forward_output_i = forward_output[:, i]
         torch.testing.assert_close(decoder_output_i, forward_output_i, atol=1e-5, rtol=1e-5)
+
+def test_cached_state_matches_forward_after_reordering():
+    batch_size = 4
+    sequence_length = 9
+    encoder_sequence_length = 6
+    d_model = 32
+    generator = torch.manual_seed(123)
+    model = TransformerDecoderLayers(
+        num_layers=3,
+        d_model=d_model,
+        num_heads=4,
+        feedforward_size=64,
+        dropout=0,
+        use_final_layer_norm=True
+    )
+    for param in model.parameters():
+        param.data.uniform_(-0.5, 0.5, generator=generator)
+    model.eval()
+    encoder_output = torch.rand((batch_size, encoder_sequence_length, d_model), generator=generator)
+    encoder_lengths = torch.tensor([6, 3, 5, 1])
+    encoder_is_padding_mask = (
+        torch.arange(encoder_sequence_length)[None, :] >= encoder_lengths[:, None]
+    )
+    decoder_input = torch.rand((batch_size, sequence_length, d_model), generator=generator)
+    permutation = torch.tensor([2, 0, 0, 3])
+    with torch.no_grad():
+        forward_output = model(
+            decoder_input,
+            encoder_output,
+            encoder_is_padding_mask=encoder_is_padding_mask,
+            include_first=False
+        )
+        state = model.initial_state(batch_size, encoder_output, encoder_is_padding_mask)
+        for i in range(sequence_length):
+            if i == sequence_length // 2:
+                state = state.transform_tensors(lambda x: x[permutation, ...])
+                forward_output = forward_output[permutation]
+                decoder_input = decoder_input[permutation]
+            state = state.next(decoder_input[:, i])
+            torch.testing.assert_close(state.output(), forward_output[:, i], atol=1e-5, rtol=1e-5)
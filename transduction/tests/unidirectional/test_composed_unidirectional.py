@@ -164,3 +164,101 @@ def test_arg_routing_to_tags():
             )
         )
     )
+
+def test_frozen_matches_forward_and_iterative():
+    model = (
+        AdditivePositional() |
+        MultiplicativePositional() |
+        (AdditivePositional() | MultiplicativePositional())
+    )
+    frozen_model = model.freeze()
+    assert len(frozen_model.leaves) == 4
+    batch_size = 5
+    sequence_length = 13
+    generator = torch.manual_seed(123)
+    input_sequence = torch.rand((batch_size, sequence_length), generator=generator)
+    expected_forward_output = model(input_sequence, include_first=False)
+    torch.testing.assert_close(
+        frozen_model(input_sequence, include_first=False),
+        expected_forward_output
+    )
+    result = frozen_model(input_sequence, include_first=False, return_state=True)
+    torch.testing.assert_close(result.output, expected_forward_output)
+    torch.testing.assert_close(result.state.output(), expected_forward_output[:, -1])
+    state = frozen_model.initial_state(batch_size)
+    for i in range(sequence_length):
+        state = state.next(input_sequence[:, i])
+        torch.testing.assert_close(state.output(), expected_forward_output[:, i])
+    state = frozen_model.initial_state(batch_size).fastforward(input_sequence[:, :6])
+    for i in range(6, sequence_length):
+        state = state.next(input_sequence[:, i])
+        torch.testing.assert_close(state.output(), expected_forward_output[:, i])
+
+def test_frozen_arg_routing_to_tags():
+    model = (
+        AdditivePositional() |
+        MainUnidirectional().main() |
+        AdditivePositional() |
+        OtherUnidirectional().tag('other') |
+        MultiplicativePositional() |
+        YetAnotherUnidirectional().tag('yetanother')
+    ).freeze()
+    batch_size = 5
+    sequence_length = 13
+    generator = torch.manual_seed(123)
+    input_sequence = torch.rand((batch_size, sequence_length), generator=generator)
+    tag_kwargs = dict(
+        other=dict(
+            beta=999,
+            gamma='qwerty'
+        ),
+        yetanother=dict(
+            alpha='meow',
+            delta='moo'
+        )
+    )
+    state = model.initial_state(
+        batch_size,
+        'foo',
+        42,
+        alpha=123,
+        beta='asdf',
+        tag_kwargs=tag_kwargs
+    )
+    output = model(
+        input_sequence,
+        'foo',
+        42,
+        alpha=123,
+        beta='asdf',
+        include_first=False,
+        tag_kwargs=tag_kwargs
+    )
+
+def test_fastforward_processes_whole_sequence():
+    num_calls = 0
+    def func(x):
+        nonlocal num_calls
+        num_calls += 1
+        return x * 2
+    model = (
+        AdditivePositional() |
+        SimpleLayerUnidirectional(func) |
+        MultiplicativePositional() |
+        SimpleLayerUnidirectional(func)
+    )
+    batch_size = 5
+    sequence_length = 13
+    prefix_length = 6
+    generator = torch.manual_seed(123)
+    input_sequence = torch.rand((batch_size, sequence_length), generator=generator)
+    expected_forward_output = model(input_sequence, include_first=False)
+    for initial_state in [model.initial_state(batch_size), model.freeze().initial_state(batch_size)]:
+        num_calls = 0
+        state = initial_state.fastforward(input_sequence[:, :prefix_length])
+        # Only the first SimpleLayerUnidirectional computes its outputs, and
+        # it does so once for the whole prefix.
+        assert num_calls == 1
+        for i in range(prefix_length, sequence_length):
+            state = state.next(input_sequence[:, i])
+            torch.testing.assert_close(state.output(), expected_forward_output[:, i])
@@ -45,3 +45,32 @@ def test_forward_matches_iterative():
         output = state.output()
         assert output.size() == (batch_size, input_size)
         torch.testing.assert_close(output, forward_output[:, i])
+
+def test_forward_returns_state():
+    batch_size = 5
+    sequence_length = 13
+    prefix_length = 6
+    input_size = 7
+    generator = torch.manual_seed(123)
+    alpha = 123
+    beta = 'moo'
+    model = ResidualUnidirectional(AdditivePositional())
+    input_sequence = torch.rand((batch_size, sequence_length, input_size), generator=generator)
+    forward_output = model(input_sequence, include_first=False, alpha=alpha, beta=beta)
+    result = model(
+        input_sequence[:, :prefix_length],
+        include_first=False,
+        return_state=True,
+        alpha=alpha,
+        beta=beta
+    )
+    torch.testing.assert_close(result.output, forward_output[:, :prefix_length])
+    state = result.state
+    torch.testing.assert_close(state.output(), forward_output[:, prefix_length-1])
+    result = state.forward(input_sequence[:, prefix_length:], return_state=True, include_first=True)
+    torch.testing.assert_close(result.output, forward_output[:, prefix_length-1:])
+    state = result.state
+    for i in range(sequence_length, sequence_length + 3):
+        input_tensor = torch.zeros((batch_size, input_size))
+        state = state.next(input_tensor)
+        torch.testing.assert_close(state.output(), input_tensor + i)
@@ -54,3 +54,19 @@ def test_custom_args():
         output = state.output()
         assert output.size() == (batch_size, input_size)
         torch.testing.assert_close(output, forward_output[:, i])
+
+def test_forward_returns_state():
+    batch_size = 5
+    sequence_length = 13
+    prefix_length = 6
+    input_size = 7
+    model = MySimple(input_size)
+    generator = torch.manual_seed(123)
+    input_sequence = torch.rand((batch_size, sequence_length, input_size), generator=generator)
+    forward_output = model(input_sequence, include_first=True)
+    result = model(input_sequence[:, :prefix_length], include_first=True, return_state=True)
+    torch.testing.assert_close(result.output, forward_output[:, :prefix_length+1])
+    state = result.state
+    torch.testing.assert_close(state.output(), forward_output[:, prefix_length])
+    result = state.forward(input_sequence[:, prefix_length:], return_state=True, include_first=True)
+    torch.testing.assert_close(result.output, forward_output[:, prefix_length:])
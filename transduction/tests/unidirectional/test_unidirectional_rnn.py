@@ -1,10 +1,10 @@
 import pytest
 import torch
 
-from torch_unidirectional import UnidirectionalSimpleRNN, UnidirectionalLSTM
+from torch_unidirectional import UnidirectionalSimpleRNN, UnidirectionalLSTM, UnidirectionalGRU
 from torch_unidirectional.rnn import remove_extra_bias_parameters
 
-@pytest.mark.parametrize('ModelClass', [UnidirectionalSimpleRNN, UnidirectionalLSTM])
+@pytest.mark.parametrize('ModelClass', [UnidirectionalSimpleRNN, UnidirectionalLSTM, UnidirectionalGRU])
 @pytest.mark.parametrize('use_extra_bias', [True, False])
 def test_forward_matches_iterative(ModelClass, use_extra_bias):
     batch_size = 5
@@ -118,6 +118,40 @@ def test_remove_extra_bias(ModelClass):
     for param in extra_bias_params:
         assert param.grad is None
 
+@pytest.mark.parametrize('ModelClass', [UnidirectionalSimpleRNN, UnidirectionalLSTM, UnidirectionalGRU])
+def test_fastforward_and_transform_tensors(ModelClass):
+    batch_size = 5
+    sequence_length = 13
+    prefix_length = 6
+    input_size = 7
+    hidden_units = 17
+    generator = torch.manual_seed(123)
+    model = ModelClass(
+        input_size=input_size,
+        hidden_units=hidden_units,
+        layers=3
+    )
+    for p in model.parameters():
+        p.data.uniform_(generator=generator)
+    input_sequence = torch.rand((batch_size, sequence_length, input_size), generator=generator)
+    forward_output = model(input_sequence, include_first=False)
+    state = model.initial_state(batch_size).fastforward(input_sequence[:, :prefix_length])
+    torch.testing.assert_close(state.output(), forward_output[:, prefix_length-1])
+    # Reverse the order of the batch elements, as beam search would rearrange
+    # them.
+    reverse = torch.arange(batch_size - 1, -1, -1)
+    state = state.transform_tensors(lambda x: x[reverse])
+    result = state.forward(
+        input_sequence[reverse, prefix_length:],
+        return_state=True,
+        include_first=True
+    )
+    torch.testing.assert_close(result.output, forward_output[reverse, prefix_length-1:])
+    torch.testing.assert_close(result.state.output(), forward_output[reverse, -1])
+    state = state.slice_batch(slice(1, 3))
+    state = state.next(input_sequence[reverse[1:3], prefix_length])
+    torch.testing.assert_close(state.output(), forward_output[reverse[1:3], prefix_length])
+
 def is_finite(tensor):
     return torch.all(torch.isfinite(tensor)).item()
 